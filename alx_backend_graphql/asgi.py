@@ -12,5 +12,24 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'alx_backend_graphql.settings')
+# no persistent connections, see CONN_MAX_AGE in settings.py
+os.environ.setdefault('DJANGO_CONN_MAX_AGE', '0')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# the apps are loaded now
+from crm.subscriptions import websocket_application  # noqa: E402
+from crm.warmup import warmup_settings, warm_up  # noqa: E402
+
+# GraphQL subscriptions on ws://.../graphql/ (crm/subscriptions.py), everything else is Django
+websocket = websocket_application()
+
+# build the schema and caches now rather than in the first request (crm/warmup.py)
+if warmup_settings()["ENABLED"]:
+    warm_up()
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "websocket":
+        return await websocket(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -1,12 +1,45 @@
-import graphene
-from graphene_django import DjangoObjectType
-from crm.schema import Mutation as CRMMutation
-from crm.schema import Query as CRMQuery
-
-class Query(CRMQuery, graphene.ObjectType):
-    pass
-#project level mutation
-class Mutation(CRMMutation, graphene.ObjectType):
-    pass
-
-schema = graphene.Schema(query=Query, mutation=Mutation)
\ No newline at end of file
+import threading
+
+# the schema is built on first use, not on import: URL loading and
+# `manage.py` commands that never execute a query don't pay for crm.schema.
+# `from alx_backend_graphql.schema import schema` and GRAPHENE["SCHEMA"]
+# both go through get_schema(), crm/warmup.py builds it when a worker boots.
+
+_schema = None
+_lock = threading.Lock()
+
+
+def build_schema():
+    import graphene
+
+    from crm.schema import Mutation as CRMMutation
+    from crm.schema import Query as CRMQuery
+    from crm.schema import Subscription as CRMSubscription
+
+    class Query(CRMQuery, graphene.ObjectType):
+        pass
+
+    #project level mutation
+    class Mutation(CRMMutation, graphene.ObjectType):
+        pass
+
+    class Subscription(CRMSubscription, graphene.ObjectType):
+        pass
+
+    return graphene.Schema(query=Query, mutation=Mutation, subscription=Subscription)
+
+
+def get_schema():
+    global _schema
+    if _schema is None:
+        # threaded workers may all take their first request at once
+        with _lock:
+            if _schema is None:
+                _schema = build_schema()
+    return _schema
+
+
+def __getattr__(name):
+    if name == "schema":
+        return get_schema()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
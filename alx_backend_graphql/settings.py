@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -74,13 +75,31 @@ WSGI_APPLICATION = 'alx_backend_graphql.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# how long a connection is kept between requests. a WSGI worker thread reuses its own,
+# PRAGMAs and page cache included. under ASGI the ORM runs in sync_to_async/run_sync
+# threads and request_finished only closes old connections in the thread it fires in,
+# so kept connections pile up in those threads: asgi.py sets DJANGO_CONN_MAX_AGE=0.
+CONN_MAX_AGE = int(os.environ.get('DJANGO_CONN_MAX_AGE', 600))
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            # take the write lock at BEGIN so concurrent writers queue instead of erroring
+            'transaction_mode': 'IMMEDIATE',
+            # seconds a connection waits for a lock
+            'timeout': 5,
+        },
     }
 }
 
+# local stand-ins for read replicas, `manage.py sync_replicas` copies db.sqlite3 over them
+DATABASES['replica1'] = {**DATABASES['default'], 'NAME': BASE_DIR / 'replica1.sqlite3'}
+DATABASES['replica2'] = {**DATABASES['default'], 'NAME': BASE_DIR / 'replica2.sqlite3'}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -125,8 +144,79 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
 GRAPHENE = {
-    "SCHEMA": "crm.schema.schema"
+    "SCHEMA": "alx_backend_graphql.schema.schema",  # built lazily, see that module
+    # graphene-django adds DjangoDebugMiddleware when DEBUG is on. there is no _debug field to
+    # report to, and it leaves the cursor of every database alias wrapped after a request
+    "MIDDLEWARE": [],
 }
 
 
+# parsed + validated GraphQL documents kept in memory, keyed by query sha256 (also the APQ hash)
+GRAPHQL_DOCUMENT_CACHE_SIZE = 1000
+
+# query cost analysis (crm/cost.py), checked before execution
+GRAPHQL_MAX_QUERY_COST = 50000
+GRAPHQL_MAX_QUERY_DEPTH = 10
+GRAPHQL_MAX_PAGE_SIZE = 100
+
+# per-resolver tracing and SQL instrumentation (crm/tracing.py)
+GRAPHQL_TRACING = {
+    "SAMPLE_RATE": 0.0,
+    "INCLUDE_IN_RESPONSE": False,
+    "ALLOW_CLIENT_REQUEST": False,  # True lets staff users send X-GraphQL-Trace: 1, the trace holds raw SQL
+}
+
+# response cache for read queries (crm/response_cache.py), invalidated per model on save/delete
+GRAPHQL_RESPONSE_CACHE = {
+    "ENABLED": False,
+    "BACKEND": "local",  # or "django" to share entries through CACHES
+    "MAXSIZE": 1000,
+}
+
+# applied to every new SQLite connection (crm/db.py)
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",  # readers don't block the writer and vice versa
+    "synchronous": "NORMAL",  # safe with WAL, fsync only at checkpoints
+    "busy_timeout": 5000,  # ms
+    "cache_size": -64000,  # negative is KiB, 64MB per connection
+    "mmap_size": 268435456,  # 256MB
+    "temp_store": "MEMORY",
+}
 
+# JSON array bodies on /graphql/ run every operation in one request, with shared loaders (crm/views.py)
+GRAPHQL_BATCH = {
+    "MAX_OPERATIONS": 20,
+    "CONCURRENT_READS": True,  # /graphql/async/ runs consecutive queries side by side
+}
+
+# bulkCreateCustomers/bulkCreateOrders(background: true), worked off in committed chunks (crm/jobs.py)
+CRM_BULK_JOBS = {
+    "WORKERS": 1,  # threads per process, 0 leaves the jobs to `manage.py run_bulk_jobs`
+    "CHUNK_SIZE": 500,  # rows per transaction
+    "PAUSE": 0.01,  # seconds between chunks, lets waiting writers take the write lock
+}
+
+# query operations read from these {alias: weight} (crm/routing.py), e.g. {"replica1": 1, "replica2": 1}
+DATABASE_ROUTERS = ["crm.routing.ReplicaRouter"]
+DATABASE_READ_REPLICAS = {
+    "ALIASES": {},
+    "PIN_SECONDS": 5,  # a client's queries stay on the primary this long after it wrote
+}
+
+# change log behind changesSince and the orderCreated/productStockChanged subscriptions (crm/feed.py)
+CRM_CHANGE_FEED = {
+    "BROKER": "local",  # or "database": poll the change log, sees the writes of other processes too
+    "POLL_INTERVAL": 1.0,  # seconds, "database" broker
+    "RETENTION_DAYS": 7,  # `manage.py prune_change_feed`
+}
+
+# column fields of CustomerType/ProductType/OrderType skip per-field resolution (crm/serialization.py)
+GRAPHQL_FAST_PATH = True
+
+# asgi.py/wsgi.py build the schema and fill the document cache before the first request (crm/warmup.py),
+# `manage.py boot_report --warm-up` times it
+GRAPHQL_WARMUP = {
+    "ENABLED": True,
+    "INTROSPECTION": True,
+    "DOCUMENTS": [],  # .graphql files or directories, the exact text clients send
+}
@@ -16,14 +16,17 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
-from graphene_django.views import GraphQLView
-from . schema import schema # This is  cuz of checker bugs. schema should be in the crm.urls.py i should only access crm/ here i think
+from crm.views import AsyncCRMGraphQLView, CRMGraphQLView, cache_stats
 from django.views.decorators.csrf import csrf_exempt
 
 
 
 urlpatterns = [
     path('admin/', admin.site.urls),
-    # path('crm/', include('crm.urls')), ---> the correct thing
-    path('graphql/', csrf_exempt(GraphQLView.as_view(graphiql=True, schema=schema))),
+    path('crm/', include('crm.urls')),
+    # no schema= here: the views take GRAPHENE["SCHEMA"], built on the first request (or by crm/warmup.py)
+    path('graphql/', csrf_exempt(CRMGraphQLView.as_view(graphiql=True))),
+    # async execution path, only worth it when served through ASGI (asgi.py)
+    path('graphql/async/', csrf_exempt(AsyncCRMGraphQLView.as_view(graphiql=True))),
+    path('graphql/cache-stats/', cache_stats),
 ]
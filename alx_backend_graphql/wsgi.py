@@ -14,3 +14,10 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'alx_backend_graphql.settings')
 
 application = get_wsgi_application()
+
+# the apps are loaded now
+from crm.warmup import warmup_settings, warm_up  # noqa: E402
+
+# build the schema and caches now rather than in the first request (crm/warmup.py)
+if warmup_settings()["ENABLED"]:
+    warm_up()
@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class CrmConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'crm'
+
+    def ready(self):
+        from . import db, feed, response_cache, tracing
+        db.connect_signals()
+        response_cache.connect_signals()
+        feed.connect_signals()
+        tracing.connect_signals()
@@ -0,0 +1,372 @@
+import gc
+import json
+import os
+import random
+import time
+import tracemalloc
+import uuid
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django_filters import OrderingFilter
+from graphene.utils.str_converters import to_camel_case
+
+from alx_backend_graphql.schema import schema
+from crm.filters import CustomerFilter, OrderFilter, ProductFilter
+from crm.models import Customer, Order, Product
+from crm.serialization import default_execution_context
+from crm.stats import rebuild_customer_stats, rebuild_sales_rollups
+
+
+# ==========
+#  benchmark harness.
+#  seeds a synthetic dataset, runs a fixed set of scenarios (paginated
+#  reads with nested relations, one query per filter, every mutation)
+#  through schema.execute or the test client, and records p50/p99
+#  latency, SQL queries and peak Python memory per scenario. results are
+#  compared with a stored baseline: more queries than the baseline is
+#  always a regression, latency and memory get a tolerance.
+# ==========
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "benchmark_baseline.json")
+
+# what the stored baseline was taken on. scale it up with the command's flags
+# (100k customers, 10k products, 1M orders...), timings are then not compared
+DEFAULT_DATASET = {"customers": 10_000, "products": 1_000, "orders": 100_000, "lines": 3}
+
+# p99 latency may grow by this fraction of the baseline (and at least this
+# many ms) before it counts. timings on a shared machine easily double from
+# one run to the next, so this catches the 10x of a lost index or an N+1,
+# not a few percent. peak memory is steady and gets a tighter bound
+TOLERANCE = 2.0
+MIN_LATENCY_DELTA_MS = 5
+MEMORY_TOLERANCE = 0.25
+MIN_MEMORY_DELTA_KIB = 64
+
+# via: "schema" (schema.execute), "client" (POST /graphql/) or "batch" (`query` is a
+# list, POSTed to /graphql/ as one JSON array)
+Scenario = namedtuple("Scenario", ["name", "query", "variables", "via"])
+
+
+@contextmanager
+def scratch_database(path, overrides=None, settings=None):
+    """point the default connection at a fresh, migrated SQLite database at `path`.
+
+    `overrides` change the DATABASES entry, `settings` are applied with override_settings.
+    """
+    settings_dict = connections.settings["default"]
+    saved = dict(settings_dict)
+    connections.close_all()
+    settings_dict.update({**(overrides or {}), "NAME": path})
+    try:
+        with override_settings(**(settings or {})):
+            call_command("migrate", verbosity=0)
+            yield
+    finally:
+        connections.close_all()
+        settings_dict.clear()
+        settings_dict.update(saved)
+
+
+def seed(customers, products, orders, lines=3, batch_size=5000, seed=0, progress=None):
+    """bulk insert a synthetic dataset, then fill the aggregates and rollups"""
+    rng = random.Random(seed)
+    now = timezone.now()
+
+    customer_ids = []
+    for start in range(0, customers, batch_size):
+        with transaction.atomic():
+            created = Customer.objects.bulk_create(
+                Customer(name=f"customer {i}", email=f"customer{i}@example.com", phone=f"+1555{i:07d}")
+                for i in range(start, min(start + batch_size, customers))
+            )
+        customer_ids += [customer.id for customer in created]
+    with transaction.atomic():
+        catalog = [
+            (product.id, product.price) for product in Product.objects.bulk_create(
+                (Product(name=f"product {i}", price=Decimal(rng.randint(100, 50000)) / 100, stock=10 ** 6)
+                 for i in range(products)),
+                batch_size=batch_size,
+            )
+        ]
+    if progress:
+        progress(f"{customers} customers, {products} products")
+
+    through = Order.products.through
+    for start in range(0, orders, batch_size):
+        count = min(batch_size, orders - start)
+        picks = [rng.sample(catalog, min(lines, len(catalog))) for _ in range(count)]
+        with transaction.atomic():
+            created = Order.objects.bulk_create(
+                Order(
+                    customer_id=rng.choice(customer_ids),
+                    # three years of history
+                    order_date=now - timedelta(minutes=rng.randint(0, 3 * 365 * 24 * 60)),
+                    total_amount=sum(price for _, price in lines_),
+                )
+                for lines_ in picks
+            )
+            through.objects.bulk_create(
+                through(order_id=order.id, product_id=product_id)
+                for order, lines_ in zip(created, picks)
+                for product_id, _ in lines_
+            )
+        if progress:
+            progress(f"{start + count} orders")
+
+    with transaction.atomic():
+        rebuild_customer_stats()
+        rebuild_sales_rollups()
+
+
+# ---------- scenarios
+
+ORDERS_PAGE = """
+    query ($first: Int, $keyset: Boolean) {
+        allOrders(first: $first, keyset: $keyset) {
+            edges { node {
+                id totalAmount orderDate
+                customer { name email }
+                products { edges { node { name price } } }
+            } }
+        }
+    }
+"""
+
+CUSTOMERS_PAGE = "{ allCustomers(first: 50) { totalCount edges { node { name email orderCount lifetimeTotal } } } }"
+PRODUCTS_PAGE = "{ allProducts(first: 50) { totalCount edges { node { name price stock } } } }"
+SALES_BY_MONTH = "{ salesSummary(groupBy: MONTH) { period orderCount units revenue } }"
+
+CREATE_CUSTOMER = """
+    mutation ($name: String!, $email: String!) {
+        createCustomer(customerData: {name: $name, email: $email, phone: "+15550000000"}) { customer { id } }
+    }
+"""
+BULK_CREATE_CUSTOMERS = """
+    mutation ($customers: [CustomerInput!]!) { bulkCreateCustomers(customerList: $customers) { creationErrors } }
+"""
+CREATE_PRODUCT = """
+    mutation ($name: String!) { createProduct(productData: {name: $name, price: "9.99", stock: 10}) { product { id } } }
+"""
+CREATE_ORDER = """
+    mutation ($customerId: ID!, $productIds: [ID]!) {
+        createOrder(orderData: {customerId: $customerId, productIds: $productIds}) { order { id } }
+    }
+"""
+BULK_CREATE_ORDERS = """
+    mutation ($orders: [OrderInput!]!) { bulkCreateOrders(orderList: $orders) { creationErrors } }
+"""
+
+
+def unique():
+    return uuid.uuid4().hex[:12]
+
+
+def sample_value(filter_, argument_type):
+    """a literal for the `argument_type` argument of `filter_`.
+
+    bounds are wide enough to match rows on any seeded dataset: an empty
+    page skips a query, which would make the baseline's counts too low.
+    """
+    if isinstance(filter_, OrderingFilter):
+        return json.dumps("-" + to_camel_case(next(iter(filter_.param_map))))
+    lookup = filter_.lookup_expr
+    lower = lookup.endswith("gte")
+    if "year" in lookup:
+        return str(timezone.now().year - 3 if lower else timezone.now().year)
+    if "month" in lookup:
+        return "1" if lower else "12"
+    if argument_type == "DateTime":
+        return json.dumps((timezone.now() - timedelta(days=3 * 365 if lower else 0)).isoformat())
+    if argument_type in ("Int", "Float", "Decimal"):
+        return "0" if lower else "1000000000"
+    # long enough for the trigram index, matches "customer 100", "product 100", "+15550001003"...
+    return json.dumps("100")
+
+
+def filter_scenarios():
+    query_type = schema.graphql_schema.query_type
+    for field, filterset_class in (
+        ("allCustomers", CustomerFilter), ("allProducts", ProductFilter), ("allOrders", OrderFilter),
+    ):
+        arguments = query_type.fields[field].args
+        for name, filter_ in filterset_class.base_filters.items():
+            argument = to_camel_case(name)
+            value = sample_value(filter_, str(arguments[argument].type))
+            yield Scenario(
+                f"filter {field}.{argument}",
+                f"{{ {field}(first: 20, {argument}: {value}) {{ totalCount edges {{ node {{ id }} }} }} }}",
+                None,
+                "schema",
+            )
+
+
+def scenarios():
+    yield Scenario("allOrders offset page", ORDERS_PAGE, {"first": 50}, "schema")
+    yield Scenario("allOrders keyset page", ORDERS_PAGE, {"first": 50, "keyset": True}, "schema")
+    yield Scenario("allOrders over HTTP", ORDERS_PAGE, {"first": 50}, "client")
+    # what a page load sends as one JSON array instead of three requests
+    yield Scenario("page load batch over HTTP", ["{ hello }", CUSTOMERS_PAGE, PRODUCTS_PAGE], None, "batch")
+    yield Scenario("allCustomers page", CUSTOMERS_PAGE, None, "schema")
+    yield Scenario("allProducts page", PRODUCTS_PAGE, None, "schema")
+    yield Scenario("salesSummary by month", SALES_BY_MONTH, None, "schema")
+    yield from filter_scenarios()
+    yield Scenario("createCustomer", CREATE_CUSTOMER,
+                   lambda fixtures: {"name": "bench", "email": f"{unique()}@example.com"}, "schema")
+    yield Scenario("bulkCreateCustomers x20", BULK_CREATE_CUSTOMERS,
+                   lambda fixtures: {"customers": [{"name": "bench", "email": f"{unique()}@example.com"}
+                                                   for _ in range(20)]}, "schema")
+    yield Scenario("createProduct", CREATE_PRODUCT, lambda fixtures: {"name": f"bench {unique()}"}, "schema")
+    yield Scenario("createOrder", CREATE_ORDER,
+                   lambda fixtures: {"customerId": fixtures["customer_id"], "productIds": fixtures["product_ids"]},
+                   "schema")
+    yield Scenario("bulkCreateOrders x20", BULK_CREATE_ORDERS,
+                   lambda fixtures: {"orders": [{"customerId": fixtures["customer_id"],
+                                                 "productIds": fixtures["product_ids"]} for _ in range(20)]},
+                   "schema")
+
+
+# ---------- running
+
+class ScenarioFailed(Exception):
+    pass
+
+
+def fixtures():
+    return {
+        "customer_id": Customer.objects.order_by("pk").values_list("pk", flat=True).first(),
+        "product_ids": list(Product.objects.order_by("-stock", "pk").values_list("pk", flat=True)[:3]),
+    }
+
+
+def run_once(scenario, variables, client):
+    if scenario.via == "client":
+        body = json.dumps({"query": scenario.query, "variables": variables})
+        response = client.post("/graphql/", body, content_type="application/json")
+        errors = response.json().get("errors")
+    elif scenario.via == "batch":
+        body = json.dumps([{"query": query, "variables": variables} for query in scenario.query])
+        response = client.post("/graphql/", body, content_type="application/json")
+        errors = [error for result in response.json() for error in result.get("errors", [])]
+    else:
+        # what the views run with
+        errors = schema.execute(
+            scenario.query, variables=variables, execution_context_class=default_execution_context()
+        ).errors
+    if errors:
+        raise ScenarioFailed(f"{scenario.name}: {errors[0]}")
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def measure(scenario, iterations=50, warmup=2, data=None, client=None):
+    """{p50_ms, p99_ms, queries, peak_kib} of one scenario"""
+    data = data or fixtures()
+    client = client or Client()
+
+    def variables():
+        return scenario.variables(data) if callable(scenario.variables) else scenario.variables
+
+    for _ in range(warmup):
+        run_once(scenario, variables(), client)
+
+    # like timeit, keep collector pauses out of the timings
+    latencies, queries = [], 0
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(iterations):
+            current = variables()
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                run_once(scenario, current, client)
+                latencies.append(time.perf_counter() - start)
+            queries = max(queries, len(captured))
+    finally:
+        gc.enable()
+
+    # tracing allocations slows everything down, so memory gets a run of its own
+    current = variables()
+    tracemalloc.start()
+    try:
+        run_once(scenario, current, client)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "queries": queries,
+        "peak_kib": round(peak / 1024, 1),
+    }
+
+
+def run(selected=None, iterations=50, warmup=2, progress=None):
+    """measure every scenario (or those whose name contains `selected`), {name: result}"""
+    data, client = fixtures(), Client()
+    results = {}
+    for scenario in scenarios():
+        if selected and selected not in scenario.name:
+            continue
+        results[scenario.name] = measure(scenario, iterations, warmup, data, client)
+        if progress:
+            progress(scenario.name, results[scenario.name])
+    return results
+
+
+# ---------- baseline
+
+def load_baseline(path=BASELINE_PATH):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def save_baseline(results, dataset, path=BASELINE_PATH):
+    """write `results` as the baseline, keeping the other scenarios of a baseline on the same dataset"""
+    baseline = load_baseline(path)
+    if baseline is not None and baseline["dataset"] == dataset:
+        results = {**baseline["scenarios"], **results}
+    with open(path, "w") as file:
+        json.dump({"dataset": dataset, "scenarios": results}, file, indent=2, sort_keys=True)
+        file.write("\n")
+
+
+def compare(results, baseline, tolerance=TOLERANCE, timings=True):
+    """regressions of `results` against `baseline`, as readable strings.
+
+    query counts don't depend on the dataset or the machine and must never
+    grow. latency and memory are only compared when `timings` is set, which
+    only makes sense on the dataset and machine the baseline was taken on.
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline["scenarios"].get(name)
+        if base is None:
+            continue
+        if result["queries"] > base["queries"]:
+            regressions.append(f"{name}: {result['queries']} queries, baseline {base['queries']}")
+        if not timings:
+            continue
+        limits = (
+            ("p99_ms", "ms", tolerance, MIN_LATENCY_DELTA_MS),
+            ("peak_kib", "KiB", MEMORY_TOLERANCE, MIN_MEMORY_DELTA_KIB),
+        )
+        for key, unit, allowed, min_delta in limits:
+            limit = max(base[key] * (1 + allowed), base[key] + min_delta)
+            if result[key] > limit:
+                regressions.append(f"{name}: {key} {result[key]}{unit}, baseline {base[key]}{unit}")
+    return regressions
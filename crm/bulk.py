@@ -0,0 +1,133 @@
+import re
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+
+from crm.models import Customer, Product
+from crm.response_cache import invalidate
+
+
+# ==========
+#  set based bulk helpers shared by the bulk mutations.
+#  rows are validated in memory first, the database is only asked
+#  set questions (one `IN (...)` per chunk) and written with bulk_create.
+# ==========
+
+PHONE_PATTERN = re.compile(r"^\+?\d{1,4}[-.\s]?\d{3}[-.\s]?\d{3,4}$")
+PHONE_ERROR = "Invalid phone format. Use +1234567890 or 123-456-7890."
+
+# rows per IN (...) lookup / INSERT statement, can be overridden per call
+DEFAULT_BATCH_SIZE = getattr(settings, "CRM_BULK_BATCH_SIZE", 500)
+
+
+def resolve_batch_size(batch_size):
+    """`batch_size`, DEFAULT_BATCH_SIZE when not given, raises ValidationError below 1"""
+    if batch_size is None:
+        return DEFAULT_BATCH_SIZE
+    if batch_size < 1:
+        # chunked() would yield nothing and the rows would silently go nowhere
+        raise ValidationError("batchSize must be at least 1")
+    return batch_size
+
+
+def validate_product(name, price, stock=None):
+    """the rules of createProduct, returns (name, price, stock) or raises ValidationError"""
+    stock = stock or 0
+    # NaN/Infinity and prices the column can't hold (max_digits, decimal_places) fail here
+    try:
+        price = Product._meta.get_field("price").clean(price, None)
+    except ValidationError as e:
+        raise ValidationError(f"price: {e.messages[0]}")
+    if price <= 0:
+        raise ValidationError("price  must be greater than 0")
+    if stock < 0:
+        raise ValidationError("stock cannot be negative")
+    return name, price, stock
+
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def existing_emails(emails, batch_size=DEFAULT_BATCH_SIZE):
+    """the subset of `emails` already in the database, one query per chunk"""
+    found = set()
+    for chunk in chunked(list(emails), batch_size):
+        found.update(Customer.objects.filter(email__in=chunk).values_list("email", flat=True))
+    return found
+
+
+def insert_customers(chunk):
+    """bulk_create the (index, Customer) pairs of `chunk` in one transaction, returns (created, errors).
+
+    an email taken by a concurrent writer since existing_emails() fails the
+    INSERT, those rows are reported and the rest of the chunk tried again.
+    """
+    errors = []
+    for attempt in range(2):
+        try:
+            with transaction.atomic():
+                return Customer.objects.bulk_create([customer for _, customer in chunk]), errors
+        except IntegrityError as e:
+            failure = e
+        taken = existing_emails({customer.email for _, customer in chunk})
+        errors.extend(
+            (index, f"this email '{customer.email}' is already in use") for index, customer in chunk
+            if customer.email in taken
+        )
+        chunk = [(index, customer) for index, customer in chunk if customer.email not in taken]
+        for _, customer in chunk:
+            # bulk_create may have set pks before the rollback
+            customer.pk = None
+    errors.extend((index, f"could not be saved: {failure}") for index, _ in chunk)
+    return [], errors
+
+
+def bulk_create_customers(rows, batch_size=None, offset=0):
+    """validate and insert customer rows.
+
+    rows are objects/dicts with name, email and phone. returns
+    (created_customers, errors) where errors keep the 1-based position of
+    the row in the original input, of which `rows` starts at `offset`.
+    """
+    batch_size = resolve_batch_size(batch_size)
+    errors = []  # (index, message) pairs
+    valid = []  # (index, Customer) pairs
+    seen_emails = set()
+
+    for index, row in enumerate(rows):
+        get = row.get if isinstance(row, dict) else lambda key: getattr(row, key, None)
+        name, email, phone = get("name"), get("email"), get("phone")
+
+        if email in seen_emails:
+            errors.append((index, f"this email '{email}' appears more than once in the batch"))
+            continue
+        if phone and not PHONE_PATTERN.match(phone):
+            errors.append((index, PHONE_ERROR))
+            continue
+        seen_emails.add(email)
+        valid.append((index, Customer(name=name, email=email, phone=phone or "")))
+
+    taken = existing_emails(seen_emails, batch_size)
+
+    to_create = []
+    for index, customer in valid:
+        if customer.email in taken:
+            errors.append((index, f"this email '{customer.email}' is already in use"))
+            continue
+        to_create.append((index, customer))
+
+    created = []
+    # each chunk commits on its own so the write lock is never held for the whole import
+    for chunk in chunked(to_create, batch_size):
+        chunk_created, chunk_errors = insert_customers(chunk)
+        created.extend(chunk_created)
+        errors.extend(chunk_errors)
+    if created:
+        # bulk_create sends no post_save
+        invalidate(Customer)
+
+    # keep the error list in input order
+    return created, [f"Customer {offset + index + 1}: {message}" for index, message in sorted(errors)]
@@ -0,0 +1,42 @@
+import contextvars
+import functools
+
+from asgiref.sync import sync_to_async
+from django.db import connections
+
+
+# ==========
+#  helpers for the async execution path (AsyncCRMGraphQLView).
+#  resolvers check `is_async_context(info)` and hand back a coroutine
+#  instead of a value; anything that still needs the sync ORM (connection
+#  slicing, transactions) is pushed to a thread with `run_sync`.
+# ==========
+
+# set inside threads started by run_sync, so code running there takes the sync path
+in_worker = contextvars.ContextVar("crm_in_worker", default=False)
+
+
+def is_async_context(info):
+    return getattr(info.context, "is_async", False) and not in_worker.get()
+
+
+def run_sync(fn, *args, thread_sensitive=True, **kwargs):
+    """await `fn(*args, **kwargs)` from async code.
+
+    thread_sensitive=False runs it in a fresh worker thread with its own DB
+    connection, which is what lets independent root fields overlap; the
+    connection is closed again when the call is done.
+    """
+
+    @functools.wraps(fn)
+    def call():
+        # sync_to_async copies context changes back to the caller, so undo this on the way out
+        token = in_worker.set(True)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            in_worker.reset(token)
+            if not thread_sensitive:
+                connections.close_all()
+
+    return sync_to_async(call, thread_sensitive=thread_sensitive)()
@@ -0,0 +1,140 @@
+from django.conf import settings
+from graphql import GraphQLError, ValidationRule, get_named_type, is_leaf_type, validate
+from graphql.execution.values import get_argument_values, get_variable_values
+from graphql.language import FieldNode, FragmentSpreadNode, InlineFragmentNode
+
+
+# ==========
+#  query cost analysis.
+#  runs as a validation rule before anything touches the database:
+#   - every object field costs 1, scalars are free
+#   - a connection multiplies the cost of its selection by the page size
+#     it asked for (`first`/`last`, or the max page size if it gave none)
+#   - queries deeper than MAX_QUERY_DEPTH or asking for pages bigger than
+#     MAX_PAGE_SIZE are rejected outright
+#  the cost depends on variables ($first), so unlike the other rules it
+#  can't be cached with the parsed document and is checked per request.
+#  the operations of a batch share one budget, see check_batch_cost.
+# ==========
+
+MAX_QUERY_COST = getattr(settings, "GRAPHQL_MAX_QUERY_COST", 50000)
+MAX_QUERY_DEPTH = getattr(settings, "GRAPHQL_MAX_QUERY_DEPTH", 10)
+MAX_PAGE_SIZE = getattr(settings, "GRAPHQL_MAX_PAGE_SIZE", 100)
+
+
+def is_connection(field_def):
+    return "first" in field_def.args and "last" in field_def.args
+
+
+def max_query_cost():
+    return getattr(settings, "GRAPHQL_MAX_QUERY_COST", MAX_QUERY_COST)
+
+
+def query_cost_rule(variables=None, report=None, max_cost=None, max_depth=None, max_page_size=None):
+    """build a ValidationRule bound to this request's variables.
+
+    the computed cost of the executed operation is written to `report`
+    (a dict) so it can be returned in the response extensions.
+    """
+    # read the settings per request so overrides apply without a restart
+    max_cost = max_cost or max_query_cost()
+    max_depth = max_depth or getattr(settings, "GRAPHQL_MAX_QUERY_DEPTH", MAX_QUERY_DEPTH)
+    max_page_size = max_page_size or getattr(settings, "GRAPHQL_MAX_PAGE_SIZE", MAX_PAGE_SIZE)
+
+    class QueryCostRule(ValidationRule):
+        def enter_operation_definition(self, node, *_):
+            schema = self.context.schema
+            coerced = get_variable_values(schema, node.variable_definitions or [], variables or {})
+            if isinstance(coerced, list):
+                # bad variables are reported by the executor with better messages
+                return self.SKIP
+            self.variables = coerced
+
+            root_type = schema.get_root_type(node.operation)
+            cost = self.selection_cost(root_type, node.selection_set, depth=1)
+            if report is not None:
+                name = node.name.value if node.name else None
+                report[name] = {"requestedQueryCost": cost, "maximumAvailable": max_cost}
+            if cost > max_cost:
+                self.report_error(GraphQLError(
+                    f"Query cost {cost} exceeds the maximum cost of {max_cost}.", node
+                ))
+            return self.SKIP
+
+        def iter_fields(self, selection_set):
+            for selection in selection_set.selections:
+                if isinstance(selection, FieldNode):
+                    yield selection
+                elif isinstance(selection, InlineFragmentNode):
+                    yield from self.iter_fields(selection.selection_set)
+                elif isinstance(selection, FragmentSpreadNode):
+                    fragment = self.context.get_fragment(selection.name.value)
+                    if fragment is not None:
+                        yield from self.iter_fields(fragment.selection_set)
+
+        def selection_cost(self, parent_type, selection_set, depth):
+            if selection_set is None or not hasattr(parent_type, "fields"):
+                return 0
+            if depth > max_depth:
+                self.report_error(GraphQLError(
+                    f"Query depth exceeds the maximum depth of {max_depth}.", selection_set
+                ))
+                return 0
+
+            total = 0
+            for field_node in self.iter_fields(selection_set):
+                name = field_node.name.value
+                if name.startswith("__"):
+                    # introspection is cheap and deep, leave it alone
+                    continue
+                field_def = parent_type.fields.get(name)
+                if field_def is None:
+                    continue
+                field_type = get_named_type(field_def.type)
+                if is_leaf_type(field_type):
+                    continue
+
+                child_cost = self.selection_cost(field_type, field_node.selection_set, depth + 1)
+                if is_connection(field_def):
+                    total += 1 + self.page_size(field_def, field_node) * child_cost
+                else:
+                    total += 1 + child_cost
+            return total
+
+        def page_size(self, field_def, field_node):
+            try:
+                args = get_argument_values(field_def, field_node, self.variables)
+            except GraphQLError:
+                return max_page_size
+            requested = [args[arg] for arg in ("first", "last") if args.get(arg) is not None]
+            for size in requested:
+                if size > max_page_size:
+                    self.report_error(GraphQLError(
+                        f"Requesting {size} records on `{field_node.name.value}` exceeds "
+                        f"the maximum page size of {max_page_size}.", field_node
+                    ))
+            return max(requested) if requested else max_page_size
+
+    return QueryCostRule
+
+
+def check_query_cost(schema, document, variables=None, operation_name=None):
+    """returns (errors, cost report of the operation that will run)"""
+    report = {}
+    errors = validate(schema, document, [query_cost_rule(variables, report)])
+    if operation_name is None and len(report) == 1:
+        operation_name = next(iter(report))
+    return errors, report.get(operation_name)
+
+
+def check_batch_cost(costs, max_cost=None):
+    """the error for a batch whose operations together cost more than one may, else None.
+
+    every operation is checked on its own too, this keeps a batch of cheap
+    operations from adding up to MAX_OPERATIONS times the budget.
+    """
+    max_cost = max_cost or max_query_cost()
+    total = sum(costs)
+    if total > max_cost:
+        return GraphQLError(f"Batch cost {total} exceeds the maximum cost of {max_cost}.")
+    return None
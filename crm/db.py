@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+
+# ==========
+#  SQLite tuning.
+#  every new SQLite connection runs the PRAGMAs in settings.SQLITE_PRAGMAS
+#  (WAL, synchronous=NORMAL, cache/mmap sizes, busy_timeout). the write
+#  side lives in DATABASES: transaction_mode=IMMEDIATE makes transactions
+#  take the write lock at BEGIN, where busy_timeout can wait for it, instead
+#  of failing with "database is locked" when a reader upgrades halfway
+#  through, and CONN_MAX_AGE keeps connections (and their page cache)
+#  under WSGI; under ASGI it is 0, see settings.py.
+# ==========
+
+def sqlite_pragmas():
+    return getattr(settings, "SQLITE_PRAGMAS", {})
+
+
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        for name, value in sqlite_pragmas().items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+
+
+def connect_signals():
+    connection_created.connect(apply_sqlite_pragmas, dispatch_uid="crm_sqlite_pragmas")
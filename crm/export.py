@@ -0,0 +1,92 @@
+import csv
+import datetime
+import json
+from collections import defaultdict
+from decimal import Decimal
+from itertools import islice
+
+from django.conf import settings
+
+from crm.models import Order
+
+
+# ==========
+#  bulk export.
+#  rows are read with values_list().iterator(), so no model instances are
+#  built and only one chunk is held in memory at a time. the product ids of
+#  each chunk of orders come from one query on the through table, the
+#  batched equivalent of prefetch_related (which values_list can't use).
+#  every chunk is rendered into a single string and streamed out.
+# ==========
+
+EXPORT_CHUNK_SIZE = getattr(settings, "CRM_EXPORT_CHUNK_SIZE", 2000)
+
+CUSTOMER_COLUMNS = ("id", "name", "email", "phone", "created_at")
+ORDER_COLUMNS = ("id", "order_date", "total_amount", "customer_id", "customer__name")
+# how the order columns are named in the output
+ORDER_HEADER = ("id", "order_date", "total_amount", "customer_id", "customer_name", "product_ids")
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def plain(value):
+    """a value json and csv both write faithfully"""
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def customer_rows(queryset, chunk_size=None):
+    chunk_size = chunk_size or EXPORT_CHUNK_SIZE
+    rows = queryset.order_by("pk").values_list(*CUSTOMER_COLUMNS).iterator(chunk_size=chunk_size)
+    for chunk in batches(rows, chunk_size):
+        yield [tuple(plain(value) for value in row) for row in chunk]
+
+
+def order_rows(queryset, chunk_size=None):
+    chunk_size = chunk_size or EXPORT_CHUNK_SIZE
+    through = Order.products.through
+    rows = queryset.order_by("pk").values_list(*ORDER_COLUMNS).iterator(chunk_size=chunk_size)
+    for chunk in batches(rows, chunk_size):
+        products = defaultdict(list)
+        lines = through.objects.filter(order_id__in=[row[0] for row in chunk]).order_by("pk")
+        for order_id, product_id in lines.values_list("order_id", "product_id"):
+            products[order_id].append(product_id)
+        yield [
+            tuple(plain(value) for value in row) + (products[row[0]],)
+            for row in chunk
+        ]
+
+
+class Echo:
+    """csv.writer target that hands each line back instead of storing it"""
+
+    def write(self, value):
+        return value
+
+
+def render_csv(header, chunks):
+    writer = csv.writer(Echo())
+    yield writer.writerow(header)
+    for chunk in chunks:
+        yield "".join(
+            writer.writerow([" ".join(map(str, value)) if isinstance(value, list) else value for value in row])
+            for row in chunk
+        )
+
+
+def render_ndjson(header, chunks):
+    for chunk in chunks:
+        yield "".join(json.dumps(dict(zip(header, row))) + "\n" for row in chunk)
+
+
+RENDERERS = {
+    "csv": (render_csv, "text/csv"),
+    "ndjson": (render_ndjson, "application/x-ndjson"),
+}
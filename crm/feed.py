@@ -0,0 +1,252 @@
+import asyncio
+import threading
+from collections import namedtuple
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.utils import timezone
+
+from .models import ChangeEvent, Order, Product
+from .response_cache import invalidate
+
+
+# ==========
+#  change feed for orders and stock.
+#  every order created and every stock change adds a ChangeEvent row in the
+#  transaction that made it. changesSince(cursor) pages through those rows,
+#  so clients catch up without rescanning allOrders/allProducts, and once the
+#  transaction commits the events go to a broker that hands them to the
+#  orderCreated/productStockChanged subscriptions (crm/subscriptions.py).
+#
+#  the "local" broker only sees commits of its own process. the "database"
+#  broker stands in for an external one: it polls the change log, so it also
+#  delivers writes of other workers and of `manage.py run_bulk_jobs`.
+#
+#  the cursor is the row id. SQLite serializes writers, so ids appear in
+#  commit order and a reader never skips a row that commits late.
+# ==========
+
+DEFAULTS = {
+    # "local" (this process) or "database" (polls the change log)
+    "BROKER": "local",
+    # seconds between polls of the "database" broker
+    "POLL_INTERVAL": 1.0,
+    # `manage.py prune_change_feed` drops events older than this
+    "RETENTION_DAYS": 7,
+}
+
+
+def feed_settings():
+    return {**DEFAULTS, **getattr(settings, "CRM_CHANGE_FEED", {})}
+
+
+def record(topic, ids):
+    """log `topic` for the objects `ids` and publish it once the transaction commits"""
+    ids = list(ids)
+    if not ids:
+        return []
+    now = timezone.now()
+    events = ChangeEvent.objects.bulk_create(ChangeEvent(topic=topic, object_id=pk, created_at=now) for pk in ids)
+    # bulk_create sends no signals
+    invalidate(ChangeEvent)
+    transaction.on_commit(lambda: get_broker().publish(events))
+    return events
+
+
+def head():
+    """the cursor of the latest event, 0 for an empty log"""
+    return ChangeEvent.objects.order_by("-id").values_list("id", flat=True).first() or 0
+
+
+def changes_after(cursor, limit=None, topics=None, until=None):
+    """events after `cursor` (up to `until`), oldest first"""
+    queryset = ChangeEvent.objects.filter(id__gt=cursor).order_by("id")
+    if until is not None:
+        queryset = queryset.filter(id__lte=until)
+    if topics:
+        queryset = queryset.filter(topic__in=topics)
+    return list(queryset[:limit] if limit else queryset)
+
+
+def expired(cursor, latest):
+    """whether the events after `cursor` were pruned (or never were), the client has to reload instead"""
+    if cursor > latest:
+        return True
+    oldest = ChangeEvent.objects.order_by("id").values_list("id", flat=True).first()
+    return oldest is not None and cursor < oldest - 1
+
+
+# a page of changesSince
+FeedPage = namedtuple("FeedPage", ["changes", "cursor", "has_more", "reset"])
+
+
+def changes_since(cursor=None, first=100, topics=None):
+    """the events after `cursor`, each with its Order/Product as it is now in `target`.
+
+    without a cursor (the first call) or with an expired one the page is
+    empty and carries the latest cursor to continue from.
+    """
+    latest = head()
+    if cursor is None or expired(cursor, latest):
+        return FeedPage([], latest, False, cursor is not None)
+    # bounded by `latest`, an event committed meanwhile is left for the next call
+    events = changes_after(cursor, first + 1, topics, until=latest)
+    has_more = len(events) > first
+    events = events[:first]
+    targets = {}
+    for topic, model in ((ChangeEvent.ORDER_CREATED, Order), (ChangeEvent.PRODUCT_STOCK_CHANGED, Product)):
+        ids = {event.object_id for event in events if event.topic == topic}
+        if ids:
+            targets[topic] = model.objects.in_bulk(ids)
+    for event in events:
+        event.target = targets.get(event.topic, {}).get(event.object_id)
+    # filtered by topic, the rest of the log up to `latest` had nothing for the client
+    return FeedPage(events, events[-1].id if has_more else latest, has_more, False)
+
+
+def prune(days=None):
+    """drop events older than `days`, always keeping the latest so cursors stay comparable"""
+    days = feed_settings()["RETENTION_DAYS"] if days is None else days
+    cutoff = timezone.now() - timedelta(days=days)
+    deleted, _ = ChangeEvent.objects.filter(created_at__lt=cutoff, id__lt=head()).delete()
+    return deleted
+
+
+# ==========
+#  signals. writes that skip them (bulk_create, queryset.update) call `record` themselves.
+# ==========
+
+def order_saved(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        record(ChangeEvent.ORDER_CREATED, [instance.pk])
+
+
+def product_saved(sender, instance, created, update_fields=None, raw=False, **kwargs):
+    # a plain save() writes every column, the stock may have changed
+    if not raw and (created or update_fields is None or "stock" in update_fields):
+        record(ChangeEvent.PRODUCT_STOCK_CHANGED, [instance.pk])
+
+
+def connect_signals():
+    from .models import Order, Product
+
+    post_save.connect(order_saved, sender=Order, dispatch_uid="feed_order_created")
+    post_save.connect(product_saved, sender=Product, dispatch_uid="feed_product_stock")
+
+
+# ==========
+#  brokers
+# ==========
+
+class LocalBroker:
+    """hands the events committed in this process to its subscribers"""
+
+    def __init__(self, **_):
+        # topic -> {asyncio.Queue: the loop it belongs to}
+        self.subscribers = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, topic):
+        queue = asyncio.Queue()
+        with self.lock:
+            self.subscribers.setdefault(topic, {})[queue] = asyncio.get_running_loop()
+        return queue
+
+    def unsubscribe(self, topic, queue):
+        with self.lock:
+            self.subscribers.get(topic, {}).pop(queue, None)
+
+    def publish(self, events):
+        self.fan_out(events)
+
+    def fan_out(self, events):
+        by_topic = {}
+        for event in events:
+            by_topic.setdefault(event.topic, []).append(event)
+        with self.lock:
+            targets = [
+                (queue, loop, topic_events)
+                for topic, topic_events in by_topic.items()
+                for queue, loop in self.subscribers.get(topic, {}).items()
+            ]
+        for queue, loop, topic_events in targets:
+            # commits happen in worker threads, the queues live on the event loop
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, topic_events)
+            except RuntimeError:
+                # the loop is gone, its subscribers with it
+                pass
+
+
+# most events one poll reads
+POLL_BATCH = 1000
+
+
+class DatabaseBroker(LocalBroker):
+    """polls the change log, one poller per event loop while it has subscribers"""
+
+    def __init__(self, poll_interval=1.0, **_):
+        super().__init__()
+        self.poll_interval = poll_interval
+        self.pollers = {}
+
+    def subscribe(self, topic):
+        queue = super().subscribe(topic)
+        loop = asyncio.get_running_loop()
+        if loop not in self.pollers:
+            self.pollers[loop] = loop.create_task(self.poll(loop))
+        return queue
+
+    def publish(self, events):
+        # the pollers pick them up, with the events of every other process
+        pass
+
+    def listening(self, loop):
+        with self.lock:
+            return any(loop in queues.values() for queues in self.subscribers.values())
+
+    async def poll(self, loop):
+        try:
+            cursor = await sync_to_async(head)()
+            while self.listening(loop):
+                events = await sync_to_async(changes_after)(cursor, POLL_BATCH)
+                if events:
+                    cursor = events[-1].id
+                    self.fan_out(events)
+                # a full batch means a backlog, e.g. a bulk import, keep reading
+                if len(events) < POLL_BATCH:
+                    await asyncio.sleep(self.poll_interval)
+        finally:
+            self.pollers.pop(loop, None)
+
+
+BROKERS = {
+    "local": LocalBroker,
+    "database": DatabaseBroker,
+}
+
+_broker = None
+_broker_config = None
+
+
+def get_broker():
+    global _broker, _broker_config
+    config = feed_settings()
+    key = (config["BROKER"], config["POLL_INTERVAL"])
+    if key != _broker_config:
+        _broker, _broker_config = BROKERS[config["BROKER"]](poll_interval=config["POLL_INTERVAL"]), key
+    return _broker
+
+
+async def listen(topic):
+    """yield lists of events of `topic` as they are published, until closed"""
+    broker = get_broker()
+    queue = broker.subscribe(topic)
+    try:
+        while True:
+            yield await queue.get()
+    finally:
+        broker.unsubscribe(topic, queue)
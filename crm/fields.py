@@ -0,0 +1,258 @@
+import base64
+import datetime
+import inspect
+import json
+from functools import partial
+
+import graphene
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from graphene.relay import PageInfo
+from graphene_django.filter import DjangoFilterConnectionField
+from graphql import GraphQLError
+
+from .concurrency import is_async_context, run_sync
+from .loaders import get_loaders
+
+PAGINATION_ARGS = {"first", "last", "before", "after", "offset", "keyset"}
+
+
+class CountableConnection(graphene.relay.Connection):
+    """relay connection with a `totalCount` field.
+
+    offset pagination already knows the count. keyset pages never count up
+    front, `totalCount` runs a COUNT(*) only if a client selects it and the
+    field allows it, and resolves to null otherwise.
+    """
+
+    class Meta:
+        abstract = True
+
+    total_count = graphene.Int()
+
+    def resolve_total_count(self, info):
+        if getattr(self, "length", None) is not None:
+            return self.length
+        count_queryset = getattr(self, "count_queryset", None)
+        return count_queryset.count() if count_queryset is not None else None
+
+
+class BatchedFilterConnectionField(DjangoFilterConnectionField):
+    """DjangoFilterConnectionField that plays nicely with the per-request loaders.
+
+    - once a page is sliced, its nodes are handed to the loaders so that
+      relations on every node of the page are fetched in one batch
+    - a resolver may return a plain list (e.g. a loader result); it is used
+      as-is unless filter arguments were passed, in which case we fall back
+      to the normal filterset queryset
+    """
+
+    @classmethod
+    def resolve_queryset(
+        cls, connection, iterable, info, args, filtering_args, filterset_class
+    ):
+        if isinstance(iterable, list):
+            if not any(args.get(arg) is not None for arg in filtering_args):
+                return iterable
+            # filtering needs a queryset, rebuild one from the list
+            model = connection._meta.node._meta.model
+            iterable = model._default_manager.filter(pk__in=[obj.pk for obj in iterable])
+        return super().resolve_queryset(
+            connection, iterable, info, args, filtering_args, filterset_class
+        )
+
+    @staticmethod
+    def prime_loaders(connection, result, info):
+        edges = getattr(result, "edges", None)
+        if edges:
+            model = connection._meta.node._meta.model
+            get_loaders(info.context).prime(model, [edge.node for edge in edges])
+
+    @staticmethod
+    def needs_orm(iterable, args):
+        # a queryset, or a list that filter arguments turn back into one
+        return not isinstance(iterable, list) or any(
+            value is not None for name, value in args.items() if name not in PAGINATION_ARGS
+        )
+
+    @classmethod
+    def connection_resolver(cls, resolver, connection, default_manager,
+                            queryset_resolver, max_limit, enforce_first_or_last,
+                            root, info, **args):
+        iterable = resolver(root, info, **args)
+        if inspect.isawaitable(iterable) or (is_async_context(info) and cls.needs_orm(iterable, args)):
+            # async loaders hand back a future, finish the connection once it resolves
+            return cls.resolve_async(
+                iterable, connection, default_manager, queryset_resolver,
+                max_limit, enforce_first_or_last, root, info, **args
+            )
+
+        result = super().connection_resolver(
+            lambda *_, **__: iterable, connection, default_manager, queryset_resolver,
+            max_limit, enforce_first_or_last, root, info, **args
+        )
+        cls.prime_loaders(connection, result, info)
+        return result
+
+    @classmethod
+    async def resolve_async(cls, iterable, *resolver_args, **args):
+        if inspect.isawaitable(iterable):
+            iterable = await iterable
+        resolve = partial(cls.connection_resolver, lambda *_, **__: iterable, *resolver_args, **args)
+        if cls.needs_orm(iterable, args):
+            # slicing and filtering a queryset needs the sync ORM
+            return await run_sync(resolve)
+        return resolve()
+
+
+# ==========
+#  keyset (a.k.a. seek) pagination.
+#  the cursor carries the values of the sort key of the last row, the next
+#  page is `WHERE (k, id) > (...) ORDER BY k, id LIMIT n`, so it costs the
+#  same no matter how deep the client has paged. opt in per request with
+#  `keyset: true`, otherwise the field pages by offset as before.
+# ==========
+
+KEYSET_PREFIX = "keyset:"
+DEFAULT_PAGE_SIZE = 100
+
+
+class KeysetEncoder(DjangoJSONEncoder):
+    # DjangoJSONEncoder cuts datetimes to milliseconds, seeking needs the exact value
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+def encode_keyset_cursor(values):
+    payload = json.dumps(values, cls=KeysetEncoder, separators=(",", ":"))
+    return base64.b64encode((KEYSET_PREFIX + payload).encode()).decode()
+
+
+def decode_keyset_cursor(cursor, fields):
+    try:
+        raw = base64.b64decode(cursor).decode()
+        if not raw.startswith(KEYSET_PREFIX):
+            raise ValueError
+        values = json.loads(raw[len(KEYSET_PREFIX):])
+        if len(values) != len(fields):
+            raise ValueError
+        return [field.to_python(value) for field, value in zip(fields, values)]
+    except (ValueError, TypeError):
+        raise GraphQLError(f"Invalid keyset cursor: {cursor}")
+
+
+def seek_filter(names, values, descending=False):
+    """(k1, k2, ...) > (v1, v2, ...) spelled out with Q objects"""
+    lookup = "lt" if descending else "gt"
+    condition = Q()
+    for position, name in enumerate(names):
+        step = Q(**{f"{name}__{lookup}": values[position]})
+        for previous, value in zip(names[:position], values[:position]):
+            step &= Q(**{previous: value})
+        condition |= step
+    return condition
+
+
+class KeysetFilterConnectionField(BatchedFilterConnectionField):
+    """BatchedFilterConnectionField with an opt-in keyset pagination mode.
+
+    `keyset_fields` is the sort key and must end with a unique column
+    (usually "id"). `count_total=False` keeps `totalCount` from ever running
+    a COUNT(*) on keyset pages.
+    """
+
+    def __init__(self, type_, keyset_fields=("id",), count_total=True, *args, **kwargs):
+        self.keyset_fields = tuple(keyset_fields)
+        self.count_total = count_total
+        kwargs.setdefault("keyset", graphene.Boolean(
+            description=f"page with cursors on ({', '.join(self.keyset_fields)}) instead of offsets",
+        ))
+        super().__init__(type_, *args, **kwargs)
+
+    def keyset_resolver(self, resolver, connection, default_manager, queryset_resolver,
+                        max_limit, enforce_first_or_last, root, info, **args):
+        if not args.get("keyset"):
+            return self.connection_resolver(
+                resolver, connection, default_manager, queryset_resolver,
+                max_limit, enforce_first_or_last, root, info, **args
+            )
+
+        first, last = args.get("first"), args.get("last")
+        after, before = args.get("after"), args.get("before")
+        if args.get("offset") is not None:
+            raise GraphQLError("offset can't be combined with keyset pagination")
+        if args.get("order_by"):
+            raise GraphQLError(f"keyset pages are ordered by ({', '.join(self.keyset_fields)}), drop orderBy")
+        if enforce_first_or_last and not (first or last):
+            raise GraphQLError(f"You must provide a `first` or `last` value to paginate `{info.field_name}`.")
+        limit = first or last or max_limit or DEFAULT_PAGE_SIZE
+        if max_limit and limit > max_limit:
+            raise GraphQLError(f"Requesting {limit} records on `{info.field_name}` exceeds the limit of {max_limit}.")
+
+        iterable = resolver(root, info, **args)
+        if iterable is None:
+            iterable = default_manager
+        queryset = queryset_resolver(connection, iterable, info, args)
+
+        model = queryset.model
+        fields = [model._meta.get_field(name) for name in self.keyset_fields]
+        names = [field.attname for field in fields]
+        loaded, deferred = queryset.query.deferred_loading
+        if loaded and not deferred:
+            # the planner narrowed the columns with .only(), the cursor needs the key too
+            queryset = queryset.only(*loaded, *names)
+        backwards = bool(last) and not first
+
+        if after:
+            queryset = queryset.filter(seek_filter(names, decode_keyset_cursor(after, fields)))
+        if before:
+            queryset = queryset.filter(seek_filter(names, decode_keyset_cursor(before, fields), descending=True))
+        ordering = [f"-{name}" for name in names] if backwards else names
+
+        # one extra row tells us whether there is another page, no COUNT(*) needed
+        rows = list(queryset.order_by(*ordering)[:limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if backwards:
+            rows.reverse()
+
+        edges = [
+            connection.Edge(node=row, cursor=encode_keyset_cursor([getattr(row, name) for name in names]))
+            for row in rows
+        ]
+        result = connection(
+            edges=edges,
+            page_info=PageInfo(
+                start_cursor=edges[0].cursor if edges else None,
+                end_cursor=edges[-1].cursor if edges else None,
+                has_previous_page=has_more if backwards else bool(after),
+                has_next_page=bool(before) if backwards else has_more,
+            ),
+        )
+        result.iterable = queryset
+        result.length = None
+        if self.count_total:
+            result.count_queryset = queryset_resolver(connection, iterable, info, args)
+        self.prime_loaders(connection, result, info)
+        return result
+
+    def async_resolver(self, *resolver_args, **args):
+        info = resolver_args[-1]
+        if is_async_context(info):
+            # filtering, counting and slicing all need the ORM: run the whole connection in its
+            # own worker thread so sibling root fields are resolved at the same time
+            return run_sync(self.keyset_resolver, *resolver_args, thread_sensitive=False, **args)
+        return self.keyset_resolver(*resolver_args, **args)
+
+    def wrap_resolve(self, parent_resolver):
+        return partial(
+            self.async_resolver,
+            self.resolver or parent_resolver,
+            self.connection_type,
+            self.get_manager(),
+            self.get_queryset_resolver(),
+            self.max_limit,
+            self.enforce_first_or_last,
+        )
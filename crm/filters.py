@@ -1,20 +1,52 @@
 import django_filters
+import graphene
+from graphene_django.filter import TypedFilter
+
 from .models import Customer, Product, Order
+from .search import matching_ids, search
+
+
+def date_part_filter(field_name, lookup_expr):
+    # left in Meta.fields, graphene-django types year/month bounds like the date
+    # field itself (DateTime), which the number lookup then rejects
+    return TypedFilter(field_name=field_name, lookup_expr=lookup_expr, input_type=graphene.Int)
+
 
 #defining the filters for each model
 class CustomerFilter(django_filters.FilterSet):
     phone_country_code = django_filters.CharFilter(field_name='phone', lookup_expr='iregex')
+    # year (which django turns into date bounds) can use crm_customer_created_idx,
+    # month__ is an extract() and always scans
+    created_at__year__gte = date_part_filter('created_at', 'year__gte')
+    created_at__year__lte = date_part_filter('created_at', 'year__lte')
+    created_at__month__gte = date_part_filter('created_at', 'month__gte')
+    created_at__month__lte = date_part_filter('created_at', 'month__lte')
+    # ranked substring search on name/email through the trigram index (crm/search.py)
+    search = django_filters.CharFilter(method='filter_search')
+    # orderBy: "-lifetimeTotal" lists the best customers first, straight off crm_customer_spend_idx
+    order_by = django_filters.OrderingFilter(
+        fields=('lifetime_total', 'order_count', 'last_order_date', 'created_at', 'name')
+    )
     class Meta:
         model = Customer
         fields = {
             'name': ['icontains'],
             'email': ['icontains'],
-            'created_at': ['year__gte', 'year__lte','month__gte', 'month__lte']
+            # crm_customer_created_idx
+            'created_at': ['gte', 'lte'],
+            # denormalized order aggregates, all indexed
+            'order_count': ['gte', 'lte'],
+            'lifetime_total': ['gte', 'lte'],
+            'last_order_date': ['gte', 'lte'],
         } 
 
+    def filter_search(self, queryset, name, value):
+        return search(queryset, value)
+
 
 class ProductFilter(django_filters.FilterSet):
-    
+    search = django_filters.CharFilter(method='filter_search')
+
     class Meta:
         model = Product
         fields = {
@@ -23,20 +55,29 @@ class ProductFilter(django_filters.FilterSet):
             'stock': ['gte', 'lte']        
         }
 
+    def filter_search(self, queryset, name, value):
+        return search(queryset, value)
+
 
 class OrderFilter(django_filters.FilterSet):
+    # declared filters are picked up automatically, so they stay out of Meta.fields
     customer_name = django_filters.CharFilter(field_name='customer__name', lookup_expr='icontains')
     product_name = django_filters.CharFilter(method='filter_by_product_name')
+    order_date__year__gte = date_part_filter('order_date', 'year__gte')
+    order_date__year__lte = date_part_filter('order_date', 'year__lte')
+    order_date__month__gte = date_part_filter('order_date', 'month__gte')
+    order_date__month__lte = date_part_filter('order_date', 'month__lte')
     class Meta:
         model = Order
         fields = {
             'total_amount': ['gte','lte'],
-            'order_date': ['year__gte', 'year__lte','month__gte', 'month__lte'],
-            'customer_name': ['customer__name__icontains'],
-            'product_name': ['product__name__icontains']
+            'order_date': ['gte', 'lte'],
         }
-        
-        def filter_by_product_name(self, queryset, name, value):
-            if value:
-                return queryset.filter(products__name__icontains=value)
-            return queryset
\ No newline at end of file
+
+    def filter_by_product_name(self, queryset, name, value):
+        if value:
+            # product ids come from the search index instead of a LIKE '%x%' over the join,
+            # the m2m join returns one row per matching product, so dedupe the orders
+            product_ids = matching_ids(Product, value, using=queryset.db)
+            return queryset.filter(products__in=product_ids).distinct()
+        return queryset
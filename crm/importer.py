@@ -0,0 +1,334 @@
+import csv
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from crm.bulk import (
+    PHONE_ERROR, PHONE_PATTERN, chunked, existing_emails, resolve_batch_size, validate_product,
+)
+from crm.feed import record
+from crm.models import ChangeEvent, Customer, Order, Product
+from crm.orders import attach_products
+from crm.response_cache import invalidate
+from crm.stats import rebuild_customer_stats, rebuild_sales_rollups
+
+
+# ==========
+#  CSV import.
+#  the file is read in chunks of `batch_size` rows. parsing and the checks
+#  that need no database (types, phone format, price > 0, stock >= 0) are
+#  pure functions, so they can run in a process pool; the checks against
+#  the database and the writes happen in this process, one transaction and
+#  one bulk_create per chunk. rejected rows are collected with their line
+#  number and the reason.
+# ==========
+
+class Rejected(Exception):
+    pass
+
+
+def parse_decimal(value, name):
+    try:
+        number = Decimal(value)
+    except (InvalidOperation, TypeError):
+        raise Rejected(f"{name} is not a number")
+    if not number.is_finite():
+        # NaN makes any comparison raise InvalidOperation
+        raise Rejected(f"{name} is not a number")
+    return number
+
+
+def parse_int(value, name):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise Rejected(f"{name} is not an integer")
+
+
+def parse_optional_id(row):
+    return parse_int(row["id"], "id") if row.get("id") else None
+
+
+def parse_customer(row):
+    name, email, phone = (row.get("name") or "").strip(), (row.get("email") or "").strip(), (row.get("phone") or "").strip()
+    if not name or not email:
+        raise Rejected("name and email are required")
+    try:
+        validate_email(email)
+    except ValidationError:
+        raise Rejected(f"'{email}' is not a valid email")
+    if phone and not PHONE_PATTERN.match(phone):
+        raise Rejected(PHONE_ERROR)
+    return {"name": name, "email": email, "phone": phone}
+
+
+def parse_product(row):
+    name = (row.get("name") or "").strip()
+    if not name:
+        raise Rejected("name is required")
+    price = parse_decimal(row.get("price"), "price")
+    stock = parse_int(row["stock"], "stock") if row.get("stock") else 0
+    try:
+        name, price, stock = validate_product(name, price, stock)
+    except ValidationError as e:
+        raise Rejected(e.messages[0])
+    except InvalidOperation:
+        raise Rejected("price is not a number")
+    return {"id": parse_optional_id(row), "name": name, "price": price, "stock": stock}
+
+
+def parse_order(row):
+    customer_id = parse_int(row["customer_id"], "customer_id") if row.get("customer_id") else None
+    customer_email = (row.get("customer_email") or "").strip() or None
+    if customer_id is None and customer_email is None:
+        raise Rejected("customer_id or customer_email is required")
+    # the same space separated list the export writes
+    product_ids = [parse_int(value, "product_ids") for value in (row.get("product_ids") or "").replace(";", " ").split()]
+    if not product_ids:
+        raise Rejected("Order must have at least one product")
+    order_date = None
+    if row.get("order_date"):
+        order_date = parse_datetime(row["order_date"])
+        if order_date is None:
+            raise Rejected("order_date is not a date and time")
+        if timezone.is_naive(order_date):
+            order_date = timezone.make_aware(order_date)
+    total_amount = None
+    if row.get("total_amount"):
+        try:
+            total_amount = Order._meta.get_field("total_amount").clean(
+                parse_decimal(row["total_amount"], "total_amount"), None
+            )
+        except ValidationError as e:
+            raise Rejected(f"total_amount: {e.messages[0]}")
+    return {
+        "id": parse_optional_id(row),
+        "customer_id": customer_id,
+        "customer_email": customer_email,
+        "product_ids": product_ids,
+        "order_date": order_date,
+        "total_amount": total_amount,
+    }
+
+
+PARSERS = {"customers": parse_customer, "products": parse_product, "orders": parse_order}
+
+
+def parse_chunk(kind, rows):
+    """[(line, row)] -> (parsed [(line, row, values)], rejected [(line, row, reason)])
+
+    module level and free of database access, so it can be sent to a worker process.
+    """
+    parse = PARSERS[kind]
+    parsed, rejected = [], []
+    for line, row in rows:
+        try:
+            parsed.append((line, row, parse(row)))
+        except Rejected as e:
+            rejected.append((line, row, str(e)))
+    return parsed, rejected
+
+
+def read_chunks(file, batch_size):
+    """[(line, row)] lists of up to `batch_size` rows, line numbers as in the file (header is 1)"""
+    rows = enumerate(csv.DictReader(file), start=2)
+    while chunk := list(islice(rows, batch_size)):
+        yield chunk
+
+
+def parse_chunks(kind, chunks, workers=0):
+    """parse_chunk over `chunks` in order, spread over `workers` processes when asked.
+
+    only a couple of chunks per worker are in flight, so a big file is
+    never read into memory ahead of the writer.
+    """
+    if workers <= 1:
+        for chunk in chunks:
+            yield parse_chunk(kind, chunk)
+        return
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(parse_chunk, kind, chunk))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class Importer:
+    """checks parsed rows against the database and writes them, one chunk at a time.
+
+    with `update=True` rows that already exist (same customer email, same
+    product/order id) are updated in place, otherwise they are rejected.
+    """
+
+    def __init__(self, kind, update=True, batch_size=None):
+        self.kind = kind
+        self.update = update
+        self.batch_size = resolve_batch_size(batch_size)
+        self.imported = 0
+        self.seen = set()  # customer emails / ids already in this file
+        self.days = set()  # days whose sales rollups need rebuilding
+
+    def write(self, parsed):
+        """write one parsed chunk, returns the rows rejected by the database checks"""
+        with transaction.atomic():
+            rejected = getattr(self, f"write_{self.kind}")(parsed)
+        self.imported += len(parsed) - len(rejected)
+        return rejected
+
+    def first_in_file(self, key, line, row, rejected, what):
+        if key is None:
+            return True
+        if key in self.seen:
+            rejected.append((line, row, f"{what} appears more than once in the file"))
+            return False
+        self.seen.add(key)
+        return True
+
+    def write_customers(self, parsed):
+        rejected, accepted = [], []
+        for line, row, values in parsed:
+            if self.first_in_file(values["email"], line, row, rejected, f"email '{values['email']}'"):
+                accepted.append((line, row, values))
+        if not self.update:
+            taken = existing_emails({values["email"] for _, _, values in accepted}, self.batch_size)
+            rejected += [(line, row, f"this email '{values['email']}' is already in use")
+                         for line, row, values in accepted if values["email"] in taken]
+            accepted = [entry for entry in accepted if entry[2]["email"] not in taken]
+        upsert = {"update_conflicts": True, "unique_fields": ["email"], "update_fields": ["name", "phone"]}
+        Customer.objects.bulk_create(
+            [Customer(**values) for _, _, values in accepted],
+            batch_size=self.batch_size,
+            **(upsert if self.update else {}),
+        )
+        return rejected
+
+    def existing_ids(self, model, ids):
+        found = set()
+        for chunk in chunked(list(ids), self.batch_size):
+            found.update(model.objects.filter(id__in=chunk).values_list("id", flat=True))
+        return found
+
+    def split_existing(self, model, parsed, rejected):
+        """drop rows whose id is repeated in the file, or exists already unless updating"""
+        accepted = [
+            (line, row, values) for line, row, values in parsed
+            if self.first_in_file(values["id"], line, row, rejected, f"id {values['id']}")
+        ]
+        if self.update:
+            return accepted
+        taken = self.existing_ids(model, {values["id"] for _, _, values in accepted if values["id"]})
+        rejected += [(line, row, f"id {values['id']} already exists")
+                     for line, row, values in accepted if values["id"] in taken]
+        return [entry for entry in accepted if entry[2]["id"] not in taken]
+
+    def bulk_upsert(self, model, objects, update_fields):
+        """insert rows without an id, insert or update the ones with one"""
+        model.objects.bulk_create([obj for obj in objects if obj.id is None], batch_size=self.batch_size)
+        model.objects.bulk_create(
+            [obj for obj in objects if obj.id is not None], batch_size=self.batch_size,
+            update_conflicts=True, unique_fields=["id"], update_fields=update_fields,
+        )
+
+    def write_products(self, parsed):
+        rejected = []
+        accepted = self.split_existing(Product, parsed, rejected)
+        products = [Product(**values) for _, _, values in accepted]
+        self.bulk_upsert(Product, products, ["name", "price", "stock"])
+        record(ChangeEvent.PRODUCT_STOCK_CHANGED, [product.id for product in products])
+        return rejected
+
+    def write_orders(self, parsed):
+        rejected = []
+        parsed = self.split_existing(Order, parsed, rejected)
+
+        emails = {values["customer_email"] for _, _, values in parsed if values["customer_id"] is None}
+        customer_by_email = dict(Customer.objects.filter(email__in=emails).values_list("email", "id"))
+        customer_ids = self.existing_ids(Customer, {values["customer_id"] for _, _, values in parsed} - {None})
+        prices = dict(
+            Product.objects.filter(id__in={pid for _, _, values in parsed for pid in values["product_ids"]})
+            .values_list("id", "price")
+        )
+
+        accepted = []  # (Order, product ids)
+        for line, row, values in parsed:
+            customer_id = values["customer_id"] or customer_by_email.get(values["customer_email"])
+            if customer_id is None or (values["customer_id"] and customer_id not in customer_ids):
+                rejected.append((line, row, "Customer does not exist"))
+                continue
+            missing = [product_id for product_id in values["product_ids"] if product_id not in prices]
+            if missing:
+                rejected.append((line, row, f"Products {missing} do not exist"))
+                continue
+            total_amount = values["total_amount"]
+            if total_amount is None:
+                total_amount = sum(prices[product_id] for product_id in values["product_ids"])
+            order = Order(
+                id=values["id"],
+                customer_id=customer_id,
+                total_amount=total_amount,
+                order_date=values["order_date"] or timezone.now(),
+            )
+            # a product listed twice counts twice in the total but is one through row, like place_order
+            accepted.append((order, list(dict.fromkeys(values["product_ids"]))))
+
+        # ids given in the file, these orders may exist already
+        given = [order.id for order, _ in accepted if order.id is not None]
+        # customers whose aggregates change: the new owners, and the old owners of updated orders
+        touched = {order.customer_id for order, _ in accepted}
+        existing = set()
+        for ids in chunked(given, self.batch_size):
+            for order_id, customer_id, order_date in (
+                Order.objects.filter(id__in=ids).values_list("id", "customer_id", "order_date")
+            ):
+                existing.add(order_id)
+                touched.add(customer_id)
+                self.days.add(timezone.localdate(order_date))
+        self.days.update(timezone.localdate(order.order_date) for order, _ in accepted)
+        self.bulk_upsert(Order, [order for order, _ in accepted], ["customer", "order_date", "total_amount"])
+        # an updated order gets the product list of the file
+        for ids in chunked(given, self.batch_size):
+            Order.products.through.objects.filter(order_id__in=ids).delete()
+        attach_products(accepted)
+        record(ChangeEvent.ORDER_CREATED, [order.id for order, _ in accepted if order.id not in existing])
+        rebuild_customer_stats(Customer.objects.filter(pk__in=touched))
+        return rejected
+
+    def finish(self):
+        if self.days:
+            # once for the whole file, history imports span years and chunks overlap days
+            with transaction.atomic():
+                rebuild_sales_rollups(min(self.days), max(self.days))
+        # bulk_create sends no signals
+        invalidate({"customers": Customer, "products": Product, "orders": Order}[self.kind])
+
+
+def import_csv(kind, file, batch_size=None, workers=0, update=True, on_rejected=None, on_progress=None):
+    """import the rows of an open CSV `file` into the `kind` table.
+
+    `on_rejected(line, row, reason)` is called for every rejected row,
+    `on_progress(imported, rejected)` after every chunk. returns
+    (imported, rejected) counts.
+    """
+    importer = Importer(kind, update=update, batch_size=batch_size)
+    rejected_count = 0
+    chunks = read_chunks(file, importer.batch_size)
+    for parsed, rejected in parse_chunks(kind, chunks, workers):
+        rejected = rejected + importer.write(parsed)
+        rejected_count += len(rejected)
+        if on_rejected:
+            for line, row, reason in sorted(rejected, key=lambda entry: entry[0]):
+                on_rejected(line, row, reason)
+        if on_progress:
+            on_progress(importer.imported, rejected_count)
+    importer.finish()
+    return importer.imported, rejected_count
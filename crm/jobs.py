@@ -0,0 +1,202 @@
+import logging
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import F, Q
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from crm.bulk import bulk_create_customers, resolve_batch_size
+from crm.models import BulkJob
+from crm.orders import bulk_place_orders
+from crm.response_cache import invalidate
+
+
+logger = logging.getLogger("crm.jobs")
+
+# ==========
+#  background bulk jobs.
+#  bulkCreateCustomers/bulkCreateOrders(background: true) store their rows
+#  in a BulkJob row and return it at once. a small thread pool in the web
+#  process (or `manage.py run_bulk_jobs`) claims queued jobs and works
+#  through them in chunks, each committed together with the job's progress,
+#  pausing between chunks so other writers get the SQLite write lock in
+#  between instead of waiting for the whole import. a worker whose job was
+#  taken over (STALE_AFTER) notices when it saves its progress, undoes the
+#  chunk and leaves the job to the new owner.
+# ==========
+
+DEFAULTS = {
+    # threads per process, 0 leaves the jobs to `manage.py run_bulk_jobs`
+    "WORKERS": 1,
+    # rows per committed transaction
+    "CHUNK_SIZE": 500,
+    # seconds between chunks
+    "PAUSE": 0.01,
+    # a running job without progress for this many seconds is taken over
+    "STALE_AFTER": 300,
+}
+
+
+def job_settings():
+    return {**DEFAULTS, **getattr(settings, "CRM_BULK_JOBS", {})}
+
+
+# what bulk_place_orders reads off the graphene OrderInput
+OrderRow = namedtuple("OrderRow", ["customer_id", "product_ids", "order_date"])
+
+
+def customer_payload(rows):
+    return [{"name": row.name, "email": row.email, "phone": row.phone} for row in rows]
+
+
+def order_payload(rows):
+    return [
+        {
+            "customer_id": row.customer_id,
+            "product_ids": list(row.product_ids or []),
+            "order_date": row.order_date.isoformat() if row.order_date else None,
+        }
+        for row in rows
+    ]
+
+
+def create_customers(rows, batch_size, offset):
+    return bulk_create_customers(rows, batch_size=batch_size, offset=offset)
+
+
+def place_orders(rows, batch_size, offset):
+    rows = [
+        OrderRow(row["customer_id"], row["product_ids"], row["order_date"] and parse_datetime(row["order_date"]))
+        for row in rows
+    ]
+    return bulk_place_orders(rows, batch_size=batch_size, offset=offset)
+
+
+# kind -> (payload from the mutation input, chunk handler returning (created, errors))
+HANDLERS = {
+    "customers": (customer_payload, create_customers),
+    "orders": (order_payload, place_orders),
+}
+
+
+class TakenOver(Exception):
+    """the job's progress moved under this worker, another one claimed it"""
+
+
+def enqueue(kind, rows, batch_size=None):
+    """store a job for `rows` of `kind` and start a worker once it is committed"""
+    if batch_size is not None:
+        # raises ValidationError now, rather than failing the job later
+        resolve_batch_size(batch_size)
+    payload = HANDLERS[kind][0](rows)
+    job = BulkJob.objects.create(kind=kind, payload=payload, total=len(payload), batch_size=batch_size)
+    invalidate(BulkJob)
+    transaction.on_commit(wake)
+    return job
+
+
+def save(job_id, **fields):
+    fields.setdefault("updated_at", timezone.now())
+    BulkJob.objects.filter(pk=job_id).update(**fields)
+    # update() sends no signals, bulkJob polls must not be answered from the response cache
+    invalidate(BulkJob)
+
+
+def claimable():
+    stale = timezone.now() - timedelta(seconds=job_settings()["STALE_AFTER"])
+    return Q(status=BulkJob.QUEUED) | Q(status=BulkJob.RUNNING, updated_at__lt=stale)
+
+
+def claim_next():
+    """mark the oldest claimable job as running and return it, None when there is none.
+
+    the conditional UPDATE makes the claim safe against other threads and processes.
+    """
+    for job_id in BulkJob.objects.filter(claimable()).order_by("id").values_list("id", flat=True)[:10]:
+        now = timezone.now()
+        claimed = BulkJob.objects.filter(claimable(), pk=job_id).update(
+            status=BulkJob.RUNNING, started_at=Coalesce(F("started_at"), now), updated_at=now,
+        )
+        if claimed:
+            return BulkJob.objects.get(pk=job_id)
+    return None
+
+
+def process(job):
+    """work through `job` from where it stopped, one committed chunk at a time"""
+    config = job_settings()
+    errors = list(job.errors)
+    try:
+        handle = HANDLERS[job.kind][1]
+        while job.processed < job.total:
+            start = job.processed
+            chunk = job.payload[start:start + config["CHUNK_SIZE"]]
+            # the rows and the progress that says they are in commit together,
+            # so a job taken over after a crash doesn't insert a chunk twice
+            with transaction.atomic():
+                created, chunk_errors = handle(chunk, job.batch_size, start)
+                # only if the progress is still where this chunk started: a worker that
+                # stalled past STALE_AFTER and woke up again must not redo what the
+                # worker that took over did
+                moved = BulkJob.objects.filter(pk=job.pk, processed=start).update(
+                    processed=start + len(chunk), succeeded=F("succeeded") + len(created),
+                    errors=errors + chunk_errors, updated_at=timezone.now(),
+                )
+                if not moved:
+                    raise TakenOver()
+            invalidate(BulkJob)
+            errors += chunk_errors
+            job.processed = start + len(chunk)
+            if config["PAUSE"]:
+                time.sleep(config["PAUSE"])
+    except TakenOver:
+        # the chunk was rolled back, the job is the other worker's now
+        logger.warning("bulk job %s was taken over by another worker", job.pk)
+        return
+    except Exception as e:
+        logger.exception("bulk job %s failed", job.pk)
+        save(job.pk, status=BulkJob.FAILED, failure=str(e), finished_at=timezone.now())
+        return
+    save(job.pk, status=BulkJob.DONE, payload=None, finished_at=timezone.now())
+
+
+def drain():
+    """process claimable jobs until there are none left, returns how many"""
+    count = 0
+    while (job := claim_next()) is not None:
+        process(job)
+        count += 1
+    return count
+
+
+def work():
+    # runs in a pool thread, which outlives the jobs, so it doesn't keep its connection around
+    try:
+        drain()
+    except Exception:
+        logger.exception("bulk job worker failed")
+    finally:
+        connections.close_all()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def wake():
+    """have the pool look for work, a no-op when this process runs no workers"""
+    global _pool
+    workers = job_settings()["WORKERS"]
+    if not workers:
+        return
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(workers, thread_name_prefix="crm-bulk-job")
+    _pool.submit(work)
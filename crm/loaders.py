@@ -0,0 +1,170 @@
+import asyncio
+from collections import defaultdict
+
+from crm.models import Customer, Order
+
+
+# ==========
+#  per-request DataLoaders.
+#  graphene resolves fields one node at a time, so without these every
+#  order on a page fires its own query for `customer` and `products`.
+#  keys get queued up front (see `prime`) and the first `load` fetches
+#  the whole queue with a single IN (...) query.
+# ==========
+
+class DataLoader:
+    """synchronous batching loader with a per-request cache"""
+
+    def __init__(self, batch_load_fn):
+        # batch_load_fn takes a list of keys and returns a {key: value} dict
+        self.batch_load_fn = batch_load_fn
+        self._cache = {}
+        # dict used as an ordered set
+        self._queue = {}
+
+    def enqueue(self, keys):
+        """queue keys so the next dispatch fetches them in the same batch"""
+        for key in keys:
+            if key not in self._cache:
+                self._queue[key] = None
+
+    def prime(self, key, value):
+        """put an already loaded value in the cache"""
+        self._cache.setdefault(key, value)
+
+    def dispatch(self):
+        if not self._queue:
+            return
+        keys, self._queue = list(self._queue), {}
+        results = self.batch_load_fn(keys)
+        for key in keys:
+            self._cache[key] = results.get(key)
+
+    def load(self, key):
+        if key not in self._cache:
+            self.enqueue([key])
+            self.dispatch()
+        return self._cache[key]
+
+    def load_many(self, keys):
+        self.enqueue(keys)
+        self.dispatch()
+        return [self._cache[key] for key in keys]
+
+
+def load_customers(customer_ids):
+    return Customer.objects.in_bulk(customer_ids)
+
+
+def load_order_products(order_ids):
+    # one query on the through table, joined to the product rows
+    through = Order.products.through
+    products = defaultdict(list)
+    rows = (
+        through.objects.filter(order_id__in=order_ids)
+        .select_related("product")
+        .order_by("order_id", "product_id")
+    )
+    for row in rows:
+        products[row.order_id].append(row.product)
+    return {order_id: products[order_id] for order_id in order_ids}
+
+
+class AsyncDataLoader(DataLoader):
+    """asyncio flavour: every `load` made in the same loop tick goes out in one batch.
+
+    `load` returns a future. keys queued with `enqueue` (e.g. from a root
+    field resolved in a worker thread) ride along with the next batch.
+    """
+
+    def __init__(self, batch_load_fn):
+        # batch_load_fn is a coroutine function: list of keys -> {key: value}
+        super().__init__(batch_load_fn)
+        self._futures = {}
+        self._scheduled = False
+
+    def load(self, key):
+        if key in self._cache:
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(self._cache[key])
+            return future
+        if key not in self._futures:
+            loop = asyncio.get_running_loop()
+            self._futures[key] = loop.create_future()
+            self._queue[key] = None
+            if not self._scheduled:
+                self._scheduled = True
+                loop.call_soon(lambda: asyncio.ensure_future(self.dispatch()))
+        return self._futures[key]
+
+    async def dispatch(self):
+        self._scheduled = False
+        if not self._queue:
+            return
+        keys, self._queue = list(self._queue), {}
+        try:
+            results = await self.batch_load_fn(keys)
+        except Exception as e:
+            for key in keys:
+                future = self._futures.pop(key, None)
+                if future is not None and not future.done():
+                    future.set_exception(e)
+            return
+        for key in keys:
+            self._cache[key] = results.get(key)
+            future = self._futures.pop(key, None)
+            if future is not None and not future.done():
+                future.set_result(self._cache[key])
+
+
+async def aload_customers(customer_ids):
+    return {customer.id: customer async for customer in Customer.objects.filter(id__in=customer_ids).aiterator()}
+
+
+async def aload_order_products(order_ids):
+    through = Order.products.through
+    products = defaultdict(list)
+    rows = (
+        through.objects.filter(order_id__in=order_ids)
+        .select_related("product")
+        .order_by("order_id", "product_id")
+    )
+    async for row in rows.aiterator():
+        products[row.order_id].append(row.product)
+    return {order_id: products[order_id] for order_id in order_ids}
+
+
+class Loaders:
+    """the set of loaders that lives on one GraphQL context"""
+
+    def __init__(self):
+        self.customer = DataLoader(load_customers)
+        self.order_products = DataLoader(load_order_products)
+
+    def prime(self, model, instances):
+        """queue the relations of a freshly resolved page of nodes"""
+        if model is Order and instances:
+            # a column the planner deferred was not selected, touching it would cost a query per row
+            if "customer_id" not in instances[0].get_deferred_fields():
+                self.customer.enqueue(order.customer_id for order in instances)
+            self.order_products.enqueue(order.id for order in instances)
+
+
+class AsyncLoaders(Loaders):
+    """same loaders for the async view, backed by the async ORM"""
+
+    def __init__(self):
+        self.customer = AsyncDataLoader(aload_customers)
+        self.order_products = AsyncDataLoader(aload_order_products)
+
+
+def get_loaders(context):
+    """return the loaders attached to `context`, creating them on first use"""
+    if context is None:
+        # nothing to attach to (e.g. schema.execute without a context), no sharing
+        return Loaders()
+    loaders = getattr(context, "loaders", None)
+    if loaders is None:
+        loaders = Loaders()
+        setattr(context, "loaders", loaders)
+    return loaders
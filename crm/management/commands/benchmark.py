@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from crm import benchmarks
+
+
+class Command(BaseCommand):
+    help = (
+        "seed a scratch database, time every benchmark scenario (p50/p99, SQL queries, peak memory) "
+        "and fail when a scenario regressed against the stored baseline"
+    )
+
+    def add_arguments(self, parser):
+        dataset = benchmarks.DEFAULT_DATASET
+        parser.add_argument("--customers", type=int, default=dataset["customers"])
+        parser.add_argument("--products", type=int, default=dataset["products"])
+        parser.add_argument("--orders", type=int, default=dataset["orders"])
+        parser.add_argument("--lines", type=int, default=dataset["lines"], help="products per order")
+        parser.add_argument("--iterations", type=int, default=50)
+        parser.add_argument("--scenario", help="only run scenarios whose name contains this")
+        parser.add_argument("--baseline", default=benchmarks.BASELINE_PATH)
+        parser.add_argument("--save-baseline", action="store_true", help="write the results as the new baseline")
+        parser.add_argument("--tolerance", type=float, default=benchmarks.TOLERANCE,
+                            help="allowed p99 growth, as a fraction of the baseline")
+
+    def handle(self, *args, **options):
+        dataset = {key: options[key] for key in ("customers", "products", "orders", "lines")}
+        directory = tempfile.mkdtemp()
+        try:
+            # the scenarios write, so they never run against the real database
+            path = os.path.join(directory, "benchmark.sqlite3")
+            with benchmarks.scratch_database(path), override_settings(ALLOWED_HOSTS=["testserver"]):
+                benchmarks.seed(**dataset, progress=self.progress)
+                results = benchmarks.run(options["scenario"], options["iterations"], progress=self.report)
+        except benchmarks.ScenarioFailed as e:
+            raise CommandError(str(e))
+        finally:
+            shutil.rmtree(directory)
+
+        if options["save_baseline"]:
+            benchmarks.save_baseline(results, dataset, options["baseline"])
+            self.stdout.write(f"baseline written to {options['baseline']}")
+            return
+
+        baseline = benchmarks.load_baseline(options["baseline"])
+        if baseline is None:
+            self.stdout.write(f"no baseline at {options['baseline']}, nothing to compare")
+            return
+        # latency and memory only mean something against the same dataset
+        timings = baseline["dataset"] == dataset
+        if not timings:
+            self.stdout.write(f"dataset differs from the baseline ({baseline['dataset']}), comparing query counts only")
+        regressions = benchmarks.compare(results, baseline, options["tolerance"], timings)
+        if regressions:
+            raise CommandError("regressions:\n  " + "\n  ".join(regressions))
+        self.stdout.write(self.style.SUCCESS("no regressions"))
+
+    def progress(self, message):
+        self.stderr.write(f"seeded {message}")
+
+    def report(self, name, result):
+        self.stdout.write(
+            f"{name:<45} p50 {result['p50_ms']:8.2f}ms  p99 {result['p99_ms']:8.2f}ms  "
+            f"{result['queries']:3d} queries  {result['peak_kib']:9.1f}KiB"
+        )
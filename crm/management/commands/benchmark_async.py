@@ -0,0 +1,83 @@
+import asyncio
+import json
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import AsyncClient, Client, override_settings
+
+
+# three independent root fields, the async view resolves them side by side
+QUERY = """
+    {
+        allCustomers(first: 20) { edges { node { name email } } }
+        allProducts(first: 20) { edges { node { name price } } }
+        allOrders(first: 20, keyset: true) {
+            edges { node { totalAmount customer { name } products { edges { node { name } } } } }
+        }
+    }
+"""
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Command(BaseCommand):
+    help = "compare requests/s and latency of the WSGI (/graphql/) and ASGI (/graphql/async/) views"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=500)
+        parser.add_argument("--concurrency", type=int, default=50)
+
+    def handle(self, *args, **options):
+        total, concurrency = options["requests"], options["concurrency"]
+        body = json.dumps({"query": QUERY})
+
+        # reads only, runs against whatever is in the database. the test clients
+        # call themselves `testserver`, which ALLOWED_HOSTS doesn't know about
+        with override_settings(ALLOWED_HOSTS=["testserver"]):
+            wsgi = self.run_wsgi(body, total, concurrency)
+            asgi = asyncio.run(self.run_asgi(body, total, concurrency))
+
+        for label, (elapsed, latencies) in (("WSGI /graphql/", wsgi), ("ASGI /graphql/async/", asgi)):
+            self.stdout.write(
+                f"{label:<22} {total / elapsed:7.0f} req/s   "
+                f"p50 {statistics.median(latencies) * 1000:7.1f}ms   "
+                f"p99 {percentile(latencies, 0.99) * 1000:7.1f}ms"
+            )
+
+    def check_response(self, status, content):
+        if status != 200 or b'"errors"' in content:
+            raise CommandError(content.decode())
+
+    def run_wsgi(self, body, total, concurrency):
+        client = Client()
+
+        def request(_):
+            start = time.perf_counter()
+            response = client.post("/graphql/", body, content_type="application/json")
+            self.check_response(response.status_code, response.content)
+            return time.perf_counter() - start
+
+        # one thread per in-flight request, the way a threaded WSGI server serves them
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            latencies = list(pool.map(request, range(total)))
+        return time.perf_counter() - start, latencies
+
+    async def run_asgi(self, body, total, concurrency):
+        client = AsyncClient()
+        slots = asyncio.Semaphore(concurrency)
+
+        async def request():
+            async with slots:
+                start = time.perf_counter()
+                response = await client.post("/graphql/async/", body, content_type="application/json")
+                self.check_response(response.status_code, response.content)
+                return time.perf_counter() - start
+
+        start = time.perf_counter()
+        latencies = await asyncio.gather(*(request() for _ in range(total)))
+        return time.perf_counter() - start, latencies
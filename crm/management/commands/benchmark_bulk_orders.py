@@ -0,0 +1,63 @@
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from alx_backend_graphql.schema import schema
+from crm.models import Customer, Product
+
+
+CREATE_ORDER = """
+    mutation ($customerId: ID!, $productIds: [ID]!) {
+        createOrder(orderData: {customerId: $customerId, productIds: $productIds}) { message }
+    }
+"""
+
+BULK_CREATE_ORDERS = """
+    mutation ($orders: [OrderInput!]!) {
+        bulkCreateOrders(orderList: $orders) { creationErrors }
+    }
+"""
+
+
+class Command(BaseCommand):
+    help = "compare bulkCreateOrders throughput with N separate createOrder calls (rolled back afterwards)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--orders", type=int, default=1000)
+        parser.add_argument("--lines", type=int, default=3, help="products per order")
+
+    def handle(self, *args, **options):
+        count, lines = options["orders"], options["lines"]
+
+        # everything runs in a transaction that is rolled back, the database is left untouched
+        with transaction.atomic():
+            customer = Customer.objects.create(name="bench", email="bench-orders@example.com")
+            products = Product.objects.bulk_create(
+                Product(name=f"bench {i}", price=Decimal("1.00"), stock=count * lines * 2)
+                for i in range(lines)
+            )
+            payload = [
+                {"customerId": customer.id, "productIds": [product.id for product in products]}
+                for _ in range(count)
+            ]
+
+            start = time.perf_counter()
+            for order in payload:
+                result = schema.execute(CREATE_ORDER, variables=order)
+                if result.errors:
+                    raise result.errors[0]
+            single = time.perf_counter() - start
+
+            start = time.perf_counter()
+            result = schema.execute(BULK_CREATE_ORDERS, variables={"orders": payload})
+            if result.errors:
+                raise result.errors[0]
+            bulk = time.perf_counter() - start
+
+            transaction.set_rollback(True)
+
+        self.stdout.write(f"createOrder x{count}:     {single:.3f}s ({count / single:.0f} orders/s)")
+        self.stdout.write(f"bulkCreateOrders x{count}: {bulk:.3f}s ({count / bulk:.0f} orders/s)")
+        self.stdout.write(f"speedup: {single / bulk:.1f}x")
@@ -0,0 +1,138 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection, connections
+
+from alx_backend_graphql.schema import schema
+from crm.benchmarks import scratch_database
+from crm.models import Customer, Product
+
+
+CREATE_ORDER = """
+    mutation ($customerId: ID!, $productIds: [ID]!) {
+        createOrder(orderData: {customerId: $customerId, productIds: $productIds}) { message }
+    }
+"""
+
+BULK_CREATE_CUSTOMERS = """
+    mutation ($customers: [CustomerInput!]!) {
+        bulkCreateCustomers(customerList: $customers) { message }
+    }
+"""
+
+READ_ORDERS = "{ allOrders(first: 20) { edges { node { totalAmount customer { name } } } } }"
+
+# what the database looked like before the tuning profile
+BASELINE = {"CONN_MAX_AGE": 0, "CONN_HEALTH_CHECKS": False, "OPTIONS": {}}
+
+
+class Command(BaseCommand):
+    help = (
+        "hammer a scratch SQLite database with concurrent createOrder/bulkCreateCustomers writers "
+        "and allOrders readers, once with the stock settings and once with the tuning profile"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--writers", type=int, default=8)
+        parser.add_argument("--readers", type=int, default=4)
+        parser.add_argument("--seconds", type=float, default=5)
+
+    def handle(self, *args, **options):
+        directory = tempfile.mkdtemp()
+        try:
+            profiles = (
+                ("baseline", BASELINE, {"SQLITE_PRAGMAS": {}}),
+                ("tuned", {}, {}),  # whatever settings.py says
+            )
+            for name, database, settings in profiles:
+                path = os.path.join(directory, f"{name}.sqlite3")
+                with scratch_database(path, database, settings):
+                    result = self.run(options)
+                self.report(name, result, options["seconds"])
+        finally:
+            shutil.rmtree(directory)
+
+    def run(self, options):
+        writers, readers = options["writers"], options["readers"]
+        customers = Customer.objects.bulk_create(
+            Customer(name=f"bench {i}", email=f"bench{i}@example.com") for i in range(writers)
+        )
+        products = Product.objects.bulk_create(
+            Product(name=f"bench {i}", price=Decimal("1.00"), stock=10 ** 9) for i in range(5)
+        )
+        product_ids = [product.id for product in products]
+        connections.close_all()
+
+        stop = time.perf_counter() + options["seconds"]
+        lock = threading.Lock()
+        result = {"writes": 0, "reads": 0, "locked": 0, "latencies": []}
+
+        def end_of_request():
+            # what django does when a request finishes
+            connection.close_if_unusable_or_obsolete()
+
+        def record(key, started):
+            with lock:
+                result[key] += 1
+                if key == "writes":
+                    result["latencies"].append(time.perf_counter() - started)
+
+        def execute(query, variables=None):
+            execution = schema.execute(query, variables=variables)
+            for error in execution.errors or []:
+                if "locked" in str(error):
+                    raise OperationalError(str(error))
+                raise error
+
+        def writer(index):
+            sequence = 0
+            while time.perf_counter() < stop:
+                started = time.perf_counter()
+                try:
+                    if sequence % 5:
+                        execute(CREATE_ORDER, {"customerId": customers[index].id, "productIds": product_ids[:3]})
+                    else:
+                        execute(BULK_CREATE_CUSTOMERS, {"customers": [
+                            {"name": "bulk", "email": f"w{index}-{sequence}-{row}@example.com"} for row in range(20)
+                        ]})
+                    record("writes", started)
+                except OperationalError:
+                    with lock:
+                        result["locked"] += 1
+                finally:
+                    end_of_request()
+                sequence += 1
+
+        def reader():
+            while time.perf_counter() < stop:
+                started = time.perf_counter()
+                try:
+                    execute(READ_ORDERS)
+                    record("reads", started)
+                except OperationalError:
+                    with lock:
+                        result["locked"] += 1
+                finally:
+                    end_of_request()
+
+        threads = [threading.Thread(target=writer, args=(index,)) for index in range(writers)]
+        threads += [threading.Thread(target=reader) for _ in range(readers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        connections.close_all()
+        return result
+
+    def report(self, name, result, seconds):
+        latencies = sorted(result["latencies"]) or [0]
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        self.stdout.write(
+            f"{name:<9} {result['writes'] / seconds:7.0f} writes/s  {result['reads'] / seconds:7.0f} reads/s  "
+            f"{result['locked']:5d} lock errors  write p99 {p99 * 1000:7.1f}ms"
+        )
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from crm.warmup import boot_report
+
+FIRST_PARTY = ("crm", "alx_backend_graphql", "schema")
+
+
+class Command(BaseCommand):
+    help = (
+        "boot a worker in a fresh interpreter and report how long django.setup, URL loading, "
+        "the warm up and the first two requests take, with the slowest imports (python -X importtime)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--warm-up", action="store_true", help="run crm.warmup.warm_up() before the first request")
+        parser.add_argument("--query", default="{ hello }", help="what the requests POST to /graphql/")
+        parser.add_argument("--top", type=int, default=15, help="how many of the slowest imports to list")
+
+    def handle(self, *args, **options):
+        try:
+            report = boot_report(options["warm_up"], options["query"])
+        except RuntimeError as e:
+            raise CommandError(f"the worker failed to boot: {e}")
+
+        self.stdout.write("phases (ms):")
+        for phase, ms in report["phases"].items():
+            self.stdout.write(f"  {phase:<16}{ms:>10.1f}")
+        self.stdout.write(f"  {'total':<16}{sum(report['phases'].values()):>10.1f}")
+        if any(status != 200 for status in report["statuses"]):
+            self.stdout.write(self.style.WARNING(f"responses: {report['statuses']}"))
+
+        imports = report["imports"]
+        self.stdout.write(f"\nslowest top-level imports (cumulative ms), {len(imports)} modules imported:")
+        for entry in sorted((i for i in imports if i.depth == 0), key=lambda i: -i.cumulative_us)[:options["top"]]:
+            self.stdout.write(f"  {entry.cumulative_us / 1000:>8.1f}  {entry.module}")
+        self.stdout.write("\nproject modules (cumulative ms):")
+        for entry in sorted(
+            (i for i in imports if i.module.split(".")[0] in FIRST_PARTY), key=lambda i: -i.cumulative_us
+        )[:options["top"]]:
+            self.stdout.write(f"  {entry.cumulative_us / 1000:>8.1f}  {entry.module}")
@@ -0,0 +1,66 @@
+import csv
+import time
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from crm.importer import PARSERS, import_csv
+
+
+class Command(BaseCommand):
+    help = (
+        "import customers, products or orders from a CSV file. "
+        "columns: customers name,email,phone; products [id,]name,price,stock; "
+        "orders [id,]customer_id|customer_email,product_ids,order_date,total_amount "
+        "(product_ids space separated, order_date and total_amount optional). "
+        "imported orders don't take stock, they are history"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("kind", choices=sorted(PARSERS))
+        parser.add_argument("path")
+        parser.add_argument("--batch-size", type=int, default=5000, help="rows per chunk / transaction")
+        parser.add_argument("--workers", type=int, default=0, help="processes parsing chunks in parallel")
+        parser.add_argument("--no-update", action="store_true",
+                            help="reject rows that already exist instead of updating them")
+        parser.add_argument("--rejected", help="where to write rejected rows (default: <path>.rejected.csv)")
+
+    def handle(self, *args, **options):
+        kind, path = options["kind"], options["path"]
+        rejected_path = options["rejected"] or f"{path}.rejected.csv"
+        start = time.perf_counter()
+        rejected_file = rejects = None
+
+        def on_rejected(line, row, reason):
+            nonlocal rejected_file, rejects
+            if rejects is None:
+                # only create the file once something is actually rejected
+                rejected_file = open(rejected_path, "w", newline="")
+                rejects = csv.writer(rejected_file)
+                rejects.writerow(["line", "error", *row])
+            rejects.writerow([line, reason, *row.values()])
+
+        def on_progress(imported, rejected):
+            rate = (imported + rejected) / (time.perf_counter() - start)
+            self.stdout.write(f"{kind}: {imported} imported, {rejected} rejected ({rate:.0f} rows/s)")
+
+        try:
+            with open(path, newline="") as file:
+                imported, rejected = import_csv(
+                    kind, file,
+                    batch_size=options["batch_size"],
+                    workers=options["workers"],
+                    update=not options["no_update"],
+                    on_rejected=on_rejected,
+                    on_progress=on_progress,
+                )
+        except ValidationError as e:
+            raise CommandError(e.messages[0])
+        finally:
+            if rejected_file is not None:
+                rejected_file.close()
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(f"{imported} {kind} imported in {elapsed:.1f}s"))
+        if rejected:
+            self.stdout.write(self.style.WARNING(f"{rejected} rows rejected, see {rejected_path}"))
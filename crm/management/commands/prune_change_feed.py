@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from crm.feed import prune
+
+
+class Command(BaseCommand):
+    help = (
+        "drop change feed events older than CRM_CHANGE_FEED['RETENTION_DAYS']. "
+        "clients holding an older cursor get `reset: true` from changesSince and reload"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=float, help="override the retention")
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"deleted {prune(options['days'])} event(s)")
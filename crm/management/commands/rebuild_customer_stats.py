@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+
+from crm.models import Customer
+from crm.stats import rebuild_customer_stats
+
+
+class Command(BaseCommand):
+    help = "recompute order_count, lifetime_total and last_order_date of every customer from the orders table"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=10000, help="customers per UPDATE / transaction")
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        last_id = Customer.objects.aggregate(last=Max("id"))["last"] or 0
+        start = time.perf_counter()
+        updated = 0
+        # id ranges rather than one giant UPDATE, so the write lock is released between batches
+        for low in range(0, last_id + 1, batch_size):
+            with transaction.atomic():
+                updated += rebuild_customer_stats(Customer.objects.filter(id__gte=low, id__lt=low + batch_size))
+            self.stdout.write(f"{updated} customers updated")
+        self.stdout.write(self.style.SUCCESS(f"rebuilt stats of {updated} customers in {time.perf_counter() - start:.1f}s"))
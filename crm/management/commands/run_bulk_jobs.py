@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from crm.jobs import drain
+
+
+class Command(BaseCommand):
+    help = (
+        "work off queued background bulk jobs, and jobs whose worker stopped making progress. "
+        "needed when CRM_BULK_JOBS['WORKERS'] is 0, and to pick up jobs left behind by a restart"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--loop", action="store_true", help="keep polling for new jobs")
+        parser.add_argument("--interval", type=float, default=2, help="seconds between polls with --loop")
+
+    def handle(self, *args, **options):
+        while True:
+            count = drain()
+            if count:
+                self.stdout.write(f"processed {count} job(s)")
+            if not options["loop"]:
+                return
+            time.sleep(options["interval"])
@@ -0,0 +1,46 @@
+import sqlite3
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from crm.routing import replica_settings
+
+
+class Command(BaseCommand):
+    help = (
+        "copy the primary SQLite database over the replica stand-ins, with SQLite's online backup. "
+        "for trying DATABASE_READ_REPLICAS locally, real replicas are kept up to date by the database"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("aliases", nargs="*", help="defaults to DATABASE_READ_REPLICAS['ALIASES']")
+        parser.add_argument("--loop", action="store_true", help="keep copying, like a lagging replica")
+        parser.add_argument("--interval", type=float, default=1, help="seconds between copies with --loop")
+
+    def handle(self, *args, **options):
+        aliases = options["aliases"] or list(replica_settings()["ALIASES"])
+        if not aliases:
+            raise CommandError("no replicas configured, name the aliases to copy to")
+        for alias in aliases:
+            if alias not in connections or connections[alias].vendor != "sqlite" or alias == "default":
+                raise CommandError(f"{alias} is not a SQLite replica alias")
+        while True:
+            for alias in aliases:
+                self.copy(alias)
+            if not options["loop"]:
+                return
+            time.sleep(options["interval"])
+
+    def copy(self, alias):
+        primary = connections["default"]
+        primary.ensure_connection()
+        # uri for the test runner's shared in-memory databases, plain paths work the same
+        target = sqlite3.connect(str(connections[alias].settings_dict["NAME"]), uri=True)
+        try:
+            primary.connection.backup(target)
+        finally:
+            target.close()
+        # the next query on the replica opens a connection that sees the new file
+        connections[alias].close()
+        self.stdout.write(f"copied default to {alias}")
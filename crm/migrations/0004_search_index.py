@@ -0,0 +1,84 @@
+from django.db import migrations
+
+
+# FTS5 mirrors of the searchable columns, see crm/search.py.
+# external content tables: the text lives in crm_customer/crm_product,
+# the triggers only maintain the trigram index.
+FTS_TABLES = {
+    "crm_customer": ("crm_customer_fts", ("name", "email")),
+    "crm_product": ("crm_product_fts", ("name",)),
+}
+
+
+def sqlite_forwards(table, fts_table, columns):
+    cols = ", ".join(columns)
+    new = ", ".join(f"new.{column}" for column in columns)
+    old = ", ".join(f"old.{column}" for column in columns)
+    return [
+        f"CREATE VIRTUAL TABLE {fts_table} USING fts5({cols}, content='{table}', content_rowid='id', tokenize='trigram')",
+        f"CREATE TRIGGER {fts_table}_ai AFTER INSERT ON {table} BEGIN "
+        f"INSERT INTO {fts_table}(rowid, {cols}) VALUES (new.id, {new}); END",
+        f"CREATE TRIGGER {fts_table}_ad AFTER DELETE ON {table} BEGIN "
+        f"INSERT INTO {fts_table}({fts_table}, rowid, {cols}) VALUES ('delete', old.id, {old}); END",
+        f"CREATE TRIGGER {fts_table}_au AFTER UPDATE OF {cols} ON {table} BEGIN "
+        f"INSERT INTO {fts_table}({fts_table}, rowid, {cols}) VALUES ('delete', old.id, {old}); "
+        f"INSERT INTO {fts_table}(rowid, {cols}) VALUES (new.id, {new}); END",
+        # index whatever is already in the table
+        f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')",
+    ]
+
+
+def sqlite_backwards(table, fts_table, columns):
+    return [
+        f"DROP TRIGGER IF EXISTS {fts_table}_ai",
+        f"DROP TRIGGER IF EXISTS {fts_table}_ad",
+        f"DROP TRIGGER IF EXISTS {fts_table}_au",
+        f"DROP TABLE IF EXISTS {fts_table}",
+    ]
+
+
+def postgresql_forwards(table, fts_table, columns):
+    # hook for other backends: trigram GIN indexes serve icontains directly
+    return ["CREATE EXTENSION IF NOT EXISTS pg_trgm"] + [
+        f"CREATE INDEX IF NOT EXISTS {table}_{column}_trgm ON {table} USING gin (UPPER({column}) gin_trgm_ops)"
+        for column in columns
+    ]
+
+
+def postgresql_backwards(table, fts_table, columns):
+    return [f"DROP INDEX IF EXISTS {table}_{column}_trgm" for column in columns]
+
+
+STATEMENTS = {
+    "sqlite": (sqlite_forwards, sqlite_backwards),
+    "postgresql": (postgresql_forwards, postgresql_backwards),
+}
+
+
+def execute_for_vendor(schema_editor, direction):
+    builders = STATEMENTS.get(schema_editor.connection.vendor)
+    if builders is None:
+        # no search index on this backend, crm.search falls back to icontains
+        return
+    for table, (fts_table, columns) in FTS_TABLES.items():
+        for statement in builders[direction](table, fts_table, columns):
+            schema_editor.execute(statement)
+
+
+def create_search_index(apps, schema_editor):
+    execute_for_vendor(schema_editor, 0)
+
+
+def drop_search_index(apps, schema_editor):
+    execute_for_vendor(schema_editor, 1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0003_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
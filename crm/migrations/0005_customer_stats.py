@@ -0,0 +1,78 @@
+# Generated by Django 5.2.3 on 2026-10-18 01:50
+
+from decimal import Decimal
+from importlib import import_module
+
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+search_index = import_module("crm.migrations.0004_search_index")
+
+
+def restore_search_triggers(apps, schema_editor):
+    # adding columns makes SQLite rebuild crm_customer, which drops the FTS triggers of 0004
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    fts_table, columns = search_index.FTS_TABLES["crm_customer"]
+    statements = search_index.sqlite_forwards("crm_customer", fts_table, columns)
+    for statement in statements:
+        if statement.startswith("CREATE TRIGGER"):
+            schema_editor.execute(statement.replace("CREATE TRIGGER", "CREATE TRIGGER IF NOT EXISTS", 1))
+
+
+def backfill_customer_stats(apps, schema_editor):
+    Customer = apps.get_model("crm", "Customer")
+    Order = apps.get_model("crm", "Order")
+    orders = Order.objects.filter(customer=OuterRef("pk")).order_by().values("customer")
+    Customer.objects.update(
+        order_count=Coalesce(Subquery(orders.annotate(value=Count("pk")).values("value")), 0),
+        lifetime_total=Coalesce(
+            Subquery(orders.annotate(value=Sum("total_amount")).values("value")),
+            Decimal("0"),
+            output_field=models.DecimalField(max_digits=14, decimal_places=2),
+        ),
+        last_order_date=Subquery(orders.annotate(value=Max("order_date")).values("value")),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0004_search_index'),
+    ]
+
+    operations = [
+        # going back, removing the columns rebuilds the table again
+        migrations.RunPython(migrations.RunPython.noop, restore_search_triggers),
+        migrations.AddField(
+            model_name='customer',
+            name='last_order_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='customer',
+            name='lifetime_total',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name='customer',
+            name='order_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='customer',
+            index=models.Index(fields=['lifetime_total', 'id'], name='crm_customer_spend_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='customer',
+            index=models.Index(fields=['order_count', 'id'], name='crm_customer_order_count_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='customer',
+            index=models.Index(fields=['last_order_date'], name='crm_customer_last_order_idx'),
+        ),
+        migrations.RunPython(restore_search_triggers, migrations.RunPython.noop),
+        migrations.RunPython(backfill_customer_stats, migrations.RunPython.noop),
+    ]
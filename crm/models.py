@@ -7,6 +7,20 @@ class Customer(models.Model):
     email = models.EmailField(unique=True)
     phone = models.CharField(max_length=15, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # order aggregates, kept up to date by crm/stats.py (rebuild with `manage.py rebuild_customer_stats`)
+    order_count = models.PositiveIntegerField(default=0)
+    lifetime_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    last_order_date = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # created_at range filters and the (created_at, id) keyset
+            models.Index(fields=["created_at", "id"], name="crm_customer_created_idx"),
+            # top customers by spend / by orders, and recency filters
+            models.Index(fields=["lifetime_total", "id"], name="crm_customer_spend_idx"),
+            models.Index(fields=["order_count", "id"], name="crm_customer_order_count_idx"),
+            models.Index(fields=["last_order_date"], name="crm_customer_last_order_idx"),
+        ]
 
     def __str__(self):
         return self.name
@@ -17,6 +31,13 @@ class Product(models.Model):
     price = models.DecimalField(max_digits=10, decimal_places=2)
     stock = models.IntegerField(default=0)
 
+    class Meta:
+        indexes = [
+            # price / stock range filters in ProductFilter
+            models.Index(fields=["price"], name="crm_product_price_idx"),
+            models.Index(fields=["stock"], name="crm_product_stock_idx"),
+        ]
+
     def __str__(self):
         return self.name
 
@@ -27,5 +48,106 @@ class Order(models.Model):
     order_date = models.DateTimeField(default=timezone.now)
     total_amount = models.DecimalField(max_digits=10, decimal_places=2)
 
+    class Meta:
+        indexes = [
+            # order_date range filters and the (order_date, id) keyset
+            models.Index(fields=["order_date", "id"], name="crm_order_date_idx"),
+            models.Index(fields=["total_amount"], name="crm_order_total_idx"),
+            # a customer's orders by date, the customer_id FK index alone can't order them
+            models.Index(fields=["customer", "order_date"], name="crm_order_customer_date_idx"),
+        ]
+
     def __str__(self):
-        return self.name
+        return f"Order {self.pk}"
+
+
+# ==========
+#  sales rollups, pre-aggregated per day for salesSummary (crm/stats.py).
+#  kept up to date by order placement, rebuilt with `manage.py rebuild_sales_rollups`.
+# ==========
+
+class DailySales(models.Model):
+    day = models.DateField(unique=True)
+    order_count = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    def __str__(self):
+        return f"{self.day}: {self.revenue}"
+
+
+class DailyProductSales(models.Model):
+    day = models.DateField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    order_count = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            # one row per product and day, also the index salesSummary(productId) reads
+            models.UniqueConstraint(fields=["product", "day"], name="crm_daily_product_sales_unique"),
+        ]
+
+    def __str__(self):
+        return f"{self.day} {self.product_id}: {self.revenue}"
+
+
+# ==========
+#  background bulk jobs, a queue in the database worked off by crm/jobs.py.
+# ==========
+
+class BulkJob(models.Model):
+    QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+    STATUSES = [(QUEUED, "queued"), (RUNNING, "running"), (DONE, "done"), (FAILED, "failed")]
+
+    kind = models.CharField(max_length=20)  # one of crm.jobs.HANDLERS
+    status = models.CharField(max_length=10, choices=STATUSES, default=QUEUED)
+    # the input rows, dropped once the job is done
+    payload = models.JSONField(null=True)
+    batch_size = models.PositiveIntegerField(null=True)
+    total = models.PositiveIntegerField(default=0)
+    processed = models.PositiveIntegerField(default=0)
+    succeeded = models.PositiveIntegerField(default=0)
+    # per-row messages, same format as the creationErrors of the mutations
+    errors = models.JSONField(default=list)
+    failure = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    # bumped after every chunk, a running job that stops moving is picked up again
+    updated_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # workers look for the oldest queued (or stalled) job
+            models.Index(fields=["status", "id"], name="crm_bulkjob_status_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} job {self.pk}: {self.status}"
+
+
+# ==========
+#  change feed, one row per order created / product stock change (crm/feed.py).
+#  the id is the cursor of changesSince, and what the subscriptions poll with
+#  the "database" broker. pruned with `manage.py prune_change_feed`.
+# ==========
+
+class ChangeEvent(models.Model):
+    ORDER_CREATED, PRODUCT_STOCK_CHANGED = "order_created", "product_stock_changed"
+    TOPICS = [(ORDER_CREATED, "order created"), (PRODUCT_STOCK_CHANGED, "product stock changed")]
+
+    topic = models.CharField(max_length=30, choices=TOPICS)
+    # an Order or Product id depending on the topic, no FK so the log outlives deletes
+    object_id = models.BigIntegerField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # pruning by age
+            models.Index(fields=["created_at"], name="crm_changeevent_created_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.pk} {self.topic} {self.object_id}"
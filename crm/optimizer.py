@@ -0,0 +1,117 @@
+from django.db.models import ForeignKey, ManyToManyField, Prefetch
+from graphene.utils.str_converters import to_snake_case
+from graphql.language import FieldNode, FragmentSpreadNode, InlineFragmentNode
+
+
+# ==========
+#  selection-set aware query planner.
+#  looks at what the client actually asked for and shapes the queryset
+#  before the connection field filters and paginates it:
+#   - scalar fields         -> .only(...)
+#   - foreign keys          -> select_related(...) (+ the related columns in .only)
+#   - many to many fields   -> prefetch_related(Prefetch(..., queryset=... .only(...)))
+# ==========
+
+# connection wrapper fields that carry no columns of their own
+CONNECTION_FIELDS = {"pageInfo", "totalCount", "cursor", "__typename"}
+
+
+def iter_fields(selection_set, fragments):
+    """yield the FieldNodes of a selection set, flattening fragments"""
+    if selection_set is None:
+        return
+    for selection in selection_set.selections:
+        if isinstance(selection, FieldNode):
+            yield selection
+        elif isinstance(selection, InlineFragmentNode):
+            yield from iter_fields(selection.selection_set, fragments)
+        elif isinstance(selection, FragmentSpreadNode):
+            fragment = fragments.get(selection.name.value)
+            if fragment is not None:
+                yield from iter_fields(fragment.selection_set, fragments)
+
+
+def node_fields(field_node, fragments):
+    """fields selected on the nodes of a connection (`edges { node { ... } }`)"""
+    for field in iter_fields(field_node.selection_set, fragments):
+        if field.name.value != "edges":
+            continue
+        for edge_field in iter_fields(field.selection_set, fragments):
+            if edge_field.name.value == "node":
+                yield from iter_fields(edge_field.selection_set, fragments)
+
+
+def get_model_field(model, name):
+    try:
+        return model._meta.get_field(to_snake_case(name))
+    except Exception:
+        return None
+
+
+class QueryPlan:
+    def __init__(self):
+        self.only = []
+        self.select_related = []
+        self.prefetch_related = []
+
+    def apply(self, queryset):
+        if self.select_related:
+            queryset = queryset.select_related(*self.select_related)
+        if self.prefetch_related:
+            queryset = queryset.prefetch_related(*self.prefetch_related)
+        if self.only:
+            queryset = queryset.only(*self.only)
+        return queryset
+
+
+def build_plan(model, fields, fragments, plan=None, prefix=""):
+    """walk the selected graphql fields and record what `model` needs to load"""
+    plan = plan or QueryPlan()
+    plan.only.append(prefix + model._meta.pk.name)
+
+    for field_node in fields:
+        name = field_node.name.value
+        if name in CONNECTION_FIELDS:
+            continue
+        model_field = get_model_field(model, name)
+        if model_field is None or model_field.primary_key:
+            continue
+
+        if isinstance(model_field, ForeignKey):
+            path = prefix + model_field.name
+            plan.select_related.append(path)
+            plan.only.append(prefix + model_field.attname)
+            build_plan(
+                model_field.related_model,
+                iter_fields(field_node.selection_set, fragments),
+                fragments, plan, prefix=path + "__",
+            )
+        elif isinstance(model_field, ManyToManyField):
+            related = model_field.related_model
+            nested = build_plan(related, node_fields(field_node, fragments), fragments)
+            plan.prefetch_related.append(
+                Prefetch(prefix + model_field.name, queryset=nested.apply(related._default_manager.all()))
+            )
+        elif model_field.concrete:
+            plan.only.append(prefix + model_field.attname)
+    return plan
+
+
+def optimize(queryset, info):
+    """apply select_related/prefetch_related/only to a root connection queryset"""
+    fields = []
+    for field_node in info.field_nodes:
+        fields.extend(node_fields(field_node, info.fragments))
+    if not fields:
+        return queryset
+    return build_plan(queryset.model, fields, info.fragments).apply(queryset)
+
+
+def optimize_nodes(queryset, info):
+    """same for a field that returns the nodes themselves instead of a connection"""
+    fields = []
+    for field_node in info.field_nodes:
+        fields.extend(iter_fields(field_node.selection_set, info.fragments))
+    if not fields:
+        return queryset
+    return build_plan(queryset.model, fields, info.fragments).apply(queryset)
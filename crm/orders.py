@@ -0,0 +1,176 @@
+from collections import Counter
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Case, F, Q, When
+from django.utils import timezone
+
+from crm.bulk import chunked, resolve_batch_size
+from crm.feed import record
+from crm.models import ChangeEvent, Customer, Order, Product
+from crm.response_cache import invalidate
+from crm.stats import record_orders, record_sales
+
+
+# ==========
+#  order placement.
+#  a constant number of queries no matter how many lines the basket has:
+#  one customer check, one locked product fetch, one guarded stock UPDATE,
+#  one order INSERT, one bulk INSERT on the through table, the updates of
+#  the customer aggregates and sales rollups (crm/stats.py), and one change
+#  feed INSERT each for the stock change and the new order (crm/feed.py).
+# ==========
+
+def count_lines(product_ids):
+    """{product_id: quantity}, a product listed twice is ordered twice"""
+    return Counter(int(product_id) for product_id in product_ids)
+
+
+def decrement_stock(quantities):
+    """take `quantities` out of stock in one UPDATE.
+
+    the WHERE clause only matches rows that still have enough stock, so if
+    fewer rows than expected were updated someone else got there first.
+    """
+    enough_stock = Q()
+    for product_id, quantity in quantities.items():
+        enough_stock |= Q(id=product_id, stock__gte=quantity)
+    updated = Product.objects.filter(enough_stock).update(
+        stock=Case(
+            *(When(id=product_id, then=F("stock") - quantity) for product_id, quantity in quantities.items()),
+            default=F("stock"),
+        )
+    )
+    if updated != len(quantities):
+        raise ValidationError("Insufficient stock for one or more products")
+    # update() sends no post_save
+    invalidate(Product)
+    record(ChangeEvent.PRODUCT_STOCK_CHANGED, quantities)
+
+
+def attach_products(orders_with_products):
+    """insert the through table rows for several orders with one bulk_create"""
+    through = Order.products.through
+    through.objects.bulk_create(
+        through(order_id=order.id, product_id=product_id)
+        for order, product_ids in orders_with_products
+        for product_id in product_ids
+    )
+    # neither does bulk_create, nor m2m_changed for through rows
+    invalidate(Order)
+
+
+def place_order(customer_id, product_ids, order_date=None):
+    try:
+        # IDs come in as strings, the loaders key customers by int
+        customer_id = int(customer_id)
+    except (TypeError, ValueError):
+        raise ValidationError("Customer does not exist")
+    if not product_ids:
+        raise ValidationError("Order must have at least one product")
+    try:
+        quantities = count_lines(product_ids)
+    except (TypeError, ValueError):
+        raise ValidationError("Invalid products in order")
+
+    with transaction.atomic():
+        if not Customer.objects.filter(id=customer_id).exists():
+            raise ValidationError("Customer does not exist")
+
+        # lock the rows so concurrent orders for the same products queue up
+        products = Product.objects.select_for_update().only("id", "price", "stock").in_bulk(quantities)
+        missing = [
+            f"Item {index + 1}, {product_id}: Product does not exist"
+            for index, product_id in enumerate(product_ids)
+            if int(product_id) not in products
+        ]
+        if missing:
+            raise ValidationError(missing)
+
+        total_amount = 0
+        for product_id, quantity in quantities.items():
+            product = products[product_id]
+            if product.stock < quantity:
+                raise ValidationError(f"Product {product_id}: only {product.stock} left in stock")
+            total_amount += product.price * quantity
+
+        decrement_stock(quantities)
+        order = Order.objects.create(
+            customer_id=customer_id,
+            total_amount=total_amount,
+            order_date=order_date or timezone.now(),
+        )
+        attach_products([(order, quantities)])
+        record_orders([order])
+        record_sales([(order, quantities)], {product_id: product.price for product_id, product in products.items()})
+    return order
+
+
+def bulk_place_orders(rows, batch_size=None, offset=0):
+    """place many orders at once.
+
+    every referenced customer and product is fetched up front (two queries),
+    rows are checked in memory, stock is taken out with one guarded UPDATE
+    and orders/through rows are inserted in chunks. returns
+    (created_orders, errors), errors keep the 1-based position of the row
+    in the original input, of which `rows` starts at `offset`.
+    """
+    batch_size = resolve_batch_size(batch_size)
+    errors = []
+    accepted = []  # (Order, quantities) pairs
+
+    parsed = []
+    for index, row in enumerate(rows):
+        try:
+            quantities = count_lines(row.product_ids or [])
+            customer_id = int(row.customer_id)
+        except (TypeError, ValueError):
+            errors.append((index, "Invalid customer or products in order"))
+            continue
+        if not quantities:
+            errors.append((index, "Order must have at least one product"))
+            continue
+        parsed.append((index, customer_id, quantities, row.order_date))
+
+    with transaction.atomic():
+        customer_ids = set(
+            Customer.objects.filter(id__in={customer_id for _, customer_id, _, _ in parsed})
+            .values_list("id", flat=True)
+        )
+        all_product_ids = set().union(*(quantities for _, _, quantities, _ in parsed))
+        products = Product.objects.select_for_update().only("id", "price", "stock").in_bulk(all_product_ids)
+
+        # stock left after the rows accepted so far
+        remaining = {product_id: product.stock for product_id, product in products.items()}
+        taken = Counter()
+        for index, customer_id, quantities, order_date in parsed:
+            if customer_id not in customer_ids:
+                errors.append((index, "Customer does not exist"))
+                continue
+            missing = [product_id for product_id in quantities if product_id not in products]
+            if missing:
+                errors.append((index, f"Products {missing} do not exist"))
+                continue
+            short = [product_id for product_id, quantity in quantities.items() if remaining[product_id] < quantity]
+            if short:
+                errors.append((index, f"Insufficient stock for products {short}"))
+                continue
+            for product_id, quantity in quantities.items():
+                remaining[product_id] -= quantity
+            taken.update(quantities)
+            total_amount = sum(products[product_id].price * quantity for product_id, quantity in quantities.items())
+            order = Order(customer_id=customer_id, total_amount=total_amount, order_date=order_date or timezone.now())
+            accepted.append((order, quantities))
+
+        # one guarded UPDATE per chunk of products keeps the CASE under the parameter limit
+        for product_ids in chunked(list(taken), batch_size):
+            decrement_stock({product_id: taken[product_id] for product_id in product_ids})
+        for chunk in chunked(accepted, batch_size):
+            Order.objects.bulk_create([order for order, _ in chunk])
+            attach_products(chunk)
+        created = [order for order, _ in accepted]
+        record(ChangeEvent.ORDER_CREATED, [order.id for order in created])
+        record_orders(created, batch_size)
+        record_sales(accepted, {product_id: product.price for product_id, product in products.items()}, batch_size)
+
+    return created, [f"Order {offset + index + 1}: {message}" for index, message in sorted(errors)]
@@ -0,0 +1,247 @@
+import hashlib
+import json
+import threading
+import time
+from collections import Counter
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from graphql import TypeInfo, TypeInfoVisitor, Visitor, get_named_type, print_ast, visit
+
+from .caching import LRUCache
+from .fields import PAGINATION_ARGS
+
+
+# ==========
+#  response cache for read queries.
+#  a cached result remembers which models the query read (found by walking
+#  the document: every selected type backed by a DjangoObjectType, or a
+#  connection of one) and the version of each model at the time. saving or
+#  deleting a row bumps the version of its model, so only the entries that
+#  read that model stop matching; the rest keep being served. writes that
+#  skip signals (bulk_create, queryset.update) call `invalidate` themselves.
+# ==========
+
+DEFAULTS = {
+    # off unless switched on, anything writing through raw SQL would serve stale data
+    "ENABLED": False,
+    # "local" keeps entries in this process (LRU), "django" uses the cache framework
+    "BACKEND": "local",
+    "MAXSIZE": 1000,
+    # for the "django" backend
+    "CACHE_ALIAS": "default",
+    "TIMEOUT": 300,
+}
+
+
+def response_cache_settings():
+    return {**DEFAULTS, **getattr(settings, "GRAPHQL_RESPONSE_CACHE", {})}
+
+
+class LocalMemoryBackend:
+    """entries in an LRU, versions in a dict, both local to the process"""
+
+    def __init__(self, maxsize=1000, **_):
+        self.entries = LRUCache(maxsize)
+        self.versions = Counter()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, value):
+        self.entries.set(key, value)
+
+    def get_versions(self, labels):
+        return tuple(self.versions[label] for label in labels)
+
+    def bump(self, labels):
+        with self._lock:
+            for label in labels:
+                self.versions[label] += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.versions.clear()
+
+
+class DjangoCacheBackend:
+    """entries and versions in a Django cache, shared by every process using it"""
+
+    prefix = "crm:graphql:"
+
+    def __init__(self, alias="default", timeout=300, **_):
+        self.cache = caches[alias]
+        self.timeout = timeout
+
+    def get(self, key):
+        return self.cache.get(self.prefix + key)
+
+    def set(self, key, value):
+        self.cache.set(self.prefix + key, value, self.timeout)
+
+    def version_key(self, label):
+        return f"{self.prefix}version:{label}"
+
+    def get_versions(self, labels):
+        found = self.cache.get_many([self.version_key(label) for label in labels])
+        return tuple(found.get(self.version_key(label)) for label in labels)
+
+    def bump(self, labels):
+        for label in labels:
+            key = self.version_key(label)
+            # a version that got evicted restarts from the clock, never from an old value
+            self.cache.add(key, time.time_ns(), None)
+            try:
+                self.cache.incr(key)
+            except ValueError:
+                self.cache.set(key, time.time_ns(), None)
+
+    def clear(self):
+        # the cache may be shared with other things, orphan our entries instead of flushing it
+        self.bump([model._meta.label_lower for model in apps.get_models()])
+
+
+BACKENDS = {"local": LocalMemoryBackend, "django": DjangoCacheBackend}
+
+
+def selected_models(schema, document):
+    """labels of the models a document reads, sorted"""
+    labels = set()
+    type_info = TypeInfo(schema)
+
+    class ModelCollector(Visitor):
+        def enter_field(self, node, *_):
+            graphql_type = get_named_type(type_info.get_type())
+            graphene_type = getattr(graphql_type, "graphene_type", None)
+            meta = getattr(graphene_type, "_meta", None)
+            # connections name their node type, object types their model
+            node_type = getattr(meta, "node", None)
+            model = getattr(getattr(node_type, "_meta", meta), "model", None)
+            # plain object types computed from tables say which ones
+            labels.update(model._meta.label_lower for model in getattr(graphene_type, "cache_models", ()))
+            if model is None:
+                return
+            labels.add(model._meta.label_lower)
+            if any(argument.name.value not in PAGINATION_ARGS for argument in node.arguments):
+                # filters can look across relations (orders by customer or product name)
+                labels.update(
+                    field.related_model._meta.label_lower
+                    for field in model._meta.get_fields()
+                    if field.is_relation and field.concrete
+                )
+
+    visit(document, TypeInfoVisitor(type_info, ModelCollector()))
+    return tuple(sorted(labels))
+
+
+class ResponseCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        # document key -> (normalized query hash, model labels)
+        self.documents = LRUCache(getattr(settings, "GRAPHQL_DOCUMENT_CACHE_SIZE", 1000))
+
+    def describe(self, document_key, schema, document):
+        entry = self.documents.get(document_key)
+        if entry is None:
+            # print_ast drops whitespace, comments and formatting differences
+            normalized = hashlib.sha256(print_ast(document).encode("utf-8")).hexdigest()
+            entry = (normalized, selected_models(schema, document))
+            self.documents.set(document_key, entry)
+        return entry
+
+    def make_key(self, document_key, schema, document, operation_name, variables):
+        """(cache key, model labels) of an operation"""
+        normalized, labels = self.describe(document_key, schema, document)
+        # the filterset and pagination arguments are part of the query text or the variables
+        payload = json.dumps([normalized, operation_name, variables or {}], sort_keys=True, cls=DjangoJSONEncoder)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest(), labels
+
+    def get(self, key, labels):
+        """(cached data or None, current versions of `labels`)
+
+        on a miss, hand the versions back to `set`: they are read before the
+        query runs, so a write that lands during execution still invalidates it.
+        """
+        versions = self.backend.get_versions(labels)
+        entry = self.backend.get(key)
+        if entry is not None and entry[0] == versions:
+            self.hits += 1
+            return entry[1], versions
+        self.misses += 1
+        return None, versions
+
+    def set(self, key, versions, data):
+        self.backend.set(key, (versions, data))
+
+    def invalidate(self, labels):
+        self.backend.bump(labels)
+
+    def clear(self):
+        self.backend.clear()
+        self.hits = self.misses = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
+
+
+_cache = None
+_cache_config = None
+
+
+def get_response_cache():
+    """the ResponseCache for the current settings, None when it's switched off"""
+    global _cache, _cache_config
+    config = response_cache_settings()
+    if not config["ENABLED"]:
+        return None
+    key = json.dumps(config, sort_keys=True)
+    if key != _cache_config:
+        backend = BACKENDS[config["BACKEND"]](
+            maxsize=config["MAXSIZE"], alias=config["CACHE_ALIAS"], timeout=config["TIMEOUT"]
+        )
+        _cache, _cache_config = ResponseCache(backend), key
+    return _cache
+
+
+def invalidate(*models):
+    """forget cached results that read any of `models`"""
+    cache = get_response_cache()
+    if cache is None:
+        return
+    labels = [model._meta.label_lower for model in models]
+    cache.invalidate(labels)
+    # and again once the transaction commits, a read that raced the write may have cached the old rows
+    transaction.on_commit(lambda: cache.invalidate(labels))
+
+
+def model_changed(sender, **kwargs):
+    invalidate(sender)
+
+
+def order_products_changed(sender, action, **kwargs):
+    if action.startswith("post_"):
+        # only orders expose their products, the product rows themselves are unchanged
+        from .models import Order
+        invalidate(Order)
+
+
+def connect_signals():
+    from .models import Customer, Order, Product
+
+    for model in (Customer, Product, Order):
+        post_save.connect(model_changed, sender=model, dispatch_uid=f"response_cache_save_{model.__name__}")
+        post_delete.connect(model_changed, sender=model, dispatch_uid=f"response_cache_delete_{model.__name__}")
+    m2m_changed.connect(order_products_changed, sender=Order.products.through,
+                        dispatch_uid="response_cache_order_products")
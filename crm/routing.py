@@ -0,0 +1,122 @@
+import contextvars
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from graphql import OperationType
+
+
+# ==========
+#  read replicas.
+#  the GraphQL views run every query operation inside `reading_from(alias)`
+#  with the next replica from DATABASE_READ_REPLICAS (smooth weighted
+#  round robin), and ReplicaRouter sends the ORM reads made meanwhile
+#  there. everything else (mutations, the reads inside them, management
+#  commands, bulk jobs) stays on `default`. a client that just wrote gets a
+#  cookie that keeps its queries on the primary for PIN_SECONDS, so it
+#  reads its own writes while the replicas catch up.
+#
+#  locally, replica1/replica2.sqlite3 stand in for replicas and
+#  `manage.py sync_replicas` copies db.sqlite3 over them.
+# ==========
+
+DEFAULTS = {
+    # {alias: weight}, the aliases must be in DATABASES. empty reads from default
+    "ALIASES": {},
+    # how long a client's queries stay on the primary after it wrote
+    "PIN_SECONDS": 5,
+    "COOKIE": "crm_primary_until",
+}
+
+
+def replica_settings():
+    return {**DEFAULTS, **getattr(settings, "DATABASE_READ_REPLICAS", {})}
+
+
+# the database reads go to while a query operation runs, None is the primary
+read_alias = contextvars.ContextVar("crm_read_alias", default=None)
+
+
+@contextmanager
+def reading_from(alias):
+    # a context variable, so it follows the resolvers into sync_to_async threads
+    token = read_alias.set(alias)
+    try:
+        yield
+    finally:
+        read_alias.reset(token)
+
+
+class ReplicaRouter:
+    """reads go wherever `reading_from` says, writes always to the primary"""
+
+    def db_for_read(self, model, **hints):
+        return read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows as the primary
+        return True
+
+
+class WeightedRoundRobin:
+    """smooth weighted round robin: weights {a: 2, b: 1} give a, b, a, a, b, a..."""
+
+    def __init__(self, weights):
+        self.weights = weights
+        self.current = dict.fromkeys(weights, 0)
+        self.lock = threading.Lock()
+
+    def next(self):
+        total = sum(self.weights.values())
+        with self.lock:
+            for alias, weight in self.weights.items():
+                self.current[alias] += weight
+            chosen = max(self.current, key=self.current.get)
+            self.current[chosen] -= total
+        return chosen
+
+
+_picker = None
+_picker_config = None
+
+
+def next_replica():
+    """the alias the next query operation reads from, None without replicas"""
+    global _picker, _picker_config
+    aliases = replica_settings()["ALIASES"]
+    if not aliases:
+        return None
+    key = json.dumps(aliases, sort_keys=True)
+    if key != _picker_config:
+        _picker, _picker_config = WeightedRoundRobin(aliases), key
+    return _picker.next()
+
+
+def pinned(request):
+    """whether `request` comes from a client that wrote within the pin window"""
+    try:
+        return float(request.COOKIES.get(replica_settings()["COOKIE"], 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def alias_for(request, operation):
+    """where the reads of one operation of `request` go"""
+    if operation != OperationType.QUERY or getattr(request, "wrote", False) or pinned(request):
+        return None
+    return next_replica()
+
+
+def pin_after_write(request, response):
+    """keep the client on the primary for a while if this request ran a mutation"""
+    config = replica_settings()
+    if not getattr(request, "wrote", False) or not config["ALIASES"]:
+        return response
+    seconds = config["PIN_SECONDS"]
+    response.set_cookie(config["COOKIE"], f"{time.time() + seconds:.3f}", max_age=seconds, httponly=True, samesite="Lax")
+    return response
@@ -1,11 +1,21 @@
 import graphene
 from graphene_django import DjangoObjectType
-from graphene_django.filter import DjangoFilterConnectionField
-from crm.models import Customer, Order, Product
+from graphene_django.filter.utils import get_filtering_args_from_filterset
+from crm.models import BulkJob, ChangeEvent, Customer, DailyProductSales, DailySales, Order, Product
 from django.core.exceptions import ValidationError
 from django.db import transaction
-from django.utils import timezone
+from graphql import GraphQLError
+from .bulk import PHONE_ERROR, PHONE_PATTERN, bulk_create_customers, validate_product
+from .concurrency import is_async_context, run_sync
+from .cost import MAX_PAGE_SIZE
+from .feed import changes_since, listen
 from .filters import CustomerFilter, OrderFilter, ProductFilter
+from .jobs import enqueue
+from .fields import BatchedFilterConnectionField, CountableConnection, KeysetFilterConnectionField
+from .loaders import get_loaders
+from .optimizer import optimize, optimize_nodes
+from .orders import bulk_place_orders, place_order
+from .stats import sales_summary
 
 
 
@@ -20,9 +30,11 @@ from .filters import CustomerFilter, OrderFilter, ProductFilter
 class CustomerType(DjangoObjectType):
     class Meta:
         model = Customer # defining which model  maps to this type
-        fields =  ("id","name", "email", "phone", 'created_at') # defining which field are available to be accessed of mutated
+        fields =  ("id","name", "email", "phone", 'created_at',
+                   "order_count", "lifetime_total", "last_order_date") # defining which field are available to be accessed of mutated
         filterset_class = CustomerFilter
         interfaces = (graphene.relay.Node,) # needed for connection filter
+        connection_class = CountableConnection
 
 class ProductType(DjangoObjectType):
     class Meta:
@@ -30,6 +42,7 @@ class ProductType(DjangoObjectType):
         fields = ("id", "name", "price", "stock") # defining which field are available to be accessed of mutated
         filterset_class = ProductFilter
         interfaces = (graphene.relay.Node,)
+        connection_class = CountableConnection
 
 class OrderType(DjangoObjectType):
     class Meta:
@@ -37,6 +50,96 @@ class OrderType(DjangoObjectType):
         fields = ("id","customer", "products", "order_date", "total_amount") # defining which field are available to be accessed of mutated
         filterset_class = OrderFilter
         interfaces = (graphene.relay.Node,)
+        connection_class = CountableConnection
+
+    # declared explicitly so the m2m goes through the loaders instead of one query per order
+    products = BatchedFilterConnectionField(ProductType)
+
+    # relations are batched across the whole page through the per-request loaders,
+    # unless the query planner already loaded them with select/prefetch_related
+    def resolve_customer(self, info):
+        if Order.customer.field.is_cached(self):
+            return self.customer
+        return get_loaders(info.context).customer.load(self.customer_id)
+
+    def resolve_products(self, info, **kwargs):
+        if "products" in getattr(self, "_prefetched_objects_cache", {}):
+            return list(self.products.all())
+        return get_loaders(info.context).order_products.load(self.id)
+
+
+class BulkJobType(DjangoObjectType):
+    """a background bulkCreateCustomers/bulkCreateOrders, see crm/jobs.py"""
+
+    class Meta:
+        model = BulkJob
+        fields = ("id", "kind", "status", "total", "processed", "succeeded", "errors", "failure",
+                  "created_at", "started_at", "finished_at")
+
+    errors = graphene.List(graphene.NonNull(graphene.String))
+    progress = graphene.Float(description="processed / total, 0 to 1")
+
+    def resolve_progress(self, info):
+        return self.processed / self.total if self.total else 1.0
+
+
+class SalesGroupBy(graphene.Enum):
+    DAY = "day"
+    WEEK = "week"
+    MONTH = "month"
+
+
+class SalesBucket(graphene.ObjectType):
+    """sales of one day/week/month, `period` is its first day"""
+    # not a DjangoObjectType, so tell the response cache what it is built from
+    cache_models = (DailySales, DailyProductSales, Order)
+
+    period = graphene.Date(required=True)
+    order_count = graphene.Int(required=True)
+    units = graphene.Int(required=True)
+    revenue = graphene.Decimal(required=True)
+
+
+class ChangeTopic(graphene.Enum):
+    ORDER_CREATED = ChangeEvent.ORDER_CREATED
+    PRODUCT_STOCK_CHANGED = ChangeEvent.PRODUCT_STOCK_CHANGED
+
+
+class ChangeType(DjangoObjectType):
+    """one entry of the change feed, see crm/feed.py"""
+
+    class Meta:
+        model = ChangeEvent
+        fields = ("topic", "object_id", "created_at")
+
+    cursor = graphene.ID(required=True)
+    topic = ChangeTopic(required=True)
+    object_id = graphene.ID(required=True)
+    # the row as it is now, null once deleted
+    order = graphene.Field(OrderType)
+    product = graphene.Field(ProductType)
+
+    def resolve_cursor(self, info):
+        return self.id
+
+    def resolve_order(self, info):
+        return self.target if self.topic == ChangeEvent.ORDER_CREATED else None
+
+    def resolve_product(self, info):
+        return self.target if self.topic == ChangeEvent.PRODUCT_STOCK_CHANGED else None
+
+
+class ChangeFeed(graphene.ObjectType):
+    """a page of changesSince, the next call continues from `cursor`"""
+    cache_models = (ChangeEvent, Order, Product)
+
+    changes = graphene.List(graphene.NonNull(ChangeType), required=True)
+    cursor = graphene.ID(required=True)
+    has_more = graphene.Boolean(required=True)
+    reset = graphene.Boolean(
+        required=True,
+        description="the cursor is older than the retained log, reload everything and continue from `cursor`",
+    )
 
 
 # =============
@@ -72,7 +175,9 @@ class CreateCustomer(graphene.Mutation):
 
     #defining the logic for the mutation. analogous to making a custom create classs in DRF
     @classmethod
-    def mutate(cls, root, info, name, email, phone=None):
+    def mutate(cls, root, info, customer_data):
+        if is_async_context(info):
+            return cls.mutate_async(root, info, customer_data)
         name = customer_data.name
         email = customer_data.email
         phone = customer_data.phone
@@ -81,10 +186,8 @@ class CreateCustomer(graphene.Mutation):
             raise ValidationError("this email is already in use")
         
         #validating phone format
-        if phone:
-            phone_pattern = r"^\+?\d{1,4}[-.\s]?\d{3}[-.\s]?\d{3,4}$"
-            if not re.match(phone_pattern, phone):
-                raise ValidationError("Invalid phone format. Use +1234567890 or 123-456-7890.")
+        if phone and not PHONE_PATTERN.match(phone):
+            raise ValidationError(PHONE_ERROR)
             
         #the create Customer in db
         with transaction.atomic():
@@ -92,46 +195,47 @@ class CreateCustomer(graphene.Mutation):
         
         #returning the response: an object with some fields
         return CreateCustomer(customer=customer, message="Customer created successfuly")
+
+    # same thing on the async ORM, used by the ASGI view
+    @classmethod
+    async def mutate_async(cls, root, info, customer_data):
+        email = customer_data.email
+        phone = customer_data.phone
+        if await Customer.objects.filter(email=email).aexists():
+            raise ValidationError("this email is already in use")
+        if phone and not PHONE_PATTERN.match(phone):
+            raise ValidationError(PHONE_ERROR)
+
+        customer = await Customer.objects.acreate(name=customer_data.name, email=email, phone=phone or "")
+        return CreateCustomer(customer=customer, message="Customer created successfuly")
     
 
 class BulkCreateCustomers(graphene.Mutation):
     class Arguments:
-        customer_list = CustomerInput(required=True)
+        customer_list = graphene.List(graphene.NonNull(CustomerInput), required=True)
+        batch_size = graphene.Int(required=False)
+        # return a job at once and create the customers in the background, poll bulkJob(id)
+        background = graphene.Boolean(default_value=False)
     
     customers = graphene.List(CustomerType)
     creation_errors =graphene.List(graphene.String)
-    message = "Bulk creation complete"
+    message = graphene.String()
+    job = graphene.Field(BulkJobType)
  
 
     @classmethod
-    def mutate(cls, root, info, customer_list):
-        created_customers = []
-        errors = []
+    def mutate(cls, root, info, customer_list, batch_size=None, background=False):
+        if is_async_context(info):
+            # chunked transactions need the sync ORM
+            return run_sync(cls.mutate, root, info, customer_list, batch_size, background)
+        if background:
+            return BulkCreateCustomers(job=enqueue("customers", customer_list, batch_size), message="Bulk creation queued")
+        # validation happens in memory, existing emails are looked up with one
+        # query per chunk and the inserts go through bulk_create (see crm/bulk.py)
+        created_customers, errors = bulk_create_customers(customer_list, batch_size=batch_size)
 
-        with transaction.atomic():
-            for index, customer in enumerate(customer_list):
-                name = customer.name
-                email = customer.email
-                phone = customer.phone
-
-                if Customer.objects.filter(email=email).exists():
-                    # logging errors in the list instead of breaking the flow with a raised error
-                    errors.append(f"Customer {index + 1}: this email '{email}' is already in use")
-                    continue
-        
-                #validating phone format
-                if phone:
-                    phone_pattern = r"^\+?\d{1,4}[-.\s]?\d{3}[-.\s]?\d{3,4}$"
-                    if not re.match(phone_pattern, phone):
-                        errors.append(f"Customer {index + 1}: Invalid phone format. Use +1234567890 or 123-456-7890.")
-                        continue
-                    
-                #the creation logic
-                customer = Customer.objects.create(name=name, email=email, phone=phone or "")
-                created_customers.append(customer)
-            
-        return BulkCreateCustomers(customer_list=created_customers,
-                                   creation_errors=errors, message=message)
+        return BulkCreateCustomers(customers=created_customers,
+                                   creation_errors=errors, message="Bulk creation complete")
 
 
 class CreateProduct(graphene.Mutation):
@@ -142,16 +246,25 @@ class CreateProduct(graphene.Mutation):
     message = graphene.String()
 
     @classmethod
-    def mutate(cls, info, root, product_data):
-        if price <= 0:
-            raise ValidationError("price  must be greater than 0")
-        if stock < 0:
-            raise ValidationError("stock cannot be negative")
+    def mutate(cls, root, info, product_data):
+        if is_async_context(info):
+            return cls.mutate_async(root, info, product_data)
+        name, price, stock = cls.validate(product_data)
         with transaction.atomic():
             product = Product.objects.create(name=name, price=price, stock=stock)
         message = "product successfully created" if product else "Error: product creation unsuccessful"
 
         return CreateProduct(product=product, message=message) 
+
+    @classmethod
+    async def mutate_async(cls, root, info, product_data):
+        name, price, stock = cls.validate(product_data)
+        product = await Product.objects.acreate(name=name, price=price, stock=stock)
+        return CreateProduct(product=product, message="product successfully created")
+
+    @staticmethod
+    def validate(product_data):
+        return validate_product(product_data.name, product_data.price, product_data.stock)
         
 
 class CreateOrder(graphene.Mutation):
@@ -162,41 +275,43 @@ class CreateOrder(graphene.Mutation):
     message= graphene.String()
 
     @classmethod
-    def mutate(cls, info, root, order_data):
-        # validate customer
-        customer_id = order_data.customer_id
-        product_ids = order_data.product_ids
-        order_date = order_data.order_date or timezone.now()
+    def mutate(cls, root, info, order_data):
+        if is_async_context(info):
+            # placing an order locks rows inside a transaction, which needs the sync ORM
+            return run_sync(cls.mutate, root, info, order_data)
+        # customer/product validation, stock and the total all happen in a
+        # fixed number of queries inside one transaction (see crm/orders.py)
+        order = place_order(
+            customer_id=order_data.customer_id,
+            product_ids=order_data.product_ids,
+            order_date=order_data.order_date,
+        )
+        return CreateOrder(order=order, message="Order created successfully")
 
-        try:
-            customer = Customer.objects.get(id=customer_id)
-        except Customer.DoesNotExist:
-            raise ValidationError("Customer does not exist")
-        
-        # validate  products
-        if not product_ids:
-            raise ValidationError("Order must have at least one product")
-        product_list = []
-        for index, product_id in enumerate(product_ids):
-            try:
-                product = Product.objects.get(id=product_id)
-                product_list.append(product)
-            except Product.DoesNotExist:
-                raise ValidationError(f"Item {index+1}, {product_id}: Product does not exist")
-
-        if len(product_list) < len(product_ids):
-            raise ValidationError("Invalid products in order")
-        
-        total_amount = sum(product.price for product in product_list)
 
-        with transaction.atomic():
-            order = Order.objects.create(
-                customer=customer_id,
-                products=product_list,
-                total_amount=total_amount,
-                order_date=order_date
-                )
-        return CreateOrder(order=order, message="Order created successfully")
+class BulkCreateOrders(graphene.Mutation):
+    class Arguments:
+        order_list = graphene.List(graphene.NonNull(OrderInput), required=True)
+        batch_size = graphene.Int(required=False)
+        background = graphene.Boolean(default_value=False)
+
+    orders = graphene.List(OrderType)
+    creation_errors = graphene.List(graphene.String)
+    message = graphene.String()
+    job = graphene.Field(BulkJobType)
+
+    @classmethod
+    def mutate(cls, root, info, order_list, batch_size=None, background=False):
+        if is_async_context(info):
+            return run_sync(cls.mutate, root, info, order_list, batch_size, background)
+        if background:
+            return BulkCreateOrders(job=enqueue("orders", order_list, batch_size), message="Bulk order creation queued")
+        # all customers and products are resolved up front, orders and their
+        # through rows go in with bulk_create (see crm/orders.py)
+        created_orders, errors = bulk_place_orders(order_list, batch_size=batch_size)
+
+        return BulkCreateOrders(orders=created_orders,
+                                creation_errors=errors, message="Bulk order creation complete")
 
 
 # ==============
@@ -212,26 +327,118 @@ class Mutation(graphene.ObjectType):
     bulk_create_customers = BulkCreateCustomers.Field()
     create_product = CreateProduct.Field()
     create_order = CreateOrder.Field()
+    bulk_create_orders = BulkCreateOrders.Field()
 
 
 class Query(graphene.ObjectType):
     # definng the outputs of the queries
     hello = graphene.String()
-    all_customers = DjangoFilterConnectionField(CustomerType)
-    all_products = DjangoFilterConnectionField(ProductType)
-    all_orders = DjangoFilterConnectionField(OrderType)
+    # `keyset: true` switches a connection to seek pagination on the given sort key
+    # max_limit caps first/last for callers that bypass the cost rule (e.g. schema.execute)
+    all_customers = KeysetFilterConnectionField(CustomerType, keyset_fields=("created_at", "id"), max_limit=MAX_PAGE_SIZE)
+    all_products = KeysetFilterConnectionField(ProductType, keyset_fields=("id",), max_limit=MAX_PAGE_SIZE)
+    # the order table is the big one, never COUNT(*) it on keyset pages
+    all_orders = KeysetFilterConnectionField(OrderType, keyset_fields=("order_date", "id"), count_total=False,
+                                             max_limit=MAX_PAGE_SIZE)
+    # served from the daily rollups, see crm/stats.py
+    sales_summary = graphene.List(
+        graphene.NonNull(SalesBucket),
+        group_by=SalesGroupBy(default_value="day"),
+        date_from=graphene.Date(name="from"),
+        date_to=graphene.Date(name="to"),
+        product_id=graphene.ID(),
+        customer_id=graphene.ID(),
+    )
+    # progress of a background bulk mutation
+    bulk_job = graphene.Field(BulkJobType, id=graphene.ID(required=True))
+    # orders created and stock changed since the last call, see crm/feed.py
+    changes_since = graphene.Field(
+        graphene.NonNull(ChangeFeed),
+        cursor=graphene.ID(description="from the previous call, leave out to start at the end of the log"),
+        first=graphene.Int(default_value=MAX_PAGE_SIZE),
+        topics=graphene.List(graphene.NonNull(ChangeTopic)),
+    )
 
     # this is the equivalent of mutate functions i think? defining the logic for each query
-    def resolve_all_customers(root, info):
-        return Customer.objects.all()
-
-    def resolve_all_products(root, info):
-        return Product.objects.all()
-
-    def resolve_all_orders(root, info):
-        return Order.objects.all()
+    # the planner trims columns and joins to whatever the client selected
+    def resolve_all_customers(root, info, **kwargs):
+        return optimize(Customer.objects.all(), info)
+
+    def resolve_all_products(root, info, **kwargs):
+        return optimize(Product.objects.all(), info)
+
+    def resolve_all_orders(root, info, **kwargs):
+        return optimize(Order.objects.all(), info)
+
+    def resolve_sales_summary(root, info, group_by="day", date_from=None, date_to=None,
+                              product_id=None, customer_id=None):
+        if is_async_context(info):
+            return run_sync(Query.resolve_sales_summary, root, info, group_by, date_from, date_to,
+                            product_id, customer_id)
+        # enum arguments arrive as members, the default as the plain value
+        period = getattr(group_by, "value", group_by)
+        return sales_summary(period, date_from, date_to, product_id, customer_id)
+
+    def resolve_bulk_job(root, info, id):
+        if is_async_context(info):
+            return run_sync(Query.resolve_bulk_job, root, info, id)
+        try:
+            id = int(id)
+        except (TypeError, ValueError):
+            raise GraphQLError("Invalid job id")
+        return BulkJob.objects.filter(pk=id).first()
+
+    def resolve_changes_since(root, info, cursor=None, first=MAX_PAGE_SIZE, topics=None):
+        if is_async_context(info):
+            return run_sync(Query.resolve_changes_since, root, info, cursor, first, topics)
+        try:
+            cursor = int(cursor) if cursor is not None else None
+        except ValueError:
+            raise GraphQLError("Invalid cursor")
+        topics = [getattr(topic, "value", topic) for topic in topics or []]
+        return changes_since(cursor, max(1, min(first, MAX_PAGE_SIZE)), topics)
 
     def resolve_hello(self, info):
         return "Hello, GraphQL!"
-    
 
+
+# ==========
+#  subscriptions, served over websockets by crm/subscriptions.py.
+#  each event of the change feed is one message; the rows are loaded (with
+#  the joins the selection needs) and filtered with the same filtersets as
+#  allOrders/allProducts, so `orderCreated(customerName: "x")` only sends
+#  x's new orders.
+# ==========
+
+def matching_rows(model, filterset_class, filters, ids, info):
+    queryset = optimize_nodes(model.objects.filter(pk__in=ids), info)
+    return list(filterset_class(data=filters, queryset=queryset).qs.order_by("pk"))
+
+
+async def changed_rows(topic, model, filterset_class, filters, info):
+    async for events in listen(topic):
+        ids = [event.object_id for event in events]
+        for row in await run_sync(matching_rows, model, filterset_class, filters, ids, info):
+            yield row
+
+
+def watch(topic, filterset_class, filters, info):
+    model = filterset_class._meta.model
+    # bad filters are reported when subscribing, not with the first event
+    filterset = filterset_class(data=filters, queryset=model.objects.none())
+    if not filterset.is_valid():
+        raise ValidationError(filterset.form.errors.as_json())
+    return changed_rows(topic, model, filterset_class, filters, info)
+
+
+class Subscription(graphene.ObjectType):
+    order_created = graphene.Field(OrderType, args=get_filtering_args_from_filterset(OrderFilter, OrderType))
+    product_stock_changed = graphene.Field(
+        ProductType, args=get_filtering_args_from_filterset(ProductFilter, ProductType)
+    )
+
+    def subscribe_order_created(root, info, **filters):
+        return watch(ChangeEvent.ORDER_CREATED, OrderFilter, filters, info)
+
+    def subscribe_product_stock_changed(root, info, **filters):
+        return watch(ChangeEvent.PRODUCT_STOCK_CHANGED, ProductFilter, filters, info)
@@ -0,0 +1,97 @@
+from django.conf import settings
+from django.db import connections
+from django.db.models import Case, IntegerField, Q, Value, When
+from django.db.models.expressions import RawSQL
+
+
+# ==========
+#  name/email search.
+#  on SQLite the searchable columns are mirrored into FTS5 tables with the
+#  trigram tokenizer (see migration 0004, kept in sync by triggers so
+#  bulk_create is covered too). a phrase MATCH on trigrams is a substring
+#  match, i.e. the same thing `icontains` answers, but served by an index
+#  and ranked with bm25. other backends get a hook: on PostgreSQL the
+#  migration adds pg_trgm GIN indexes, which serve icontains directly.
+# ==========
+
+# model label -> (fts table, indexed columns)
+SEARCH_TABLES = {
+    "crm.customer": ("crm_customer_fts", ("name", "email")),
+    "crm.product": ("crm_product_fts", ("name",)),
+}
+
+# the trigram tokenizer can't match anything shorter than one trigram
+MIN_TRIGRAM_LENGTH = 3
+
+# how many of the best matches are ranked, every match is returned but the
+# ones past this follow in id order (search-as-you-type only shows the top)
+MAX_SEARCH_RESULTS = getattr(settings, "CRM_SEARCH_MAX_RESULTS", 1000)
+
+
+def fts_phrase(value):
+    """quote user input as a single FTS5 phrase so operators in it are inert"""
+    return '"{}"'.format(value.replace('"', '""'))
+
+
+def ranked_ids(model, value, using="default", limit=MAX_SEARCH_RESULTS):
+    """ids of `model` rows matching `value`, best match first (SQLite FTS5 only)"""
+    table, _ = SEARCH_TABLES[model._meta.label_lower]
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f"SELECT rowid FROM {table} WHERE {table} MATCH %s ORDER BY rank LIMIT %s",
+            [fts_phrase(value), limit],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def fts_matches(model, value):
+    """a subquery of the ids of `model` rows matching `value`, for `pk__in` (SQLite FTS5 only)"""
+    table, _ = SEARCH_TABLES[model._meta.label_lower]
+    # stays in SQL: a broad term over a big table would blow the bound parameter limit as a list
+    return RawSQL(f"SELECT rowid FROM {table} WHERE {table} MATCH %s", [fts_phrase(value)])
+
+
+def uses_fts(queryset, value):
+    return (
+        queryset.model._meta.label_lower in SEARCH_TABLES
+        and connections[queryset.db].vendor == "sqlite"
+        and len(value) >= MIN_TRIGRAM_LENGTH
+    )
+
+
+def fallback_search(queryset, value):
+    """icontains over the searchable columns, what non-FTS backends run"""
+    _, columns = SEARCH_TABLES[queryset.model._meta.label_lower]
+    condition = Q()
+    for column in columns:
+        condition |= Q(**{f"{column}__icontains": value})
+    return queryset.filter(condition)
+
+
+def search(queryset, value):
+    """filter `queryset` down to rows matching `value`, the best MAX_SEARCH_RESULTS ranked first"""
+    value = (value or "").strip()
+    if not value:
+        return queryset
+    if not uses_fts(queryset, value):
+        return fallback_search(queryset, value)
+
+    ids = ranked_ids(queryset.model, value, using=queryset.db, limit=MAX_SEARCH_RESULTS)
+    if not ids:
+        return queryset.none()
+    rank = Case(
+        *(When(pk=pk, then=Value(position)) for position, pk in enumerate(ids)),
+        default=Value(len(ids)),
+        output_field=IntegerField(),
+    )
+    # the filter is the whole match set, so totalCount, later pages and exports see every row
+    return queryset.filter(pk__in=fts_matches(queryset.model, value)).order_by(rank, "pk")
+
+
+def matching_ids(model, value, using="default"):
+    """a subquery of the matching ids (e.g. orders by product name), unranked"""
+    value = (value or "").strip()
+    queryset = model._default_manager.using(using)
+    if uses_fts(queryset, value):
+        return fts_matches(model, value)
+    return fallback_search(queryset, value).values("pk")
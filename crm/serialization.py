@@ -0,0 +1,221 @@
+import json
+from asyncio import gather
+from functools import partial
+
+from django.conf import settings
+from graphene.relay.node import GlobalID
+from graphene.types.resolver import dict_or_attr_resolver
+from graphene_django import DjangoObjectType
+from graphql import ExecutionContext, GraphQLNonNull, GraphQLObjectType, Undefined, is_leaf_type, located_error
+from graphql.execution.execute import get_field_def
+from graphql.pyutils import Path
+
+try:
+    import orjson
+except ImportError:  # optional, the stdlib encoder is used without it
+    orjson = None
+
+
+# ==========
+#  fast path for pages of nodes.
+#  graphql-core executes every field of every node on its own: a Path, a
+#  GraphQLResolveInfo, argument coercion, the resolver, awaitable checks and
+#  the leaf completion, per field and row. most fields of CustomerType,
+#  ProductType and OrderType (and the edges' node and cursor, and pageInfo)
+#  just read an attribute, so FastExecutionContext compiles each selection
+#  set once per request into steps that read those attributes off the row
+#  and serialize them in one loop. relations, custom resolvers, fields with
+#  arguments and everything under a middleware (tracing) still go through
+#  the executor, and so does a value that fails to serialize, which then
+#  gets the usual located error.
+#  responses are written with orjson when it is installed.
+# ==========
+
+def fast_path_enabled():
+    return getattr(settings, "GRAPHQL_FAST_PATH", True)
+
+
+def default_execution_context():
+    """the execution context class the views run with, None for graphql-core's own"""
+    return FastExecutionContext if fast_path_enabled() else None
+
+
+def column_reader(attname, default):
+    """what graphene's dict_or_attr_resolver(attname, default) returns, minus the call"""
+
+    def read(source):
+        if isinstance(source, dict):
+            return source.get(attname, default)
+        return getattr(source, attname, default)
+
+    return read
+
+
+def global_id_reader(node, type_name):
+    """the relay id of a DjangoObjectType row, GlobalID.id_resolver without the resolve_id round trip"""
+
+    def read(source):
+        return node.to_global_id(type_name, source.pk)
+
+    return read
+
+
+def column_field(parent_type, field_def):
+    """a function reading the value of `field_def` off a row, None if it needs its resolver"""
+    resolve = field_def.resolve
+    if field_def.args or not isinstance(resolve, partial):
+        return None
+    if resolve.func is dict_or_attr_resolver and not resolve.keywords:
+        return column_reader(*resolve.args)
+    if (
+        resolve.func is GlobalID.id_resolver
+        and resolve.args[0] is DjangoObjectType.resolve_id
+        and resolve.keywords.get("parent_type_name") is None
+    ):
+        return global_id_reader(resolve.args[1], parent_type.name)
+    return None
+
+
+def plain_type_check(object_type):
+    """whether is_type_of of `object_type` can run without a GraphQLResolveInfo"""
+    is_type_of = object_type.is_type_of
+    return is_type_of is None or getattr(is_type_of, "__func__", None) is DjangoObjectType.is_type_of.__func__
+
+
+# how a step of a compiled selection set gets its value
+EXECUTE, LEAF, OBJECT = range(3)
+
+
+class FastExecutionContext(ExecutionContext):
+    """ExecutionContext that serializes plain column fields without resolving them one by one"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # (parent type, id of the fields dict) -> (fields, steps)
+        self._serializers = {}
+
+    def compile_fields(self, parent_type, fields):
+        """[(response_name, field_nodes, kind, return_type, plan)], one step per field.
+
+        the plan of a LEAF step is (read, serialize, non_null), of an OBJECT step the read.
+        """
+        steps = []
+        for response_name, field_nodes in fields.items():
+            kind, return_type, plan = EXECUTE, None, None
+            field_def = get_field_def(self.schema, parent_type, field_nodes[0])
+            if field_def is not None and not any(node.arguments for node in field_nodes):
+                return_type = field_def.type
+                named = return_type.of_type if isinstance(return_type, GraphQLNonNull) else return_type
+                if is_leaf_type(named):
+                    kind = LEAF
+                elif isinstance(named, GraphQLObjectType) and plain_type_check(named):
+                    # a connection's pageInfo, an edge's node
+                    kind = OBJECT
+                plan = column_field(parent_type, field_def) if kind != EXECUTE else None
+                if plan is None:
+                    kind = EXECUTE
+                elif kind == LEAF:
+                    plan = (plan, named.serialize, named is not return_type)
+            steps.append((response_name, field_nodes, kind, return_type, plan))
+        return steps
+
+    def serializer(self, parent_type, fields):
+        # collect_subfields hands out the same dict for every row of a list
+        key = (parent_type, id(fields))
+        entry = self._serializers.get(key)
+        if entry is None or entry[0] is not fields:
+            steps = self.compile_fields(parent_type, fields)
+            if all(kind == EXECUTE for _, _, kind, _, _ in steps):
+                steps = None
+            entry = self._serializers[key] = (fields, steps)
+        return entry[1]
+
+    def execute_fields(self, parent_type, source_value, path, fields):
+        steps = None if self.middleware_manager else self.serializer(parent_type, fields)
+        if steps is None:
+            return super().execute_fields(parent_type, source_value, path, fields)
+
+        results = {}
+        is_awaitable = self.is_awaitable
+        awaitable_fields = []
+        for response_name, field_nodes, kind, return_type, plan in steps:
+            if kind == LEAF:
+                # inline, this runs for every column of every row
+                read, serialize, non_null = plan
+                try:
+                    value = read(source_value)
+                    if value is not None:
+                        value = serialize(value)
+                    elif not non_null:
+                        results[response_name] = None
+                        continue
+                except Exception:
+                    value = None
+                if value is not None and value is not Undefined:
+                    results[response_name] = value
+                    continue
+                result = Undefined
+            elif kind == OBJECT:
+                result = self.complete_row(parent_type, return_type, field_nodes, plan, source_value, path, response_name)
+            else:
+                result = Undefined
+            if result is Undefined:
+                # the executor resolves it, and raises (and locates) any error
+                result = self.execute_field(
+                    parent_type, source_value, field_nodes, Path(path, response_name, parent_type.name)
+                )
+            if result is not Undefined:
+                results[response_name] = result
+                if is_awaitable(result):
+                    awaitable_fields.append(response_name)
+
+        if not awaitable_fields:
+            return results
+
+        async def get_results():
+            results.update(zip(awaitable_fields, await gather(*(results[name] for name in awaitable_fields))))
+            return results
+
+        return get_results()
+
+    def complete_row(self, parent_type, return_type, field_nodes, read, source, path, response_name):
+        """the fields of the object in a column (an edge's node), Undefined for the executor to take over"""
+        non_null = isinstance(return_type, GraphQLNonNull)
+        object_type = return_type.of_type if non_null else return_type
+        try:
+            value = read(source)
+            if value is None:
+                return Undefined if non_null else None
+            if object_type.is_type_of is not None and not object_type.is_type_of(value, None):
+                return Undefined
+        except Exception:
+            return Undefined
+        field_path = Path(path, response_name, parent_type.name)
+        try:
+            result = self.execute_fields(object_type, value, field_path, self.collect_subfields(object_type, field_nodes))
+        except Exception as raw_error:
+            # a non-null field of the row failed, the row is null (or the error goes further up)
+            self.handle_field_error(located_error(raw_error, field_nodes, field_path.as_list()), return_type)
+            return None
+        if not self.is_awaitable(result):
+            return result
+
+        async def await_result():
+            try:
+                return await result
+            except Exception as raw_error:
+                self.handle_field_error(located_error(raw_error, field_nodes, field_path.as_list()), return_type)
+                return None
+
+        return await_result()
+
+
+def dumps(data):
+    """compact JSON text of a response"""
+    if orjson is not None:
+        try:
+            # non-str keys: json.dumps turns them into strings, orjson needs to be told to
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode()
+        except TypeError:
+            pass
+    return json.dumps(data, separators=(",", ":"))
@@ -0,0 +1,231 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db.models import Case, Count, DateField, F, IntegerField, Max, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, Greatest, Trunc, TruncDate
+from django.utils import timezone
+
+from crm.models import Customer, DailyProductSales, DailySales, Order
+from crm.response_cache import invalidate
+
+
+# ==========
+#  denormalized customer aggregates.
+#  order_count, lifetime_total and last_order_date live on the customer
+#  row so "top customers" is an index scan instead of a GROUP BY over all
+#  orders. placing orders adds to them with F() expressions inside the
+#  same transaction; `rebuild_customer_stats` recomputes them from the
+#  orders table (backfill, or after writes that bypass crm/orders.py).
+# ==========
+
+TOTAL_FIELD = Customer._meta.get_field("lifetime_total")
+
+
+def record_orders(orders, batch_size=500):
+    """add freshly created `orders` to their customers' aggregates, one UPDATE per chunk of customers"""
+    per_customer = defaultdict(lambda: [0, Decimal("0"), None])
+    for order in orders:
+        stats = per_customer[order.customer_id]
+        stats[0] += 1
+        stats[1] += order.total_amount
+        stats[2] = max(stats[2], order.order_date) if stats[2] else order.order_date
+
+    customer_ids = list(per_customer)
+    for start in range(0, len(customer_ids), batch_size):
+        chunk = customer_ids[start:start + batch_size]
+
+        def per_row(position, output_field):
+            return Case(
+                *(When(pk=pk, then=Value(per_customer[pk][position])) for pk in chunk),
+                output_field=output_field,
+            )
+
+        latest = per_row(2, Customer._meta.get_field("last_order_date"))
+        Customer.objects.filter(pk__in=chunk).update(
+            order_count=F("order_count") + per_row(0, IntegerField()),
+            lifetime_total=F("lifetime_total") + per_row(1, TOTAL_FIELD),
+            # GREATEST is NULL if either side is, a first order has no previous date
+            last_order_date=Greatest(Coalesce(F("last_order_date"), latest), latest),
+        )
+    if customer_ids:
+        # update() sends no post_save
+        invalidate(Customer)
+
+
+def rebuild_customer_stats(customers=None):
+    """recompute the aggregates of `customers` (a queryset, default all) from their orders"""
+    customers = Customer.objects.all() if customers is None else customers
+    orders = Order.objects.filter(customer=OuterRef("pk")).order_by().values("customer")
+    updated = customers.update(
+        order_count=Coalesce(Subquery(orders.annotate(value=Count("pk")).values("value")), 0),
+        lifetime_total=Coalesce(
+            Subquery(orders.annotate(value=Sum("total_amount")).values("value")),
+            Value(Decimal("0")),
+            output_field=TOTAL_FIELD,
+        ),
+        last_order_date=Subquery(orders.annotate(value=Max("order_date")).values("value")),
+    )
+    invalidate(Customer)
+    return updated
+
+
+# ==========
+#  sales rollups.
+#  DailySales holds every order of a day, DailyProductSales the orders of a
+#  day that contain a product. placing an order adds to both (one INSERT of
+#  missing zero rows, one UPDATE per table); salesSummary then sums at most
+#  one row per day and truncates to weeks/months in SQL.
+#  the through table keeps one row per product and no price, so a rebuild
+#  counts a line as one unit at the product's current price, while live
+#  updates see the real quantity and price.
+# ==========
+
+ROLLUP_PERIODS = ("day", "week", "month")
+CENT = Decimal("0.01")
+
+
+def add_to_rollup(model, increments, batch_size=500):
+    """add {key: (order_count, units, revenue)} to `model` rows, key is day or (day, product_id)"""
+    keyed_by_product = model is DailyProductSales
+
+    def lookup(key):
+        return {"day": key[0], "product_id": key[1]} if keyed_by_product else {"day": key}
+
+    keys = list(increments)
+    for start in range(0, len(keys), batch_size):
+        chunk = keys[start:start + batch_size]
+        # make sure every row exists, then increment: concurrent first orders of a day can't lose counts
+        model.objects.bulk_create([model(**lookup(key)) for key in chunk], ignore_conflicts=True)
+        condition = Q()
+        for key in chunk:
+            condition |= Q(**lookup(key))
+        rows = model.objects.filter(condition).values_list("pk", *lookup(chunk[0]))
+        pks = {tuple(row[1:]) if keyed_by_product else row[1]: row[0] for row in rows}
+
+        def per_row(position, output_field):
+            return Case(
+                *(When(pk=pks[key], then=Value(increments[key][position])) for key in chunk),
+                output_field=output_field,
+            )
+
+        model.objects.filter(pk__in=pks.values()).update(
+            order_count=F("order_count") + per_row(0, IntegerField()),
+            units=F("units") + per_row(1, IntegerField()),
+            revenue=F("revenue") + per_row(2, model._meta.get_field("revenue")),
+        )
+
+
+def record_sales(orders, prices, batch_size=500):
+    """add freshly created orders to the rollups.
+
+    `orders` is [(order, {product_id: quantity})], `prices` {product_id: unit price}.
+    """
+    per_day = defaultdict(lambda: [0, 0, Decimal("0")])
+    per_product = defaultdict(lambda: [0, 0, Decimal("0")])
+    for order, quantities in orders:
+        day = timezone.localdate(order.order_date)
+        totals = per_day[day]
+        totals[0] += 1
+        totals[1] += sum(quantities.values())
+        totals[2] += order.total_amount
+        for product_id, quantity in quantities.items():
+            totals = per_product[(day, product_id)]
+            totals[0] += 1
+            totals[1] += quantity
+            totals[2] += prices[product_id] * quantity
+    add_to_rollup(DailySales, per_day, batch_size)
+    add_to_rollup(DailyProductSales, per_product, batch_size)
+    if per_day:
+        invalidate(DailySales, DailyProductSales)
+
+
+def rebuild_sales_rollups(date_from=None, date_to=None, batch_size=5000):
+    """recompute the rollups of the days in [date_from, date_to] (default all) from the orders"""
+    through = Order.products.through
+    orders = Order.objects.order_by()
+    lines = through.objects.order_by()
+    days = {}
+    if date_from:
+        days["day__gte"] = date_from
+    if date_to:
+        days["day__lte"] = date_to
+
+    DailySales.objects.filter(**days).delete()
+    DailyProductSales.objects.filter(**days).delete()
+
+    units = dict(
+        lines.annotate(day=TruncDate("order__order_date")).filter(**days)
+        .values("day").annotate(units=Count("pk")).values_list("day", "units")
+    )
+    per_day = (
+        orders.annotate(day=TruncDate("order_date")).filter(**days)
+        .values("day").annotate(order_count=Count("pk"), revenue=Sum("total_amount"))
+        .values_list("day", "order_count", "revenue")
+    )
+    DailySales.objects.bulk_create(
+        (DailySales(day=day, order_count=count, units=units.get(day, 0), revenue=revenue)
+         for day, count, revenue in per_day.iterator()),
+        batch_size=batch_size,
+    )
+    per_product = (
+        lines.annotate(day=TruncDate("order__order_date")).filter(**days)
+        .values("day", "product_id")
+        .annotate(order_count=Count("order_id"), revenue=Sum("product__price"))
+        .values_list("day", "product_id", "order_count", "revenue")
+    )
+    DailyProductSales.objects.bulk_create(
+        (DailyProductSales(day=day, product_id=product_id, order_count=count, units=count, revenue=revenue)
+         for day, product_id, count, revenue in per_product.iterator()),
+        batch_size=batch_size,
+    )
+    invalidate(DailySales, DailyProductSales)
+
+
+def bucketed(rows, period, date_from=None, date_to=None, **metrics):
+    """group `rows` (which have a `day`) into periods, {period: {metric: value}}"""
+    if date_from:
+        rows = rows.filter(day__gte=date_from)
+    if date_to:
+        rows = rows.filter(day__lte=date_to)
+    bucket = F("day") if period == "day" else Trunc("day", period, output_field=DateField())
+    grouped = rows.order_by().annotate(period=bucket).values("period").annotate(**metrics)
+    return {row.pop("period"): row for row in grouped}
+
+
+def sales_summary(period="day", date_from=None, date_to=None, product_id=None, customer_id=None):
+    """[{period, order_count, units, revenue}] per day/week/month, oldest first"""
+    if period not in ROLLUP_PERIODS:
+        raise ValueError(f"period must be one of {ROLLUP_PERIODS}")
+    dates = {"date_from": date_from, "date_to": date_to}
+    summed = {"order_count": Sum("order_count"), "units": Sum("units"), "revenue": Sum("revenue")}
+
+    if customer_id is None:
+        rollup = DailySales.objects.all()
+        if product_id is not None:
+            rollup = DailyProductSales.objects.filter(product_id=product_id)
+        buckets = bucketed(rollup, period, **dates, **summed)
+    else:
+        # no rollup per customer, it would be as big as the orders table. a customer's
+        # orders are few and crm_order_customer_date_idx finds them directly
+        lines = Order.products.through.objects.filter(order__customer_id=customer_id)
+        lines = lines.annotate(day=TruncDate("order__order_date"))
+        if product_id is not None:
+            # same as the rollup rebuild: a line is one unit at the current price
+            buckets = bucketed(
+                lines.filter(product_id=product_id), period, **dates,
+                order_count=Count("pk"), units=Count("pk"), revenue=Sum("product__price"),
+            )
+        else:
+            orders = Order.objects.filter(customer_id=customer_id).annotate(day=TruncDate("order_date"))
+            buckets = bucketed(orders, period, **dates, order_count=Count("pk"), revenue=Sum("total_amount"))
+            for key, row in bucketed(lines, period, **dates, units=Count("pk")).items():
+                buckets.setdefault(key, {"order_count": 0, "revenue": Decimal("0")}).update(row)
+
+    rows = [
+        {"period": key, "order_count": 0, "units": 0, "revenue": Decimal("0"), **buckets[key]}
+        for key in sorted(buckets)
+    ]
+    for row in rows:
+        # SQLite sums decimals into whatever precision it likes
+        row["revenue"] = Decimal(row["revenue"]).quantize(CENT)
+    return rows
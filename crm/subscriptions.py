@@ -0,0 +1,204 @@
+import asyncio
+import json
+import logging
+
+from django.core.serializers.json import DjangoJSONEncoder
+from graphene_django.settings import graphene_settings
+from graphql import ExecutionResult, GraphQLError, OperationType, get_operation_ast, subscribe
+
+from .cost import check_query_cost
+from .loaders import AsyncLoaders
+from .views import CRMGraphQLView
+
+
+logger = logging.getLogger("crm.subscriptions")
+
+# ==========
+#  GraphQL subscriptions over websockets, graphql-transport-ws protocol
+#  (https://github.com/enisdenjo/graphql-ws/blob/master/PROTOCOL.md), which
+#  is what graphql-ws, Apollo Client and GraphiQL speak.
+#  asgi.py sends websocket connections to /graphql/ here, plain HTTP still
+#  goes to Django. documents go through the same cache, validation and cost
+#  rules as /graphql/; only subscription operations are accepted, queries
+#  and mutations belong on the HTTP endpoints.
+# ==========
+
+PROTOCOL = "graphql-transport-ws"
+
+# close codes of the protocol
+BAD_REQUEST = 4400
+UNAUTHORIZED = 4401
+INIT_TIMEOUT = 4408
+DUPLICATE_SUBSCRIBER = 4409
+TOO_MANY_INITS = 4429
+# seconds a client has to send connection_init
+INIT_TIMEOUT_SECONDS = 10
+
+
+def format_result(result):
+    payload = {"data": result.data}
+    if result.errors:
+        payload["errors"] = [CRMGraphQLView.format_error(error) for error in result.errors]
+    return payload
+
+
+class SubscriptionContext:
+    """info.context of a subscription, stands in for the request"""
+
+    is_async = True
+
+    def __init__(self, scope, payload):
+        self.scope = scope
+        self.connection_params = payload or {}
+
+    @property
+    def loaders(self):
+        # a fresh set every time: an event is one row, and nothing loaded may outlive it
+        return AsyncLoaders()
+
+
+class Connection:
+    """one websocket, any number of subscriptions"""
+
+    def __init__(self, schema, scope, receive, send):
+        self.schema = schema
+        self.scope = scope
+        self.receive = receive
+        self._send = send
+        self.context = None
+        self.subscriptions = {}  # id -> asyncio.Task
+        # parse/validate through the document cache of the HTTP views
+        self.view = CRMGraphQLView(schema=schema)
+
+    async def send(self, message):
+        await self._send({"type": "websocket.send", "text": json.dumps(message, cls=DjangoJSONEncoder)})
+
+    async def close(self, code, reason=""):
+        await self._send({"type": "websocket.close", "code": code, "reason": reason})
+
+    async def run(self):
+        message = await self.receive()
+        if message["type"] != "websocket.connect":
+            return
+        if PROTOCOL not in self.scope.get("subprotocols", []):
+            # the older subscriptions-transport-ws protocol is not spoken here
+            await self._send({"type": "websocket.close", "code": BAD_REQUEST})
+            return
+        await self._send({"type": "websocket.accept", "subprotocol": PROTOCOL})
+        init_timeout = asyncio.get_running_loop().call_later(INIT_TIMEOUT_SECONDS, self.init_expired)
+        try:
+            while True:
+                message = await self.receive()
+                if message["type"] == "websocket.disconnect":
+                    return
+                if not await self.handle(message.get("text") or message.get("bytes")):
+                    return
+                if self.context is not None:
+                    init_timeout.cancel()
+        finally:
+            init_timeout.cancel()
+            for task in self.subscriptions.values():
+                task.cancel()
+            await asyncio.gather(*self.subscriptions.values(), return_exceptions=True)
+
+    def init_expired(self):
+        if self.context is None:
+            asyncio.ensure_future(self.close(INIT_TIMEOUT, "Connection initialisation timeout"))
+
+    async def handle(self, text):
+        """act on one client message, False once the socket is closed"""
+        try:
+            message = json.loads(text)
+            kind = message["type"]
+        except (TypeError, ValueError, KeyError):
+            await self.close(BAD_REQUEST, "Invalid message")
+            return False
+
+        if kind == "connection_init":
+            if self.context is not None:
+                await self.close(TOO_MANY_INITS, "Too many initialisation requests")
+                return False
+            self.context = SubscriptionContext(self.scope, message.get("payload"))
+            await self.send({"type": "connection_ack"})
+        elif kind == "ping":
+            await self.send({"type": "pong"})
+        elif kind == "pong":
+            pass
+        elif kind == "subscribe":
+            if self.context is None:
+                await self.close(UNAUTHORIZED, "Unauthorized")
+                return False
+            id, payload = message.get("id"), message.get("payload")
+            if not isinstance(id, str) or not isinstance(payload, dict):
+                await self.close(BAD_REQUEST, "Invalid subscribe message")
+                return False
+            if id in self.subscriptions:
+                await self.close(DUPLICATE_SUBSCRIBER, f"Subscriber for {id} already exists")
+                return False
+            self.subscriptions[id] = asyncio.ensure_future(self.subscribe(id, payload))
+        elif kind == "complete":
+            task = self.subscriptions.pop(message.get("id"), None)
+            if task is not None:
+                task.cancel()
+        else:
+            await self.close(BAD_REQUEST, f"Unexpected message type {kind}")
+            return False
+        return True
+
+    async def subscribe(self, id, payload):
+        try:
+            stream = await self.start(payload)
+            if isinstance(stream, ExecutionResult):
+                errors = [CRMGraphQLView.format_error(error) for error in stream.errors]
+                await self.send({"type": "error", "id": id, "payload": errors})
+                return
+            try:
+                async for result in stream:
+                    await self.send({"type": "next", "id": id, "payload": format_result(result)})
+            finally:
+                await stream.aclose()
+            await self.send({"type": "complete", "id": id})
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("subscription %s failed", id)
+            await self.send({"type": "error", "id": id, "payload": [{"message": "Internal server error"}]})
+        finally:
+            self.subscriptions.pop(id, None)
+
+    async def start(self, payload):
+        """the event stream of a subscribe message, or an ExecutionResult with the errors"""
+        query = payload.get("query")
+        variables = payload.get("variables") or {}
+        operation_name = payload.get("operationName")
+        if not isinstance(query, str):
+            return ExecutionResult(errors=[GraphQLError("Must provide query string.")])
+        document, errors = self.view.get_document(query)
+        if errors:
+            return ExecutionResult(errors=errors)
+        operation = get_operation_ast(document, operation_name)
+        if operation is None or operation.operation != OperationType.SUBSCRIPTION:
+            return ExecutionResult(errors=[GraphQLError("Only subscriptions are served here, use /graphql/.")])
+        errors, _ = check_query_cost(self.schema.graphql_schema, document, variables, operation_name)
+        if errors:
+            return ExecutionResult(errors=errors)
+        return await subscribe(
+            self.schema.graphql_schema,
+            document,
+            context_value=self.context,
+            variable_values=variables,
+            operation_name=operation_name,
+        )
+
+
+def websocket_application(schema=None, path="/graphql/"):
+    """ASGI app for websocket connections to `path`, on GRAPHENE["SCHEMA"] unless given `schema`"""
+
+    async def application(scope, receive, send):
+        if scope["path"] != path:
+            await receive()
+            await send({"type": "websocket.close"})
+            return
+        await Connection(schema or graphene_settings.SCHEMA, scope, receive, send).run()
+
+    return application
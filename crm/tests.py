@@ -1,3 +1,1501 @@
-from django.test import TestCase
+import csv
+import datetime
+import io
+import json
+import os
+import shutil
+import tempfile
+import asyncio
+import time
+from collections import namedtuple
+from unittest import mock
+from decimal import Decimal
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management import CommandError, call_command
+from django.db import connection, connections
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+import graphene
+from graphene_django.settings import graphene_settings
+from graphql import execute, parse
+
+from alx_backend_graphql import schema as project_schema
+from alx_backend_graphql.schema import schema
+from crm import benchmarks, bulk
+from crm import feed
+from crm.export import order_rows
+from crm.jobs import claim_next, drain, process
+from crm.filters import CustomerFilter, OrderFilter, ProductFilter
+from crm.models import BulkJob, ChangeEvent, Customer, DailySales, Order, Product
+from crm.orders import bulk_place_orders, place_order
+from crm.response_cache import get_response_cache, selected_models
+from crm.routing import WeightedRoundRobin
+from crm.schema import CustomerType
+from crm.serialization import FastExecutionContext
+from crm.subscriptions import PROTOCOL, websocket_application
+from crm.tracing import Tracer, current_path
+from crm.views import CRMGraphQLView, query_hash
+from crm.warmup import parse_importtime, warm_up
+
+
+# stands in for the OrderInput objects bulk_place_orders gets from the mutation
+OrderRow = namedtuple("OrderRow", ["customer_id", "product_ids", "order_date"])
+
+
+def seed_orders(count, products_per_order=3):
+    """create `count` orders, each with its own customer and a few products"""
+    products = Product.objects.bulk_create(
+        Product(name=f"product {i}", price=Decimal("9.99"), stock=10)
+        for i in range(products_per_order * 2)
+    )
+    customers = Customer.objects.bulk_create(
+        Customer(name=f"customer {i}", email=f"customer{i}@example.com")
+        for i in range(count)
+    )
+    orders = Order.objects.bulk_create(
+        Order(customer=customer, total_amount=Decimal("29.97")) for customer in customers
+    )
+    Order.products.through.objects.bulk_create(
+        Order.products.through(order_id=order.id, product_id=products[(i + j) % len(products)].id)
+        for i, order in enumerate(orders)
+        for j in range(products_per_order)
+    )
+    return orders
+
+
+class OrderLoaderTests(TestCase):
+    query = """
+        query ($first: Int) {
+            allOrders(first: $first) {
+                edges { node {
+                    customer { name }
+                    products { edges { node { name price } } }
+                } }
+            }
+        }
+    """
+
+    def run_query(self, first):
+        context = RequestFactory().post("/graphql/")
+        with CaptureQueriesContext(connection) as queries:
+            result = schema.execute(self.query, variables={"first": first}, context_value=context)
+        self.assertIsNone(result.errors)
+        return result, len(queries)
+
+    def test_query_count_does_not_grow_with_page_size(self):
+        seed_orders(50)
+        _, small = self.run_query(5)
+        result, large = self.run_query(50)
+        self.assertEqual(small, large)
+        self.assertEqual(len(result.data["allOrders"]["edges"]), 50)
+
+    def test_relations_are_resolved_per_order(self):
+        orders = seed_orders(3)
+        result, _ = self.run_query(3)
+        edges = result.data["allOrders"]["edges"]
+        for order, edge in zip(orders, edges):
+            node = edge["node"]
+            self.assertEqual(node["customer"]["name"], order.customer.name)
+            expected = sorted(order.products.values_list("name", flat=True))
+            self.assertEqual(sorted(e["node"]["name"] for e in node["products"]["edges"]), expected)
+
+
+
+class QueryPlannerTests(TestCase):
+    query = """
+        query {
+            allOrders(first: 20) {
+                edges { node { ...OrderFields } }
+            }
+        }
+        fragment OrderFields on OrderType {
+            totalAmount
+            customer { name }
+            products { edges { node { name } } }
+        }
+    """
+
+    def test_fragment_selections_drive_joins_and_columns(self):
+        seed_orders(20)
+        context = RequestFactory().post("/graphql/")
+        with CaptureQueriesContext(connection) as queries:
+            result = schema.execute(self.query, context_value=context)
+        self.assertIsNone(result.errors)
+        # count, page joined to customer, prefetched products
+        self.assertEqual(len(queries), 3)
+        page_sql = queries.captured_queries[1]["sql"]
+        self.assertIn('"crm_customer"."name"', page_sql)
+        self.assertNotIn('"crm_customer"."email"', page_sql)
+        self.assertNotIn('"crm_order"."order_date"', page_sql)
+        node = result.data["allOrders"]["edges"][0]["node"]
+        self.assertEqual(len(node["products"]["edges"]), 3)
+
+    def test_narrow_query_only_loads_requested_columns(self):
+        seed_orders(5)
+        with CaptureQueriesContext(connection) as queries:
+            result = schema.execute("{ allCustomers(first: 5) { edges { node { name } } } }")
+        self.assertIsNone(result.errors)
+        page_sql = queries.captured_queries[-1]["sql"]
+        self.assertIn('"crm_customer"."name"', page_sql)
+        self.assertNotIn('"crm_customer"."email"', page_sql)
+
+
+class BulkCreateCustomersTests(TestCase):
+    mutation = """
+        mutation ($customers: [CustomerInput!]!, $batchSize: Int) {
+            bulkCreateCustomers(customerList: $customers, batchSize: $batchSize) {
+                customers { email }
+                creationErrors
+            }
+        }
+    """
+
+    def test_rows_are_validated_and_inserted_in_chunks(self):
+        Customer.objects.create(name="existing", email="taken@example.com")
+        customers = [{"name": f"c{i}", "email": f"c{i}@example.com"} for i in range(10)]
+        customers[2]["email"] = "taken@example.com"
+        customers[4]["phone"] = "not a phone"
+        customers[7]["email"] = "c0@example.com"
+
+        with CaptureQueriesContext(connection) as queries:
+            result = schema.execute(self.mutation, variables={"customers": customers, "batchSize": 4})
+        self.assertIsNone(result.errors)
+        payload = result.data["bulkCreateCustomers"]
+        self.assertEqual(len(payload["customers"]), 7)
+        self.assertEqual(
+            [error.split(":")[0] for error in payload["creationErrors"]],
+            ["Customer 3", "Customer 5", "Customer 8"],
+        )
+        self.assertEqual(Customer.objects.count(), 8)
+        # 2 email lookups + 2 inserts (plus savepoint bookkeeping), never one per row
+        self.assertLess(len([q for q in queries.captured_queries if "SAVEPOINT" not in q["sql"]]), 8)
+
+    def test_batch_size_must_be_positive(self):
+        result = schema.execute(self.mutation, variables={"customers": [{"name": "a", "email": "a@example.com"}], "batchSize": -1})
+        self.assertEqual(result.errors[0].message, "batchSize must be at least 1")
+        self.assertFalse(Customer.objects.exists())
+
+    def test_email_taken_after_the_lookup_is_reported(self):
+        Customer.objects.create(name="racer", email="c1@example.com")
+        customers = [{"name": f"c{i}", "email": f"c{i}@example.com"} for i in range(3)]
+        real = bulk.existing_emails
+        # the concurrent writer commits between the lookup and the INSERT
+        with mock.patch("crm.bulk.existing_emails", side_effect=[set(), real({"c0@example.com", "c1@example.com", "c2@example.com"})]):
+            result = schema.execute(self.mutation, variables={"customers": customers})
+        self.assertIsNone(result.errors)
+        payload = result.data["bulkCreateCustomers"]
+        self.assertEqual(sorted(c["email"] for c in payload["customers"]), ["c0@example.com", "c2@example.com"])
+        self.assertEqual(payload["creationErrors"], ["Customer 2: this email 'c1@example.com' is already in use"])
+        self.assertEqual(Customer.objects.count(), 3)
+
+
+class CreateOrderTests(TestCase):
+    mutation = """
+        mutation ($customerId: ID!, $productIds: [ID]!) {
+            createOrder(orderData: {customerId: $customerId, productIds: $productIds}) {
+                order { totalAmount products { edges { node { name } } } }
+            }
+        }
+    """
+
+    def setUp(self):
+        self.customer = Customer.objects.create(name="buyer", email="buyer@example.com")
+        self.products = Product.objects.bulk_create(
+            Product(name=f"p{i}", price=Decimal("2.50"), stock=5) for i in range(40)
+        )
+
+    def place(self, product_ids):
+        return schema.execute(self.mutation, variables={
+            "customerId": self.customer.id,
+            "productIds": [product.id for product in product_ids],
+        })
+
+    def test_query_count_is_independent_of_basket_size(self):
+        with CaptureQueriesContext(connection) as small:
+            self.assertIsNone(self.place(self.products[:2]).errors)
+        with CaptureQueriesContext(connection) as large:
+            self.assertIsNone(self.place(self.products).errors)
+        self.assertEqual(len(small), len(large))
+
+    def test_total_and_stock_follow_quantities(self):
+        first, second = self.products[:2]
+        result = self.place([first, first, second])
+        self.assertIsNone(result.errors)
+        self.assertEqual(Decimal(result.data["createOrder"]["order"]["totalAmount"]), Decimal("7.50"))
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual((first.stock, second.stock), (3, 4))
+
+    def test_customer_of_the_new_order(self):
+        query = """
+            mutation ($customerId: ID!, $productIds: [ID]!) {
+                createOrder(orderData: {customerId: $customerId, productIds: $productIds}) {
+                    order { customer { name } }
+                }
+            }
+        """
+        variables = {"customerId": str(self.customer.id), "productIds": [self.products[0].id]}
+        body = self.client.post(
+            "/graphql/", json.dumps({"query": query, "variables": variables}), content_type="application/json"
+        ).json()
+        self.assertNotIn("errors", body)
+        self.assertEqual(body["data"]["createOrder"]["order"]["customer"], {"name": "buyer"})
+
+        variables["customerId"] = "abc"
+        result = schema.execute(query, variables=variables)
+        self.assertEqual(result.errors[0].message, "Customer does not exist")
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_overselling_is_rejected_and_rolled_back(self):
+        first, second = self.products[:2]
+        result = self.place([first] * 6 + [second])
+        self.assertIsNotNone(result.errors)
+        self.assertEqual(Order.objects.count(), 0)
+        second.refresh_from_db()
+        self.assertEqual(second.stock, 5)
+
+
+class BulkCreateOrdersTests(TestCase):
+    mutation = """
+        mutation ($orders: [OrderInput!]!) {
+            bulkCreateOrders(orderList: $orders, batchSize: 2) {
+                orders { totalAmount customer { name } }
+                creationErrors
+            }
+        }
+    """
+
+    def test_orders_are_created_with_per_item_errors(self):
+        customer = Customer.objects.create(name="buyer", email="buyer@example.com")
+        cheap, scarce = Product.objects.bulk_create([
+            Product(name="cheap", price=Decimal("1.00"), stock=100),
+            Product(name="scarce", price=Decimal("5.00"), stock=1),
+        ])
+        orders = [
+            {"customerId": customer.id, "productIds": [cheap.id, scarce.id]},
+            {"customerId": customer.id, "productIds": [scarce.id]},
+            {"customerId": 999, "productIds": [cheap.id]},
+            {"customerId": customer.id, "productIds": [cheap.id, cheap.id]},
+            {"customerId": customer.id, "productIds": [999]},
+        ]
+        result = schema.execute(self.mutation, variables={"orders": orders})
+        self.assertIsNone(result.errors)
+        payload = result.data["bulkCreateOrders"]
+        self.assertEqual([order["totalAmount"] for order in payload["orders"]], ["6.00", "2.00"])
+        self.assertEqual(
+            [error.split(":")[0] for error in payload["creationErrors"]],
+            ["Order 2", "Order 3", "Order 5"],
+        )
+        self.assertEqual(Order.products.through.objects.count(), 3)
+        scarce.refresh_from_db()
+        cheap.refresh_from_db()
+        self.assertEqual((scarce.stock, cheap.stock), (0, 97))
+
+    def test_batch_size_must_be_positive(self):
+        customer = Customer.objects.create(name="buyer", email="buyer@example.com")
+        product = Product.objects.create(name="p", price=Decimal("1.00"), stock=5)
+        with self.assertRaisesMessage(ValidationError, "batchSize must be at least 1"):
+            bulk_place_orders([OrderRow(customer.id, [product.id], None)], batch_size=-1)
+        product.refresh_from_db()
+        self.assertEqual((Order.objects.count(), product.stock), (0, 5))
+
+
+class DocumentCacheTests(TestCase):
+    query = "{ hello }"
+
+    def setUp(self):
+        CRMGraphQLView.document_cache.clear()
+
+    def post(self, body):
+        response = self.client.post("/graphql/", json.dumps(body), content_type="application/json")
+        return response.json()
+
+    def test_repeated_queries_are_parsed_once(self):
+        for _ in range(3):
+            self.assertEqual(self.post({"query": self.query})["data"], {"hello": "Hello, GraphQL!"})
+        stats = CRMGraphQLView.document_cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["size"]), (2, 1, 1))
+
+    def test_automatic_persisted_queries(self):
+        extensions = {"persistedQuery": {"version": 1, "sha256Hash": query_hash(self.query)}}
+
+        body = self.post({"extensions": extensions})
+        self.assertEqual(body["errors"][0]["extensions"]["code"], "PERSISTED_QUERY_NOT_FOUND")
+
+        # registering the query once lets later requests send only the hash
+        self.assertEqual(self.post({"query": self.query, "extensions": extensions})["data"], {"hello": "Hello, GraphQL!"})
+        self.assertEqual(self.post({"extensions": extensions})["data"], {"hello": "Hello, GraphQL!"})
+
+    def test_documents_are_cached_per_schema(self):
+        class Query(graphene.ObjectType):
+            ping = graphene.String()
+
+        other = CRMGraphQLView(schema=graphene.Schema(query=Query))
+        document, errors = CRMGraphQLView(schema=schema).get_document(self.query)
+        self.assertEqual(errors, [])
+        # valid for the project schema, not for one without `hello`
+        _, errors = other.get_document(self.query)
+        self.assertEqual(len(errors), 1)
+        self.assertIs(CRMGraphQLView(schema=schema).get_document(self.query)[0], document)
+
+    def test_hash_mismatch_is_rejected(self):
+        extensions = {"persistedQuery": {"version": 1, "sha256Hash": "0" * 64}}
+        body = self.post({"query": self.query, "extensions": extensions})
+        self.assertEqual(body["errors"][0]["message"], "provided sha does not match query")
+
+
+class WarmupTests(TestCase):
+    def setUp(self):
+        CRMGraphQLView.document_cache.clear()
+
+    def test_one_schema(self):
+        self.assertIs(project_schema.get_schema(), schema)
+        self.assertIs(graphene_settings.SCHEMA, schema)
+
+    def test_warm_up_caches_the_shipped_documents(self):
+        query = "query Hello { hello }"
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        os.makedirs(os.path.join(directory, "pages"))
+        with open(os.path.join(directory, "pages", "hello.graphql"), "w") as file:
+            file.write(query)
+
+        timings = warm_up({"ENABLED": True, "INTROSPECTION": True, "DOCUMENTS": [directory]})
+        self.assertEqual(list(timings), ["urlconf", "schema", "introspection", "documents"])
+        # a persisted query the client never registered is found
+        extensions = {"persistedQuery": {"version": 1, "sha256Hash": query_hash(query)}}
+        response = self.client.post("/graphql/", json.dumps({"extensions": extensions}), content_type="application/json")
+        self.assertEqual(response.json()["data"], {"hello": "Hello, GraphQL!"})
+
+    def test_parse_importtime(self):
+        imports = parse_importtime(
+            "import time: self [us] | cumulative | imported package\n"
+            "import time:       120 |        120 |     crm.caching\n"
+            "import time:      3951 |       4071 | crm.feed\n"
+        )
+        self.assertEqual([(i.module, i.depth, i.cumulative_us) for i in imports], [("crm.caching", 2, 120), ("crm.feed", 0, 4071)])
+
+
+class KeysetPaginationTests(TestCase):
+    query = """
+        query ($after: String, $before: String, $first: Int, $last: Int) {
+            allOrders(keyset: true, first: $first, last: $last, after: $after, before: $before) {
+                totalCount
+                pageInfo { endCursor startCursor hasNextPage hasPreviousPage }
+                edges { node { id totalAmount } }
+            }
+        }
+    """
+
+    def page(self, **variables):
+        result = schema.execute(self.query, variables=variables)
+        self.assertIsNone(result.errors)
+        return result.data["allOrders"]
+
+    def test_pages_walk_the_whole_table_without_counting(self):
+        seed_orders(25)
+        seen, after = [], None
+        for _ in range(5):
+            with CaptureQueriesContext(connection) as queries:
+                page = self.page(first=10, after=after)
+            self.assertFalse(any("COUNT(" in q["sql"] for q in queries.captured_queries))
+            self.assertIsNone(page["totalCount"])
+            seen.extend(edge["node"]["id"] for edge in page["edges"])
+            if not page["pageInfo"]["hasNextPage"]:
+                break
+            after = page["pageInfo"]["endCursor"]
+        else:
+            self.fail("keyset pagination never reached the last page")
+        self.assertEqual(len(seen), 25)
+        self.assertEqual(len(set(seen)), 25)
+
+    def test_backwards_paging(self):
+        seed_orders(5)
+        forward = self.page(first=5)
+        last_two = self.page(last=2, before=forward["pageInfo"]["endCursor"])
+        self.assertEqual(
+            [edge["node"]["id"] for edge in last_two["edges"]],
+            [edge["node"]["id"] for edge in forward["edges"][2:4]],
+        )
+        self.assertTrue(last_two["pageInfo"]["hasPreviousPage"])
+
+    def test_offset_mode_still_counts(self):
+        seed_orders(3)
+        result = schema.execute("{ allProducts(first: 1) { totalCount edges { node { name } } } }")
+        self.assertIsNone(result.errors)
+        self.assertEqual(result.data["allProducts"]["totalCount"], 6)
+
+
+class FilterQueryPlanTests(TestCase):
+    """every index-backed filter must keep searching its index instead of scanning the table"""
+
+    indexed_filters = [
+        (CustomerFilter, {"created_at__gte": "2024-01-01T00:00:00Z"}),
+        (CustomerFilter, {"created_at__year__gte": 2024, "created_at__year__lte": 2025}),
+        (ProductFilter, {"price__gte": "10", "price__lte": "20"}),
+        (ProductFilter, {"stock__lte": 5}),
+        (OrderFilter, {"total_amount__gte": "100"}),
+        (OrderFilter, {"order_date__gte": "2024-01-01T00:00:00Z", "order_date__lte": "2024-02-01T00:00:00Z"}),
+        (OrderFilter, {"order_date__year__gte": 2024}),
+    ]
+
+    def test_indexed_filters_do_not_scan(self):
+        for filterset_class, data in self.indexed_filters:
+            with self.subTest(filterset=filterset_class.__name__, data=data):
+                filterset = filterset_class(data=data, queryset=filterset_class._meta.model.objects.all())
+                self.assertTrue(filterset.is_valid(), filterset.errors)
+                table = filterset_class._meta.model._meta.db_table
+                plan = filterset.qs.explain()
+                self.assertNotRegex(plan, rf"SCAN {table}\b", plan)
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        Customer.objects.bulk_create([
+            Customer(name="Ada Lovelace", email="ada@example.com"),
+            Customer(name="Alan Turing", email="alan@example.com"),
+            Customer(name="Grace Hopper", email="lovelace.fan@example.com"),
+        ])
+
+    def names(self, query, **variables):
+        result = schema.execute(query, variables=variables)
+        self.assertIsNone(result.errors)
+        return [edge["node"]["name"] for edge in result.data["allCustomers"]["edges"]]
+
+    def test_search_uses_the_index_and_ranks_matches(self):
+        query = "query ($q: String) { allCustomers(search: $q) { edges { node { name } } } }"
+        with CaptureQueriesContext(connection) as queries:
+            names = self.names(query, q="lovelace")
+        self.assertTrue(any("crm_customer_fts" in q["sql"] for q in queries.captured_queries))
+        self.assertEqual(set(names), {"Ada Lovelace", "Grace Hopper"})
+        self.assertEqual(self.names(query, q="TURING"), ["Alan Turing"])
+        # FTS syntax in the input is treated as plain text
+        self.assertEqual(self.names(query, q='"ada" OR *'), [])
+
+    def test_index_follows_updates_and_deletes(self):
+        query = "query ($q: String) { allCustomers(search: $q) { edges { node { name } } } }"
+        Customer.objects.filter(name="Alan Turing").update(name="Alan Kay")
+        self.assertEqual(self.names(query, q="turing"), [])
+        self.assertEqual(self.names(query, q="kay"), ["Alan Kay"])
+        Customer.objects.filter(name="Alan Kay").delete()
+        self.assertEqual(self.names(query, q="kay"), [])
+
+    def test_short_terms_fall_back_to_icontains(self):
+        query = "query ($q: String) { allCustomers(search: $q) { edges { node { name } } } }"
+        self.assertEqual(self.names(query, q="al"), ["Alan Turing"])
+
+    def test_orders_by_product_name(self):
+        # orders 1 and 3 get "product 0", order 2 gets "product 1"
+        seed_orders(3, products_per_order=1)
+        result = schema.execute('{ allOrders(productName: "duct 1") { edges { node { id } } } }')
+        self.assertIsNone(result.errors)
+        self.assertEqual(len(result.data["allOrders"]["edges"]), 1)
+
+    def test_matches_past_the_ranked_ones_are_kept(self):
+        Customer.objects.bulk_create(Customer(name=f"Lovelace {i}", email=f"l{i}@example.com") for i in range(5))
+        query = "query ($q: String) { allCustomers(search: $q) { totalCount edges { node { name } } } }"
+        with mock.patch("crm.search.MAX_SEARCH_RESULTS", 2), CaptureQueriesContext(connection) as queries:
+            result = schema.execute(query, variables={"q": "lovelace"})
+        self.assertIsNone(result.errors)
+        self.assertEqual(result.data["allCustomers"]["totalCount"], 7)
+        self.assertEqual(len(result.data["allCustomers"]["edges"]), 7)
+        # the match set is a subquery, not a list of bound ids
+        self.assertTrue(any("MATCH" in q["sql"] and "COUNT" in q["sql"] for q in queries.captured_queries))
+
+
+class QueryCostTests(TestCase):
+    def post(self, query, variables=None):
+        body = json.dumps({"query": query, "variables": variables or {}})
+        return self.client.post("/graphql/", body, content_type="application/json").json()
+
+    def test_cost_is_reported_in_extensions(self):
+        body = self.post("{ allOrders(first: 10) { edges { node { customer { name } } } } }")
+        self.assertNotIn("errors", body)
+        # allOrders + 10 * (edges + node + customer)
+        self.assertEqual(body["extensions"]["cost"]["requestedQueryCost"], 31)
+
+    def test_nested_connections_over_budget_are_rejected(self):
+        query = """
+            query ($first: Int) {
+                allOrders(first: $first) { edges { node {
+                    products(first: $first) { edges { node { name } } }
+                } } }
+            }
+        """
+        # 1 + 100 * (edges + node + 1 + 100 * (edges + node)) = 20301
+        self.assertNotIn("errors", self.post(query, {"first": 100}))
+        with self.settings(GRAPHQL_MAX_QUERY_COST=10000):
+            with CaptureQueriesContext(connection) as queries:
+                body = self.post(query, {"first": 100})
+            self.assertEqual(len(queries), 0)
+            self.assertIn("exceeds the maximum cost", body["errors"][0]["message"])
+            self.assertEqual(body["extensions"]["cost"]["requestedQueryCost"], 20301)
+            # a smaller page fits the same budget
+            self.assertNotIn("errors", self.post(query, {"first": 10}))
+
+    def test_page_size_and_depth_limits(self):
+        body = self.post("{ allCustomers(first: 1000) { edges { node { name } } } }")
+        self.assertIn("maximum page size", body["errors"][0]["message"])
+
+        deep = "{ allOrders(first: 1) { edges { node { products(first: 1) { edges { node { id } } } } } } }"
+        self.assertNotIn("errors", self.post(deep))
+        with self.settings(GRAPHQL_MAX_QUERY_DEPTH=4):
+            self.assertIn("maximum depth", self.post(deep)["errors"][0]["message"])
+
+
+class TracingTests(TestCase):
+    query = "{ allOrders(first: 5) { edges { node { totalAmount } } } }"
+
+    def post(self, **headers):
+        body = json.dumps({"query": self.query})
+        return self.client.post("/graphql/", body, content_type="application/json", headers=headers).json()
+
+    @override_settings(GRAPHQL_TRACING={"ALLOW_CLIENT_REQUEST": True, "LOG": False})
+    def test_trace_reports_resolvers_and_sql_per_field(self):
+        seed_orders(5)
+        self.assertNotIn("tracing", self.post()["extensions"])
+        # the header is ignored for anyone but staff
+        self.assertNotIn("tracing", self.post(**{"X-GraphQL-Trace": "1"})["extensions"])
+        self.client.force_login(User.objects.create_user("staff", is_staff=True))
+
+        tracing = self.post(**{"X-GraphQL-Trace": "1"})["extensions"]["tracing"]
+        self.assertEqual(tracing["version"], 1)
+        paths = [resolver["path"] for resolver in tracing["execution"]["resolvers"]]
+        self.assertIn(["allOrders"], paths)
+        self.assertIn(["allOrders", "edges", 0, "node", "totalAmount"], paths)
+        # count + page, the planner deferred customer_id so nothing is touched per row
+        self.assertEqual(tracing["sql"]["byField"]["allOrders"]["count"], 2)
+        self.assertEqual(tracing["sql"]["duplicates"], [])
+
+    @override_settings(GRAPHQL_TRACING={"SAMPLE_RATE": 1.0, "INCLUDE_IN_RESPONSE": True, "LOG": False})
+    def test_repeated_sql_on_a_field_is_flagged(self):
+        tracer = Tracer(duplicate_threshold=3)
+        token = current_path.set(("allOrders", "edges", 0, "node", "customer"))
+        try:
+            with tracer.capture_sql():
+                for customer in Customer.objects.bulk_create(
+                    Customer(name=f"c{i}", email=f"c{i}@example.com") for i in range(3)
+                ):
+                    Customer.objects.get(pk=customer.pk)
+        finally:
+            current_path.reset(token)
+        duplicates = tracer.report()["sql"]["duplicates"]
+        self.assertEqual(len(duplicates), 1)
+        self.assertEqual(duplicates[0]["field"], "allOrders.edges.node.customer")
+        self.assertIn("tracing", self.post()["extensions"])
+
+
+class AsyncViewTests(TransactionTestCase):
+    # root fields run in worker threads with their own connections, so the data has to be committed
+
+    async def post(self, query, variables=None):
+        body = json.dumps({"query": query, "variables": variables or {}})
+        response = await self.async_client.post("/graphql/async/", body, content_type="application/json")
+        return response.json()
+
+    async def test_root_fields_and_relations_resolve_asynchronously(self):
+        await sync_to_async(seed_orders)(5)
+        body = await self.post("""{
+            hello
+            allCustomers(first: 5) { edges { node { name } } }
+            allOrders(first: 5) { edges { node { customer { email } products { edges { node { name } } } } } }
+        }""")
+        self.assertNotIn("errors", body)
+        self.assertEqual(body["data"]["hello"], "Hello, GraphQL!")
+        self.assertEqual(len(body["data"]["allCustomers"]["edges"]), 5)
+        orders = body["data"]["allOrders"]["edges"]
+        self.assertEqual(orders[0]["node"]["customer"]["email"], "customer0@example.com")
+        self.assertEqual(len(orders[0]["node"]["products"]["edges"]), 3)
+
+    async def test_filtered_relation(self):
+        await sync_to_async(seed_orders)(5)
+        # a filter on a nested connection turns the prefetched list back into a queryset
+        body = await self.post("""{
+            allOrders(first: 5, keyset: true) { edges { node { products(name_Icontains: "product 1") { edges { node { name } } } } } }
+        }""")
+        self.assertNotIn("errors", body)
+        self.assertEqual(len(body["data"]["allOrders"]["edges"]), 5)
+
+    async def test_mutations(self):
+        body = await self.post(
+            'mutation { createCustomer(customerData: {name: "a", email: "a@example.com"}) { customer { id } } }'
+        )
+        self.assertNotIn("errors", body)
+        body = await self.post(
+            'mutation { createProduct(productData: {name: "p", price: "2.00", stock: 3}) { product { id } } }'
+        )
+        self.assertNotIn("errors", body)
+        customer = await Customer.objects.aget(email="a@example.com")
+        product = await Product.objects.aget(name="p")
+        body = await self.post(
+            "mutation ($c: ID!, $p: [ID]!) { createOrder(orderData: {customerId: $c, productIds: $p}) { order { totalAmount } } }",
+            {"c": customer.id, "p": [product.id, product.id]},
+        )
+        self.assertNotIn("errors", body)
+        self.assertEqual(body["data"]["createOrder"]["order"]["totalAmount"], "4.00")
+
+    async def test_batch(self):
+        await sync_to_async(seed_orders)(5)
+        orders = "{ allOrders(first: 5) { edges { node { customer { email } products { edges { node { name } } } } } } }"
+        body = json.dumps([
+            {"query": orders, "id": "a"},
+            {"query": "{ allCustomers(first: 5) { edges { node { email } } } }", "id": "b"},
+            {"query": 'mutation { createProduct(productData: {name: "p", price: "2.00", stock: 3}) { product { name } } }'},
+            {"query": orders, "id": "c"},
+        ])
+        response = await self.async_client.post("/graphql/async/", body, content_type="application/json")
+        results = response.json()
+        self.assertEqual([result["id"] for result in results], ["a", "b", None, "c"])
+        self.assertTrue(all("errors" not in result for result in results), results)
+        self.assertEqual(results[0]["data"], results[3]["data"])
+        self.assertEqual(results[0]["data"]["allOrders"]["edges"][0]["node"]["customer"]["email"], "customer0@example.com")
+        self.assertEqual(results[2]["data"]["createProduct"]["product"]["name"], "p")
+
+    @override_settings(GRAPHQL_TRACING={"ALLOW_CLIENT_REQUEST": True, "LOG": False})
+    async def test_trace_captures_the_sql_of_worker_threads(self):
+        await sync_to_async(seed_orders)(5)
+        await self.async_client.aforce_login(await User.objects.acreate(username="staff", is_staff=True))
+        body = json.dumps({"query": "{ allOrders(first: 5) { edges { node { customer { email } } } } }"})
+        response = await self.async_client.post(
+            "/graphql/async/", body, content_type="application/json", headers={"X-GraphQL-Trace": "1"}
+        )
+        tracing = response.json()["extensions"]["tracing"]
+        # count + page, read in a run_sync thread with its own connection (the planner joins the customers)
+        self.assertEqual(tracing["sql"]["byField"], {"allOrders": {"count": 2, "duration": mock.ANY}})
+        paths = [resolver["path"] for resolver in tracing["execution"]["resolvers"]]
+        self.assertIn(["allOrders", "edges", 0, "node", "customer"], paths)
+
+
+class FastPathTests(TestCase):
+    """FastExecutionContext must answer exactly like graphql-core's executor"""
+
+    def execute_both(self, query, graphql_schema=None):
+        graphql_schema = graphql_schema or schema.graphql_schema
+        document = parse(query)
+        plain = execute(graphql_schema, document)
+        fast = execute(graphql_schema, document, execution_context_class=FastExecutionContext)
+        self.assertEqual(fast.data, plain.data)
+        self.assertEqual([error.formatted for error in fast.errors or []], [error.formatted for error in plain.errors or []])
+        return fast
+
+    def test_pages_match_the_executor(self):
+        seed_orders(5)
+        Customer.objects.filter(name="customer 1").update(phone="+15550001", last_order_date=datetime.datetime(2025, 1, 2, tzinfo=datetime.timezone.utc))
+        result = self.execute_both("""{
+            allCustomers(first: 5) {
+                totalCount
+                pageInfo { hasNextPage endCursor }
+                edges { cursor node { __typename id name email phone createdAt orderCount lifetimeTotal lastOrderDate } }
+            }
+            allOrders(first: 5) {
+                edges { node { ...order customer { id mail: email } products(first: 2) { edges { node { id price stock } } } } }
+            }
+        }
+        fragment order on OrderType { id orderDate totalAmount }""")
+        self.assertIsNone(result.errors)
+        self.assertEqual(len(result.data["allCustomers"]["edges"]), 5)
+        self.assertEqual(result.data["allOrders"]["edges"][0]["node"]["totalAmount"], "29.97")
+
+    def test_bad_values_get_the_executors_errors(self):
+        class Query(graphene.ObjectType):
+            customer = graphene.Field(CustomerType)
+            customers = graphene.List(graphene.NonNull(CustomerType))
+
+            def resolve_customer(root, info):
+                # name is non-null
+                return Customer(pk=1, name=None, email="a@example.com")
+
+            def resolve_customers(root, info):
+                return [Customer(pk=2, name="b", email="b@example.com"), Customer(pk=3, name=None, email="c@example.com")]
+
+        result = self.execute_both(
+            "{ customer { id email name } customers { id name } }",
+            graphene.Schema(query=Query, types=[CustomerType]).graphql_schema,
+        )
+        self.assertEqual(result.data, {"customer": None, "customers": None})
+        self.assertEqual([error.path for error in result.errors], [["customer", "name"], ["customers", 1, "name"]])
+
+    def test_view_response(self):
+        seed_orders(3)
+        query = "{ allProducts(first: 3) { edges { node { id name price stock } } } }"
+        response = self.client.post("/graphql/", json.dumps({"query": query}), content_type="application/json")
+        self.assertEqual(response.json()["data"], schema.execute(query).data)
+        pretty = self.client.post("/graphql/?pretty=1", json.dumps({"query": query}), content_type="application/json")
+        self.assertIn(b"\n  ", pretty.content)
+
+
+class BatchRequestTests(TestCase):
+    """a JSON array body runs every operation in one request"""
+
+    def post(self, body):
+        return self.client.post("/graphql/", json.dumps(body), content_type="application/json")
+
+    def test_operations_run_in_order(self):
+        response = self.post([
+            {"query": "{ hello }", "id": 1},
+            {"query": 'mutation { createCustomer(customerData: {name: "a", email: "a@example.com"}) { message } }', "id": 2},
+            {"query": "{ allCustomers { totalCount } }", "id": 3},
+            {"query": "{ nope }", "id": 4},
+        ])
+        results = response.json()
+        self.assertEqual(response.status_code, 400)  # the worst status of the batch
+        self.assertEqual([(result["id"], result["status"]) for result in results], [(1, 200), (2, 200), (3, 200), (4, 400)])
+        self.assertEqual(results[0]["data"], {"hello": "Hello, GraphQL!"})
+        self.assertEqual(results[2]["data"]["allCustomers"]["totalCount"], 1)
+
+    def test_single_operation_is_unchanged(self):
+        body = self.post({"query": "{ hello }"}).json()
+        self.assertEqual(body["data"], {"hello": "Hello, GraphQL!"})
+        self.assertNotIn("id", body)
+
+    def test_repeated_query_runs_once(self):
+        seed_orders(5)
+        query = "query ($first: Int) { allOrders(first: $first) { edges { node { customer { email } } } } }"
+        with CaptureQueriesContext(connection) as single:
+            self.post({"query": query, "variables": {"first": 5}})
+        with CaptureQueriesContext(connection) as batch:
+            results = self.post([
+                {"query": query, "variables": {"first": 5}},
+                {"query": query, "variables": {"first": 5}},
+                {"query": query, "variables": {"first": 2}},
+            ]).json()
+        self.assertEqual(results[0]["data"], results[1]["data"])
+        self.assertEqual(len(results[2]["data"]["allOrders"]["edges"]), 2)
+        self.assertEqual(len(batch), 2 * len(single))
+
+    def test_mutation_forgets_earlier_results(self):
+        count = {"query": "{ allCustomers { totalCount } }"}
+        results = self.post([
+            count,
+            {"query": 'mutation { createCustomer(customerData: {name: "a", email: "a@example.com"}) { message } }'},
+            count,
+        ]).json()
+        self.assertEqual([results[0]["data"], results[2]["data"]], [
+            {"allCustomers": {"totalCount": 0}}, {"allCustomers": {"totalCount": 1}},
+        ])
+
+    @override_settings(GRAPHQL_BATCH={"MAX_OPERATIONS": 2})
+    def test_limits(self):
+        response = self.post([{"query": "{ hello }"}] * 3)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("at most 2", response.json()["errors"][0]["message"])
+        self.assertEqual(self.post([{"query": "{ hello }"}, "{ hello }"]).status_code, 400)
+        self.assertEqual(self.post([]).status_code, 400)
+
+    @override_settings(GRAPHQL_MAX_QUERY_COST=100)
+    def test_batch_shares_one_cost_budget(self):
+        # 1 + 10 * (edges + node + customer) = 31 each, fine on its own
+        orders = {"query": "{ allOrders(first: 10) { edges { node { customer { name } } } } }"}
+        self.assertEqual(self.post([orders] * 3).status_code, 200)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post([orders] * 4)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Batch cost 124 exceeds the maximum cost of 100", response.json()["errors"][0]["message"])
+        self.assertEqual(len(queries), 0)
+
+
+@override_settings(DATABASE_READ_REPLICAS={"ALIASES": {"replica1": 2, "replica2": 1}})
+class ReplicaRoutingTests(TestCase):
+    databases = {"default", "replica1", "replica2"}
+    names = "{ allCustomers { edges { node { name } } } }"
+
+    def setUp(self):
+        # tell the databases apart by what they hold
+        for alias in self.databases:
+            Customer.objects.using(alias).create(name=alias, email=f"{alias}@example.com")
+
+    def post(self, body):
+        return self.client.post("/graphql/", json.dumps(body), content_type="application/json")
+
+    def read_names(self, body=None):
+        edges = self.post(body or {"query": self.names}).json()["data"]["allCustomers"]["edges"]
+        return sorted(edge["node"]["name"] for edge in edges)
+
+    def test_weighted_round_robin(self):
+        picker = WeightedRoundRobin({"a": 2, "b": 1})
+        self.assertEqual([picker.next() for _ in range(6)], ["a", "b", "a", "a", "b", "a"])
+
+    def test_queries_read_from_replicas(self):
+        with CaptureQueriesContext(connection) as primary:
+            names = [self.read_names()[0] for _ in range(3)]
+        self.assertEqual(sorted(names), ["replica1", "replica1", "replica2"])
+        self.assertEqual(len(primary), 0)
+
+    @override_settings(DATABASE_READ_REPLICAS={})
+    def test_no_replicas_reads_from_primary(self):
+        self.assertEqual(self.read_names(), ["default"])
+
+    def test_mutation_pins_the_client_to_the_primary(self):
+        create = 'mutation { createCustomer(customerData: {name: "new", email: "new@example.com"}) { message } }'
+        with CaptureQueriesContext(connections["replica1"]) as replica1, \
+                CaptureQueriesContext(connections["replica2"]) as replica2:
+            response = self.post({"query": create})
+        self.assertEqual(len(replica1) + len(replica2), 0)
+        self.assertIn("crm_primary_until", response.cookies)
+        # the client's next query sees its write
+        self.assertEqual(self.read_names(), ["default", "new"])
+        # and once the window is over it is back on the replicas
+        self.client.cookies["crm_primary_until"] = str(time.time() - 1)
+        self.assertNotIn("new", self.read_names())
+
+    def test_queries_after_a_mutation_in_a_batch_read_from_the_primary(self):
+        results = self.post([
+            {"query": self.names},
+            {"query": 'mutation { createCustomer(customerData: {name: "new", email: "new@example.com"}) { message } }'},
+            {"query": self.names},
+        ]).json()
+        names = [sorted(edge["node"]["name"] for edge in result["data"]["allCustomers"]["edges"]) for result in (results[0], results[2])]
+        self.assertIn(names[0], (["replica1"], ["replica2"]))
+        self.assertEqual(names[1], ["default", "new"])
+
+    @override_settings(GRAPHQL_RESPONSE_CACHE={"ENABLED": True})
+    def test_replica_reads_are_not_cached(self):
+        get_response_cache().clear()
+        self.read_names()
+        self.read_names()
+        self.assertEqual(get_response_cache().stats()["hits"], 0)
+
+
+class ReplicaSyncTests(TransactionTestCase):
+    databases = {"default", "replica1"}
+
+    def test_sync_replicas_copies_the_primary(self):
+        Customer.objects.create(name="a", email="a@example.com")
+        call_command("sync_replicas", "replica1", stdout=io.StringIO())
+        self.assertEqual(list(Customer.objects.using("replica1").values_list("email", flat=True)), ["a@example.com"])
+
+    @override_settings(DATABASE_READ_REPLICAS={"ALIASES": {"replica1": 1}})
+    async def test_async_resolvers_read_from_the_replica(self):
+        await Customer.objects.using("replica1").acreate(name="replica", email="r@example.com")
+        body = json.dumps({"query": "{ allCustomers { edges { node { name } } } }"})
+        response = await self.async_client.post("/graphql/async/", body, content_type="application/json")
+        self.assertEqual(response.json()["data"]["allCustomers"]["edges"], [{"node": {"name": "replica"}}])
+
+
+@override_settings(GRAPHQL_RESPONSE_CACHE={"ENABLED": True})
+class ResponseCacheTests(TestCase):
+    products = "{ allProducts(first: 10) { edges { node { name stock } } } }"
+    customers = "{ allCustomers(first: 10) { edges { node { name } } } }"
+
+    def setUp(self):
+        get_response_cache().clear()
+        seed_orders(2)
+
+    def post(self, query, variables=None):
+        body = json.dumps({"query": query, "variables": variables or {}})
+        return self.client.post("/graphql/", body, content_type="application/json").json()
+
+    def assert_cached(self, query, cached=True):
+        with CaptureQueriesContext(connection) as queries:
+            body = self.post(query)
+        self.assertNotIn("errors", body)
+        self.assertEqual(len(queries) == 0, cached, [q["sql"] for q in queries])
+        return body
+
+    def test_repeated_and_reformatted_queries_hit(self):
+        self.assert_cached(self.products, cached=False)
+        self.assert_cached(self.products)
+        self.assert_cached("{allProducts(first:10){edges{node{name stock}}}}")
+        self.assertEqual(get_response_cache().stats()["hit_ratio"], 2 / 3)
+
+    def test_mutation_evicts_only_affected_entries(self):
+        self.assert_cached(self.products, cached=False)
+        self.assert_cached(self.customers, cached=False)
+        self.post('mutation { createProduct(productData: {name: "new", price: "1.00"}) { product { id } } }')
+
+        body = self.assert_cached(self.products, cached=False)
+        self.assertIn({"node": {"name": "new", "stock": 0}}, body["data"]["allProducts"]["edges"])
+        self.assert_cached(self.customers)
+
+    def test_stock_update_without_signals_evicts(self):
+        body = self.assert_cached(self.products, cached=False)
+        product = Product.objects.get(name=body["data"]["allProducts"]["edges"][0]["node"]["name"])
+        customer = Customer.objects.first()
+        self.post(
+            "mutation ($c: ID!, $p: [ID]!) { createOrder(orderData: {customerId: $c, productIds: $p}) { order { id } } }",
+            {"c": customer.id, "p": [product.id]},
+        )
+        body = self.assert_cached(self.products, cached=False)
+        self.assertEqual(body["data"]["allProducts"]["edges"][0]["node"]["stock"], product.stock - 1)
+
+    def test_filters_depend_on_related_models(self):
+        document = parse('{ allOrders(customerName: "a") { edges { node { totalAmount } } } }')
+        self.assertEqual(
+            selected_models(schema.graphql_schema, document), ("crm.customer", "crm.order", "crm.product")
+        )
+        document = parse("{ allOrders { totalCount } }")
+        self.assertEqual(selected_models(schema.graphql_schema, document), ("crm.order",))
+
+    @override_settings(GRAPHQL_RESPONSE_CACHE={"ENABLED": True, "BACKEND": "django"})
+    def test_django_cache_backend(self):
+        get_response_cache().clear()
+        self.assert_cached(self.customers, cached=False)
+        self.assert_cached(self.customers)
+        Customer.objects.create(name="new", email="new@example.com")
+        self.assert_cached(self.customers, cached=False)
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        seed_orders(5)
+        self.client.force_login(User.objects.create_user("staff", is_staff=True))
+
+    def get(self, path, **params):
+        response = self.client.get(path, params)
+        content = b"".join(response.streaming_content).decode() if response.streaming else response.content.decode()
+        return response, content
+
+    def test_orders_csv(self):
+        response, content = self.get("/crm/export/orders/")
+        self.assertEqual(response["Content-Type"], "text/csv")
+        lines = list(csv.reader(io.StringIO(content)))
+        self.assertEqual(lines[0], ["id", "order_date", "total_amount", "customer_id", "customer_name", "product_ids"])
+        self.assertEqual(len(lines), 6)
+        order = Order.objects.order_by("pk").first()
+        self.assertEqual(lines[1][4], order.customer.name)
+        self.assertEqual(sorted(map(int, lines[1][5].split())), sorted(order.products.values_list("id", flat=True)))
+
+    def test_orders_are_filtered_with_the_filterset(self):
+        response, content = self.get("/crm/export/orders/", format="ndjson", customer_name="customer 3")
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([row["customer_name"] for row in rows], ["customer 3"])
+        self.assertEqual(len(rows[0]["product_ids"]), 3)
+
+    def test_queries_per_chunk(self):
+        # one query for the rows, plus one through-table query per chunk
+        with CaptureQueriesContext(connection) as queries:
+            list(order_rows(Order.objects.all(), chunk_size=2))
+        self.assertEqual(len(queries), 1 + 3)
+
+    def test_customers_and_bad_parameters(self):
+        response, content = self.get("/crm/export/customers/", format="ndjson")
+        self.assertEqual(len(content.splitlines()), 5)
+        response, _ = self.get("/crm/export/customers/", format="xml")
+        self.assertEqual(response.status_code, 400)
+        response, _ = self.get("/crm/export/orders/", total_amount__gte="lots")
+        self.assertEqual(response.status_code, 400)
+
+    def test_staff_only(self):
+        self.client.logout()
+        for path in ("/crm/export/customers/", "/crm/export/orders/"):
+            response, _ = self.get(path)
+            self.assertEqual(response.status_code, 302)
+            self.assertIn("/admin/login/", response["Location"])
+        self.client.force_login(User.objects.create_user("clerk"))
+        self.assertEqual(self.get("/crm/export/customers/")[0].status_code, 302)
+
+
+class ImportCSVTests(TestCase):
+    def run_import(self, kind, text, *args):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, f"{kind}.csv")
+        with open(path, "w", newline="") as file:
+            file.write(text)
+        call_command("import_csv", kind, path, "--batch-size", "2", *args, stdout=io.StringIO())
+        rejected_path = f"{path}.rejected.csv"
+        if not os.path.exists(rejected_path):
+            return []
+        with open(rejected_path, newline="") as file:
+            return list(csv.DictReader(file))
+
+    def test_customers_are_validated_and_upserted(self):
+        Customer.objects.create(name="old name", email="ann@example.com")
+        rejected = self.run_import("customers", (
+            "name,email,phone\n"
+            "Ann,ann@example.com,+1234567890\n"
+            "Bob,bob@example.com,not a phone\n"
+            "Cid,cid@example.com,\n"
+            "Cid again,cid@example.com,\n"
+            "Dee,not-an-email,\n"
+        ))
+        self.assertEqual(Customer.objects.get(email="ann@example.com").name, "Ann")
+        self.assertTrue(Customer.objects.filter(email="cid@example.com", name="Cid").exists())
+        self.assertEqual(Customer.objects.count(), 2)
+        self.assertEqual([(row["line"], row["email"]) for row in rejected],
+                         [("3", "bob@example.com"), ("5", "cid@example.com"), ("6", "not-an-email")])
+
+    def test_existing_rows_are_rejected_without_update(self):
+        Customer.objects.create(name="old name", email="ann@example.com")
+        rejected = self.run_import("customers", "name,email\nAnn,ann@example.com\n", "--no-update")
+        self.assertEqual(rejected[0]["error"], "this email 'ann@example.com' is already in use")
+        self.assertEqual(Customer.objects.get().name, "old name")
+
+    def test_products_in_parallel(self):
+        rejected = self.run_import("products", (
+            "name,price,stock\n"
+            "a,1.50,3\n"
+            "b,0,1\n"
+            "c,2.00,-1\n"
+            "d,abc,1\n"
+            "e,3.00,\n"
+            "f,NaN,1\n"
+            "g,1e20,1\n"
+            "h,1.005,1\n"
+        ), "--workers", "2")
+        self.assertEqual(sorted(Product.objects.values_list("name", "stock")), [("a", 3), ("e", 0)])
+        self.assertEqual([row["error"] for row in rejected], [
+            "price  must be greater than 0", "stock cannot be negative", "price is not a number",
+            "price is not a number",
+            "price: Ensure that there are no more than 10 digits in total.",
+            "price: Ensure that there are no more than 2 decimal places.",
+        ])
+
+    def test_batch_size_must_be_positive(self):
+        with self.assertRaisesMessage(CommandError, "batchSize must be at least 1"):
+            self.run_import("products", "name,price,stock\na,1.50,3\n", "--batch-size", "-1")
+
+    def test_orders(self):
+        customer = Customer.objects.create(name="Ann", email="ann@example.com")
+        first, second = Product.objects.bulk_create([
+            Product(name="a", price=Decimal("1.50"), stock=1), Product(name="b", price=Decimal("2.00"), stock=1),
+        ])
+        rejected = self.run_import("orders", (
+            "customer_email,customer_id,product_ids,order_date,total_amount\n"
+            f"ann@example.com,,{first.id} {second.id} {second.id},2024-05-01T10:00:00,\n"
+            f",{customer.id},{first.id},,9.99\n"
+            f"nobody@example.com,,{first.id},,\n"
+            f",{customer.id},999999,,\n"
+        ))
+        orders = list(Order.objects.order_by("pk"))
+        self.assertEqual([order.total_amount for order in orders], [Decimal("5.50"), Decimal("9.99")])
+        self.assertEqual(orders[0].order_date.year, 2024)
+        self.assertEqual(sorted(orders[0].products.values_list("id", flat=True)), [first.id, second.id])
+        self.assertEqual([row["line"] for row in rejected], ["4", "5"])
+        # history, stock is left alone
+        self.assertEqual(Product.objects.get(pk=first.pk).stock, 1)
+
+
+class CustomerStatsTests(TestCase):
+    def setUp(self):
+        self.ann, self.bob = Customer.objects.bulk_create([
+            Customer(name="Ann", email="ann@example.com"), Customer(name="Bob", email="bob@example.com"),
+        ])
+        self.product = Product.objects.create(name="p", price=Decimal("10.00"), stock=100)
+
+    def test_orders_update_the_aggregates(self):
+        first = place_order(self.ann.id, [self.product.id])
+        place_order(self.ann.id, [self.product.id, self.product.id])
+        bulk_place_orders([
+            OrderRow(self.bob.id, [self.product.id], None), OrderRow(self.ann.id, [self.product.id], None),
+        ])
+        self.ann.refresh_from_db()
+        self.bob.refresh_from_db()
+        self.assertEqual((self.ann.order_count, self.ann.lifetime_total), (3, Decimal("40.00")))
+        self.assertEqual((self.bob.order_count, self.bob.lifetime_total), (1, Decimal("10.00")))
+        self.assertGreater(self.ann.last_order_date, first.order_date)
+
+    def test_rebuild_matches_incremental_updates(self):
+        place_order(self.ann.id, [self.product.id])
+        place_order(self.bob.id, [self.product.id, self.product.id])
+        expected = list(Customer.objects.order_by("pk").values_list("order_count", "lifetime_total", "last_order_date"))
+        Customer.objects.update(order_count=0, lifetime_total=0, last_order_date=None)
+        call_command("rebuild_customer_stats", "--batch-size", "1", stdout=io.StringIO())
+        actual = list(Customer.objects.order_by("pk").values_list("order_count", "lifetime_total", "last_order_date"))
+        self.assertEqual(actual, expected)
+
+    def test_top_customers_query(self):
+        place_order(self.bob.id, [self.product.id, self.product.id])
+        place_order(self.ann.id, [self.product.id])
+        result = schema.execute(
+            '{ allCustomers(orderBy: "-lifetimeTotal", orderCount_Gte: 1) { edges { node { name lifetimeTotal } } } }'
+        )
+        self.assertIsNone(result.errors)
+        names = [edge["node"]["name"] for edge in result.data["allCustomers"]["edges"]]
+        self.assertEqual(names, ["Bob", "Ann"])
+
+        plan = Customer.objects.order_by("-lifetime_total", "-id")[:10].explain()
+        self.assertIn("crm_customer_spend_idx", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+
+class SalesSummaryTests(TestCase):
+    query = """
+        query ($groupBy: SalesGroupBy, $from: Date, $productId: ID, $customerId: ID) {
+            salesSummary(groupBy: $groupBy, from: $from, productId: $productId, customerId: $customerId) {
+                period orderCount units revenue
+            }
+        }
+    """
+
+    def setUp(self):
+        self.ann, self.bob = Customer.objects.bulk_create([
+            Customer(name="Ann", email="ann@example.com"), Customer(name="Bob", email="bob@example.com"),
+        ])
+        self.pen, self.ink = Product.objects.bulk_create([
+            Product(name="pen", price=Decimal("2.00"), stock=100), Product(name="ink", price=Decimal("5.00"), stock=100),
+        ])
+        day = datetime.datetime(2024, 1, 30, 12, tzinfo=datetime.timezone.utc)
+        place_order(self.ann.id, [self.pen.id, self.pen.id, self.ink.id], order_date=day)
+        place_order(self.bob.id, [self.pen.id], order_date=day)
+        place_order(self.ann.id, [self.ink.id], order_date=day + datetime.timedelta(days=3))
+
+    def summary(self, **variables):
+        result = schema.execute(self.query, variables=variables)
+        self.assertIsNone(result.errors)
+        return [
+            (row["period"], row["orderCount"], row["units"], row["revenue"])
+            for row in result.data["salesSummary"]
+        ]
+
+    def test_rollups_are_updated_by_orders(self):
+        self.assertEqual(self.summary(), [
+            ("2024-01-30", 2, 4, "11.00"), ("2024-02-02", 1, 1, "5.00"),
+        ])
+        self.assertEqual(self.summary(groupBy="MONTH"), [
+            ("2024-01-01", 2, 4, "11.00"), ("2024-02-01", 1, 1, "5.00"),
+        ])
+        self.assertEqual(self.summary(groupBy="WEEK", productId=self.pen.id), [("2024-01-29", 2, 3, "6.00")])
+        self.assertEqual(self.summary(**{"from": "2024-02-01"}), [("2024-02-02", 1, 1, "5.00")])
+
+    def test_customer_summary_reads_the_orders(self):
+        self.assertEqual(self.summary(groupBy="MONTH", customerId=self.ann.id), [
+            ("2024-01-01", 1, 2, "9.00"), ("2024-02-01", 1, 1, "5.00"),
+        ])
+
+    def test_rebuild(self):
+        DailySales.objects.all().delete()
+        call_command("rebuild_sales_rollups", stdout=io.StringIO())
+        # the through table keeps no quantities, the second pen of the first order is gone
+        self.assertEqual(self.summary(), [
+            ("2024-01-30", 2, 3, "11.00"), ("2024-02-02", 1, 1, "5.00"),
+        ])
+        self.assertEqual(self.summary(productId=self.ink.id), [
+            ("2024-01-30", 1, 1, "5.00"), ("2024-02-02", 1, 1, "5.00"),
+        ])
+
+    def test_summary_reads_one_rollup_table(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.summary(groupBy="MONTH")
+        self.assertEqual(len(queries), 1)
+        self.assertIn("crm_dailysales", queries[0]["sql"])
+
+
+class BenchmarkTests(TestCase):
+    """the benchmark scenarios run, and none needs more queries than the stored baseline"""
+
+    @override_settings(ALLOWED_HOSTS=["testserver"])
+    def test_query_counts_within_baseline(self):
+        benchmarks.seed(customers=30, products=10, orders=60)
+        results = benchmarks.run(iterations=1, warmup=0)
+        baseline = benchmarks.load_baseline()
+        self.assertEqual(set(results), set(baseline["scenarios"]), "regenerate the baseline with --save-baseline")
+        self.assertEqual(benchmarks.compare(results, baseline, timings=False), [])
+
+    def test_compare(self):
+        baseline = {"scenarios": {"page": {"p50_ms": 10, "p99_ms": 20, "queries": 2, "peak_kib": 100}}}
+        noisy = {"page": {"p50_ms": 15, "p99_ms": 50, "queries": 2, "peak_kib": 150}}
+        self.assertEqual(benchmarks.compare(noisy, baseline), [])
+        worse = {"page": {"p50_ms": 10, "p99_ms": 80, "queries": 3, "peak_kib": 200}}
+        self.assertEqual(len(benchmarks.compare(worse, baseline)), 3)
+        self.assertEqual(len(benchmarks.compare(worse, baseline, timings=False)), 1)
+
+    def test_year_and_month_filters_take_numbers(self):
+        benchmarks.seed(customers=3, products=3, orders=5)
+        year = Order.objects.latest("order_date").order_date.year
+        result = schema.execute(
+            "query ($year: Int) { allOrders(orderDate_Year_Gte: $year, orderDate_Month_Lte: 12) { totalCount } }",
+            variables={"year": year},
+        )
+        self.assertIsNone(result.errors)
+        self.assertGreater(result.data["allOrders"]["totalCount"], 0)
+
+
+BULK_JOB_QUERY = """
+    query ($id: ID!) { bulkJob(id: $id) { status total processed succeeded progress errors failure } }
+"""
+
+
+@override_settings(CRM_BULK_JOBS={"WORKERS": 0, "CHUNK_SIZE": 2, "PAUSE": 0})
+class BulkJobTests(TestCase):
+    mutation = """
+        mutation ($customers: [CustomerInput!]!) {
+            bulkCreateCustomers(customerList: $customers, background: true) { message job { id status } }
+        }
+    """
+
+    def job(self, job_id):
+        result = schema.execute(BULK_JOB_QUERY, variables={"id": job_id})
+        self.assertIsNone(result.errors)
+        return result.data["bulkJob"]
+
+    def test_customers_in_the_background(self):
+        customers = [{"name": f"c{i}", "email": f"c{i}@example.com"} for i in range(4)]
+        customers.append({"name": "again", "email": "c1@example.com"})
+        result = schema.execute(self.mutation, variables={"customers": customers})
+        self.assertIsNone(result.errors)
+        job_id = result.data["bulkCreateCustomers"]["job"]["id"]
+        self.assertEqual(self.job(job_id)["status"], "QUEUED")
+        self.assertEqual(Customer.objects.count(), 0)
+
+        self.assertEqual(drain(), 1)
+        self.assertEqual(self.job(job_id), {
+            "status": "DONE", "total": 5, "processed": 5, "succeeded": 4, "progress": 1.0,
+            # the position in the whole list, not in the chunk
+            "errors": ["Customer 5: this email 'c1@example.com' is already in use"], "failure": "",
+        })
+        self.assertEqual(Customer.objects.count(), 4)
+        self.assertIsNone(BulkJob.objects.get(pk=job_id).payload)
+
+    def test_orders_in_the_background(self):
+        seed_orders(1)
+        customer, product = Customer.objects.get(), Product.objects.first()
+        result = schema.execute(
+            """mutation ($orders: [OrderInput!]!) {
+                bulkCreateOrders(orderList: $orders, background: true) { job { id } }
+            }""",
+            variables={"orders": [
+                {"customerId": customer.id, "productIds": [product.id], "orderDate": "2024-03-01T10:00:00+00:00"},
+                {"customerId": 0, "productIds": [product.id]},
+                {"customerId": customer.id, "productIds": [product.id, product.id]},
+            ]},
+        )
+        self.assertIsNone(result.errors)
+        drain()
+        job = self.job(result.data["bulkCreateOrders"]["job"]["id"])
+        self.assertEqual((job["status"], job["succeeded"], job["errors"]), ("DONE", 2, ["Order 2: Customer does not exist"]))
+        self.assertEqual(Order.objects.count(), 3)
+        self.assertTrue(Order.objects.filter(order_date__year=2024).exists())
+
+    def test_stalled_job_resumes_where_it_stopped(self):
+        job = BulkJob.objects.create(
+            kind="customers", status=BulkJob.RUNNING, total=3, processed=2,
+            payload=[{"name": f"c{i}", "email": f"c{i}@example.com", "phone": None} for i in range(3)],
+            updated_at=datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc),
+        )
+        # a running job that still moves belongs to another worker
+        BulkJob.objects.create(kind="customers", status=BulkJob.RUNNING, total=1, payload=[{}])
+        self.assertEqual(drain(), 1)
+        self.assertEqual(list(Customer.objects.values_list("email", flat=True)), ["c2@example.com"])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.processed, job.succeeded), (BulkJob.DONE, 3, 1))
+
+    @override_settings(CRM_BULK_JOBS={"CHUNK_SIZE": 2, "PAUSE": 0})
+    def test_worker_backs_off_a_job_taken_over(self):
+        BulkJob.objects.create(
+            kind="customers", total=4,
+            payload=[{"name": f"c{i}", "email": f"c{i}@example.com", "phone": None} for i in range(4)],
+        )
+        job = claim_next()
+        # this worker stalled, another one claimed the job and did the first chunk meanwhile
+        BulkJob.objects.filter(pk=job.pk).update(processed=2, succeeded=2)
+        with self.assertLogs("crm.jobs", "WARNING"):
+            process(job)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.processed, job.succeeded), (BulkJob.RUNNING, 2, 2))
+        # the chunk of the worker that was taken over is rolled back
+        self.assertEqual(Customer.objects.count(), 0)
+
+    def test_batch_size_is_checked_when_queued(self):
+        result = schema.execute(
+            "mutation ($c: [CustomerInput!]!) { bulkCreateCustomers(customerList: $c, background: true, batchSize: -1) { job { id } } }",
+            variables={"c": [{"name": "a", "email": "a@example.com"}]},
+        )
+        self.assertEqual(result.errors[0].message, "batchSize must be at least 1")
+        self.assertFalse(BulkJob.objects.exists())
+
+    def test_invalid_job_id(self):
+        result = schema.execute('{ bulkJob(id: "abc") { id } }')
+        self.assertEqual(result.errors[0].message, "Invalid job id")
+        self.assertIsNone(schema.execute('{ bulkJob(id: "123456") { id } }').data["bulkJob"])
+
+    def test_failure_is_reported(self):
+        job = BulkJob.objects.create(kind="nope", total=1, payload=[{}])
+        with self.assertLogs("crm.jobs", "ERROR"):
+            drain()
+        result = self.job(job.id)
+        self.assertEqual(result["status"], "FAILED")
+        self.assertIn("nope", result["failure"])
+
+
+@override_settings(CRM_BULK_JOBS={"WORKERS": 1, "CHUNK_SIZE": 10, "PAUSE": 0})
+class BulkJobPoolTests(TransactionTestCase):
+    def test_pool_works_off_the_job(self):
+        customers = [{"name": f"c{i}", "email": f"c{i}@example.com"} for i in range(25)]
+        result = schema.execute(
+            "mutation ($c: [CustomerInput!]!) { bulkCreateCustomers(customerList: $c, background: true) { job { id } } }",
+            variables={"c": customers},
+        )
+        self.assertIsNone(result.errors)
+        job_id = result.data["bulkCreateCustomers"]["job"]["id"]
+        for _ in range(200):
+            job = BulkJob.objects.get(pk=job_id)
+            if job.status == BulkJob.DONE:
+                break
+            time.sleep(0.05)
+        self.assertEqual((job.status, job.succeeded), (BulkJob.DONE, 25))
+
+
+class ChangeFeedTests(TestCase):
+    feed = """query ($cursor: ID, $first: Int, $topics: [ChangeTopic!]) {
+        changesSince(cursor: $cursor, first: $first, topics: $topics) {
+            cursor hasMore reset
+            changes { topic order { totalAmount } product { name stock } }
+        }
+    }"""
+
+    def changes_since(self, **variables):
+        result = schema.execute(self.feed, variable_values=variables)
+        self.assertIsNone(result.errors)
+        return result.data["changesSince"]
+
+    def test_orders_and_stock_changes_since_a_cursor(self):
+        customer = Customer.objects.create(name="a", email="a@example.com")
+        product = Product.objects.create(name="p", price=Decimal("2.00"), stock=5)
+        start = self.changes_since()
+        self.assertEqual((start["changes"], start["reset"]), ([], False))
+
+        place_order(customer.id, [product.id, product.id])
+        bulk_place_orders([OrderRow(customer.id, [product.id], None)])
+        page = self.changes_since(cursor=start["cursor"])
+        self.assertEqual([change["topic"] for change in page["changes"]], [
+            "PRODUCT_STOCK_CHANGED", "ORDER_CREATED", "PRODUCT_STOCK_CHANGED", "ORDER_CREATED",
+        ])
+        self.assertEqual(page["changes"][0]["product"], {"name": "p", "stock": 2})  # as it is now
+        self.assertEqual(page["changes"][1]["order"], {"totalAmount": "4.00"})
+        self.assertFalse(page["hasMore"])
+        self.assertEqual(self.changes_since(cursor=page["cursor"])["changes"], [])
+
+        first = self.changes_since(cursor=start["cursor"], first=3, topics=["ORDER_CREATED"])
+        self.assertEqual(len(first["changes"]), 2)
+        self.assertEqual(first["cursor"], page["cursor"])
+        paged = self.changes_since(cursor=start["cursor"], first=1)
+        self.assertTrue(paged["hasMore"])
+        self.assertEqual(len(self.changes_since(cursor=paged["cursor"], first=3)["changes"]), 3)
+
+    def test_writes_without_signals_are_logged(self):
+        customer = Customer.objects.create(name="a", email="a@example.com")
+        product = Product.objects.create(name="p", price=Decimal("2.00"), stock=5)
+        cursor = feed.head()
+        Product.objects.filter(pk=product.pk).update(name="q")  # not a stock change, not logged
+        product.price = Decimal("3.00")
+        product.save(update_fields=["price"])
+        bulk_place_orders([OrderRow(customer.id, [product.id], None)] * 2)
+        self.assertEqual(
+            sorted(ChangeEvent.objects.filter(id__gt=cursor).values_list("topic", flat=True)),
+            ["order_created", "order_created", "product_stock_changed"],
+        )
+
+    def test_pruned_cursor_resets(self):
+        product = Product.objects.create(name="p", price=Decimal("2.00"), stock=5)
+        product.save()
+        product.save()
+        ChangeEvent.objects.update(created_at=datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=30))
+        old = ChangeEvent.objects.order_by("id").first().id - 1
+        self.assertEqual(feed.prune(), 2)  # the latest stays
+        page = self.changes_since(cursor=old)
+        self.assertEqual((page["changes"], page["reset"], page["cursor"]), ([], True, str(feed.head())))
+        self.assertFalse(self.changes_since(cursor=page["cursor"])["reset"])
+        self.assertIn("Invalid cursor", str(schema.execute(self.feed, variable_values={"cursor": "x"}).errors))
+
+
+class WebSocket:
+    """a websocket client driving the ASGI app in-process"""
+
+    def __init__(self, subprotocols=(PROTOCOL,), path="/graphql/"):
+        self.incoming, self.outgoing = asyncio.Queue(), asyncio.Queue()
+        scope = {"type": "websocket", "path": path, "subprotocols": list(subprotocols), "headers": []}
+        self.task = asyncio.ensure_future(websocket_application(schema)(scope, self.incoming.get, self.outgoing.put))
+
+    async def connect(self):
+        await self.incoming.put({"type": "websocket.connect"})
+        return await self.receive_raw()
+
+    async def send(self, message):
+        await self.incoming.put({"type": "websocket.receive", "text": json.dumps(message)})
+
+    async def receive_raw(self):
+        return await asyncio.wait_for(self.outgoing.get(), 5)
+
+    async def receive(self):
+        message = await self.receive_raw()
+        return json.loads(message["text"]) if "text" in message else message
+
+    async def disconnect(self):
+        await self.incoming.put({"type": "websocket.disconnect", "code": 1000})
+        await asyncio.wait_for(self.task, 5)
+
+
+class SubscriptionTests(TransactionTestCase):
+    # events are published on commit, and rows are loaded in worker threads
+
+    async def open(self):
+        socket = WebSocket()
+        self.assertEqual((await socket.connect())["subprotocol"], PROTOCOL)
+        await socket.send({"type": "connection_init"})
+        self.assertEqual(await socket.receive(), {"type": "connection_ack"})
+        return socket
+
+    async def subscribed(self, topic):
+        # the stream registers with the broker on its first read
+        for _ in range(200):
+            if feed.get_broker().subscribers.get(topic):
+                return
+            await asyncio.sleep(0.01)
+        self.fail(f"nobody subscribed to {topic}")
+
+    async def test_order_created_with_filter(self):
+        customers = await sync_to_async(Customer.objects.bulk_create)(
+            [Customer(name="alice", email="a@example.com"), Customer(name="bob", email="b@example.com")]
+        )
+        product = await Product.objects.acreate(name="p", price=Decimal("2.00"), stock=10)
+        socket = await self.open()
+        await socket.send({"id": "1", "type": "subscribe", "payload": {
+            "query": "subscription ($name: String) { orderCreated(customerName: $name) { totalAmount customer { name } } }",
+            "variables": {"name": "alice"},
+        }})
+        await self.subscribed(ChangeEvent.ORDER_CREATED)
+        await sync_to_async(place_order)(customers[1].id, [product.id])
+        await sync_to_async(place_order)(customers[0].id, [product.id, product.id])
+        message = await socket.receive()
+        self.assertEqual(message, {"id": "1", "type": "next", "payload": {
+            "data": {"orderCreated": {"totalAmount": "4.00", "customer": {"name": "alice"}}},
+        }})
+        await socket.send({"id": "1", "type": "complete"})
+        await socket.send({"type": "ping"})
+        self.assertEqual(await socket.receive(), {"type": "pong"})
+        await socket.disconnect()
+        self.assertFalse(feed.get_broker().subscribers.get(ChangeEvent.ORDER_CREATED))
+
+    @override_settings(CRM_CHANGE_FEED={"BROKER": "database", "POLL_INTERVAL": 0.02})
+    async def test_stock_changes_through_the_database_broker(self):
+        product = await Product.objects.acreate(name="p", price=Decimal("2.00"), stock=10)
+        socket = await self.open()
+        await socket.send({"id": "s", "type": "subscribe", "payload": {
+            "query": "subscription { productStockChanged(stock_Lte: 5) { name stock } }",
+        }})
+        await self.subscribed(ChangeEvent.PRODUCT_STOCK_CHANGED)
+        await asyncio.sleep(0.1)  # the poller has read the head of the log
+        # as another process would: only the change log row, nothing published here
+        await sync_to_async(Product.objects.filter(pk=product.pk).update)(stock=3)
+        await ChangeEvent.objects.acreate(topic=ChangeEvent.PRODUCT_STOCK_CHANGED, object_id=product.pk)
+        message = await socket.receive()
+        self.assertEqual(message["payload"], {"data": {"productStockChanged": {"name": "p", "stock": 3}}})
+        await socket.disconnect()
+
+    async def test_protocol_errors(self):
+        socket = WebSocket(subprotocols=["graphql-ws"])
+        self.assertEqual((await socket.connect())["code"], 4400)
+
+        socket = WebSocket()
+        await socket.connect()
+        await socket.send({"id": "1", "type": "subscribe", "payload": {"query": "subscription { orderCreated { id } }"}})
+        self.assertEqual((await socket.receive())["code"], 4401)
+
+        socket = await self.open()
+        await socket.send({"id": "1", "type": "subscribe", "payload": {"query": "{ hello }"}})
+        message = await socket.receive()
+        self.assertEqual(message["type"], "error")
+        self.assertIn("Only subscriptions", message["payload"][0]["message"])
+        await socket.send({"id": "2", "type": "subscribe", "payload": {
+            "query": 'subscription { orderCreated(totalAmount_Gte: "x") { id } }',
+        }})
+        self.assertEqual((await socket.receive())["type"], "error")
+        await socket.send({"type": "connection_init"})
+        self.assertEqual((await socket.receive())["code"], 4429)
 
-# Create your tests here.
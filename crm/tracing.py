@@ -0,0 +1,228 @@
+import contextvars
+import json
+import logging
+import random
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from inspect import isawaitable
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+
+logger = logging.getLogger("crm.tracing")
+
+# ==========
+#  per-resolver tracing and SQL instrumentation.
+#  a sampled request gets a Tracer: the graphene middleware times every
+#  resolver, a DB execute wrapper charges each SQL statement to the
+#  resolver that was running when it fired, and statements repeated for
+#  every item of a list are flagged as N+1 suspects. the result is
+#  Apollo-tracing-compatible (plus an `sql` section).
+#  the tracer and the running resolver are context variables and every
+#  connection carries the wrapper, so on the async view the SQL run in
+#  sync_to_async/run_sync threads (each with its own connection) is
+#  charged to the resolver that started the thread.
+# ==========
+
+DEFAULTS = {
+    # fraction of requests traced, 0 switches tracing off
+    "SAMPLE_RATE": 0.0,
+    # add extensions.tracing to the response of traced requests
+    "INCLUDE_IN_RESPONSE": False,
+    # let staff users force a trace with the `X-GraphQL-Trace: 1` header. the trace
+    # carries raw SQL, so nobody else gets one whatever this says
+    "ALLOW_CLIENT_REQUEST": False,
+    # same SQL on the same field this many times is reported as N+1
+    "DUPLICATE_THRESHOLD": 3,
+    # write every trace to the crm.tracing logger as JSON
+    "LOG": True,
+}
+
+
+def tracing_settings():
+    return {**DEFAULTS, **getattr(settings, "GRAPHQL_TRACING", {})}
+
+
+# the Tracer whose capture_sql() is running, and the path of the resolver being traced.
+# context variables follow the resolvers into asyncio tasks and sync_to_async threads
+active_tracer = contextvars.ContextVar("crm_active_tracer", default=None)
+current_path = contextvars.ContextVar("crm_trace_path", default=())
+
+
+def field_key(path):
+    """allOrders.edges.0.node.customer -> allOrders.edges.node.customer"""
+    return ".".join(str(part) for part in path if not isinstance(part, int))
+
+
+def normalize_sql(sql):
+    # the SQL handed to execute wrappers is still parametrized, IN lists just vary in length
+    return re.sub(r"IN \((%s,? ?)+\)", "IN (...)", sql)
+
+
+class Tracer:
+    def __init__(self, include_in_response=False, duplicate_threshold=3):
+        self.include_in_response = include_in_response
+        self.duplicate_threshold = duplicate_threshold
+        self.start_wall = datetime.now(timezone.utc)
+        self.start = time.perf_counter_ns()
+        self.end = None
+        self.resolvers = []
+        # SQL of the async view comes in from several threads at once
+        self.lock = threading.Lock()
+        self.sql_count = Counter()
+        self.sql_time = Counter()
+        self.sql_statements = defaultdict(Counter)
+
+    def offset(self):
+        return time.perf_counter_ns() - self.start
+
+    # graphene middleware hook
+    def trace_resolver(self, next, root, info, **args):
+        path = tuple(info.path.as_list())
+        start = self.offset()
+        token = current_path.set(path)
+        try:
+            result = next(root, info, **args)
+        except Exception:
+            self.record_resolver(info, path, start)
+            raise
+        finally:
+            current_path.reset(token)
+        if isawaitable(result):
+            return self.trace_awaitable(result, info, path, start)
+        self.record_resolver(info, path, start)
+        return result
+
+    async def trace_awaitable(self, result, info, path, start):
+        # an async resolver runs when it is awaited, the path has to be set again then
+        token = current_path.set(path)
+        try:
+            return await result
+        finally:
+            current_path.reset(token)
+            self.record_resolver(info, path, start)
+
+    def record_resolver(self, info, path, start):
+        self.resolvers.append({
+            "path": list(path),
+            "parentType": str(info.parent_type),
+            "fieldName": info.field_name,
+            "returnType": str(info.return_type),
+            "startOffset": start,
+            "duration": self.offset() - start,
+        })
+
+    # django execute_wrapper hook
+    def trace_sql(self, execute, sql, params, many, context):
+        start = time.perf_counter_ns()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter_ns() - start
+            key = field_key(current_path.get()) or "(root)"
+            with self.lock:
+                self.sql_count[key] += 1
+                self.sql_time[key] += duration
+                self.sql_statements[key][normalize_sql(sql)] += 1
+
+    @contextmanager
+    def capture_sql(self):
+        # connections opened before connect_signals() ran have no wrapper yet
+        for alias in connections:
+            install_sql_wrapper(connections[alias])
+        token = active_tracer.set(self)
+        try:
+            yield self
+        finally:
+            active_tracer.reset(token)
+
+    def finish(self):
+        self.end = time.perf_counter_ns()
+
+    def duplicates(self):
+        return [
+            {"field": key, "sql": sql, "count": count}
+            for key, statements in self.sql_statements.items()
+            for sql, count in statements.items()
+            if count >= self.duplicate_threshold
+        ]
+
+    def report(self):
+        """the trace in Apollo tracing format, plus SQL stats per field"""
+        end = self.end or time.perf_counter_ns()
+        duration = end - self.start
+        return {
+            "version": 1,
+            "startTime": self.start_wall.isoformat(),
+            "endTime": (self.start_wall + timedelta(microseconds=duration / 1000)).isoformat(),
+            "duration": duration,
+            "execution": {"resolvers": self.resolvers},
+            "sql": {
+                "count": sum(self.sql_count.values()),
+                "duration": sum(self.sql_time.values()),
+                "byField": {
+                    key: {"count": self.sql_count[key], "duration": self.sql_time[key]}
+                    for key in self.sql_count
+                },
+                "duplicates": self.duplicates(),
+            },
+        }
+
+    def to_json(self):
+        return json.dumps(self.report())
+
+
+def trace_active_sql(execute, sql, params, many, context):
+    """execute wrapper on every connection, hands the statement to the active Tracer if any"""
+    tracer = active_tracer.get()
+    if tracer is None:
+        return execute(sql, params, many, context)
+    return tracer.trace_sql(execute, sql, params, many, context)
+
+
+def install_sql_wrapper(connection, **kwargs):
+    # execute_wrappers outlives reconnects, connection_created fires on each one
+    if trace_active_sql not in connection.execute_wrappers:
+        connection.execute_wrappers.append(trace_active_sql)
+
+
+def connect_signals():
+    connection_created.connect(install_sql_wrapper, dispatch_uid="crm_tracing_sql")
+
+
+def start_trace(request):
+    """a Tracer if this request is sampled (or asked for one and may), else None"""
+    config = tracing_settings()
+    forced = (
+        config["ALLOW_CLIENT_REQUEST"]
+        and request.headers.get("X-GraphQL-Trace") == "1"
+        and getattr(getattr(request, "user", None), "is_staff", False)
+    )
+    if not forced and not (config["SAMPLE_RATE"] and random.random() < config["SAMPLE_RATE"]):
+        return None
+    return Tracer(
+        include_in_response=config["INCLUDE_IN_RESPONSE"] or forced,
+        duplicate_threshold=config["DUPLICATE_THRESHOLD"],
+    )
+
+
+def finish_trace(tracer):
+    tracer.finish()
+    if tracing_settings()["LOG"]:
+        logger.info(tracer.to_json())
+
+
+class TracingMiddleware:
+    """graphene middleware, a no-op unless the request carries a Tracer"""
+
+    def resolve(self, next, root, info, **args):
+        tracer = getattr(info.context, "tracer", None)
+        if tracer is None:
+            return next(root, info, **args)
+        return tracer.trace_resolver(next, root, info, **args)
@@ -1,8 +1,8 @@
 from django.urls import path
-from graphene_django.views import GraphQLView
-from . import schema
-from django.views.decorators.csrf import csrf_exempt
 
-# urlpatterns = [
-#     path("graphql/", csrf_exempt(GraphQLView.as_view(graphiql=True))),
-# ]
\ No newline at end of file
+from . import views
+
+urlpatterns = [
+    path("export/customers/", views.export_customers, name="export-customers"),
+    path("export/orders/", views.export_orders, name="export-orders"),
+]
@@ -1,3 +1,606 @@
-from django.shortcuts import render
+import asyncio
+import hashlib
+import inspect
+import json
+from collections import namedtuple
+from contextlib import nullcontext
 
-# Create your views here.
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db import connection, transaction
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_GET
+from django.views.generic import View
+from graphene_django.constants import MUTATION_ERRORS_FLAG
+from graphene_django.settings import graphene_settings
+from graphene_django.utils.utils import set_rollback
+from graphene_django.views import GraphQLView, HttpError
+from graphql import (
+    ExecutionResult,
+    GraphQLError,
+    OperationType,
+    execute,
+    get_operation_ast,
+    parse,
+    validate,
+    validate_schema,
+)
+
+from .caching import LRUCache
+from .cost import check_batch_cost, check_query_cost
+from .export import CUSTOMER_COLUMNS, ORDER_HEADER, RENDERERS, customer_rows, order_rows
+from .filters import CustomerFilter, OrderFilter
+from .loaders import AsyncLoaders, Loaders
+from .models import Customer, Order
+from .response_cache import get_response_cache
+from .routing import alias_for, pin_after_write, reading_from
+from .serialization import default_execution_context, dumps
+from .tracing import TracingMiddleware, finish_trace, start_trace
+
+
+PreparedRequest = namedtuple(
+    "PreparedRequest",
+    ["schema", "document", "execute_options", "operation", "atomic", "cost", "tracer", "cache", "batch_key"],
+)
+
+# where a query result goes in the response cache: (ResponseCache, key, model labels)
+CacheSlot = namedtuple("CacheSlot", ["response_cache", "key", "labels"])
+
+
+BATCH_DEFAULTS = {
+    # most operations one JSON array body may hold
+    "MAX_OPERATIONS": 20,
+    # async view: run consecutive queries of a batch side by side
+    "CONCURRENT_READS": True,
+}
+
+
+def batch_settings():
+    return {**BATCH_DEFAULTS, **getattr(settings, "GRAPHQL_BATCH", {})}
+
+
+def query_hash(query):
+    return hashlib.sha256(query.encode("utf-8")).hexdigest()
+
+
+class CRMGraphQLView(GraphQLView):
+    """GraphQLView with per-request DataLoaders, a parsed/validated document
+    cache, Automatic Persisted Query support, query cost limits and an
+    optional response cache for read queries (crm.response_cache).
+
+    the document cache is keyed by the sha256 of the query text, which is
+    also the APQ hash, so a persisted query is simply a cache entry that the
+    client refers to by hash instead of sending the text again.
+
+    a JSON array body is a batch: its operations run in order in the same
+    request and share one set of loaders, so a customer loaded by the first
+    operation is not fetched again by the next, and a query repeated with the
+    same variables is executed once. a mutation starts over with empty
+    loaders and forgets the results of the queries before it. the cost of
+    all its operations together must fit GRAPHQL_MAX_QUERY_COST.
+
+    with DATABASE_READ_REPLICAS configured, query operations read from a
+    replica (crm.routing), unless the request or, within the pin window, the
+    same client has run a mutation.
+
+    column fields of the nodes are serialized by crm.serialization's
+    FastExecutionContext (GRAPHQL_FAST_PATH), and responses are encoded
+    with orjson when it is installed.
+    """
+
+    # shared across requests, as_view() builds a new instance every time. keyed by
+    # (id of the schema, validation rules, query hash), see cached_document
+    document_cache = LRUCache(getattr(settings, "GRAPHQL_DOCUMENT_CACHE_SIZE", 1000))
+
+    def get_context(self, request):
+        # the operations of a batch share the request, and with it the loaders
+        if getattr(request, "loaders", None) is None:
+            self.reset_batch_state(request)
+        return request
+
+    def dispatch(self, request, *args, **kwargs):
+        return pin_after_write(request, super().dispatch(request, *args, **kwargs))
+
+    @staticmethod
+    def reset_batch_state(request):
+        """forget whatever earlier operations of the request loaded"""
+        request.loaders = AsyncLoaders() if getattr(request, "is_async", False) else Loaders()
+        request.batch_results = {}
+
+    def parse_body(self, request):
+        if self.get_content_type(request) == "application/json" and request.body.lstrip()[:1] == b"[":
+            # GraphQLView only takes arrays when built with batch=True, and then nothing else
+            self.batch = True
+            entries = super().parse_body(request)
+            limit = batch_settings()["MAX_OPERATIONS"]
+            if len(entries) > limit:
+                raise HttpError(HttpResponseBadRequest(f"A batch may hold at most {limit} operations."))
+            if not all(isinstance(entry, dict) for entry in entries):
+                raise HttpError(HttpResponseBadRequest("Every operation of a batch must be a JSON object."))
+            # rejected as a whole, before any of it runs
+            error = check_batch_cost([self.operation_cost(request, entry) for entry in entries])
+            if error is not None:
+                raise HttpError(HttpResponseBadRequest(error.message))
+            return entries
+        return super().parse_body(request)
+
+    def operation_cost(self, request, entry):
+        """requestedQueryCost of one operation of a batch, 0 if it fails before executing"""
+        query, variables, operation_name, _ = self.get_graphql_params(request, entry)
+        if query:
+            document, errors = self.get_document(query)
+        else:
+            persisted_hash = self.get_persisted_hash(request, entry)
+            document, errors = (persisted_hash and self.cached_document(persisted_hash)) or (None, None)
+        if document is None or errors:
+            return 0
+        _, cost = check_query_cost(self.schema.graphql_schema, document, variables, operation_name)
+        return cost["requestedQueryCost"] if cost else 0
+
+    def json_encode(self, request, d, pretty=False):
+        if not (self.pretty or pretty) and not request.GET.get("pretty"):
+            return dumps(d)
+        return super().json_encode(request, d, pretty)
+
+    def get_middleware(self, request):
+        middleware = list(self.middleware or [])
+        if getattr(request, "tracer", None) is not None:
+            # only sampled requests pay for per-resolver timing
+            middleware.append(TracingMiddleware())
+        return middleware
+
+    @staticmethod
+    def get_persisted_hash(request, data):
+        """the sha256Hash of an APQ request (`extensions.persistedQuery`), if any"""
+        extensions = request.GET.get("extensions") or data.get("extensions")
+        if isinstance(extensions, str):
+            try:
+                extensions = json.loads(extensions)
+            except ValueError:
+                raise HttpError(HttpResponseBadRequest("Extensions are invalid JSON."))
+        persisted = (extensions or {}).get("persistedQuery")
+        if not persisted:
+            return None
+        if persisted.get("version") != 1:
+            raise HttpError(HttpResponseBadRequest("Unsupported persisted query version."))
+        return persisted.get("sha256Hash")
+
+    def get_document(self, query, key=None):
+        """parse and validate `query`, going through the document cache.
+
+        returns (document, errors); documents that fail to parse are not cached.
+        """
+        key = key or query_hash(query)
+        entry = self.cached_document(key)
+        if entry is not None:
+            return entry
+
+        try:
+            document = parse(query)
+        except GraphQLError as e:
+            return None, [e]
+
+        errors = validate(
+            self.schema.graphql_schema,
+            document,
+            self.validation_rules,
+            graphene_settings.MAX_VALIDATION_ERRORS,
+        )
+        # the entry holds on to the schema, so its id can't be reused while the entry lives
+        self.document_cache.set(self.document_key(key), (self.schema.graphql_schema, document, errors))
+        return document, errors
+
+    def document_key(self, key):
+        # a document is only valid for the schema and rules it was validated against,
+        # views on another schema (warm up, subscriptions, tests) must not be served it
+        return (id(self.schema.graphql_schema), tuple(self.validation_rules or ()), key)
+
+    def cached_document(self, key):
+        """(document, errors) cached for this view's schema under the query hash `key`, or None"""
+        entry = self.document_cache.get(self.document_key(key))
+        return None if entry is None else entry[1:]
+
+    def prepare_request(
+        self, request, data, query, variables, operation_name, show_graphiql=False
+    ):
+        """everything up to execution: APQ lookup, parse/validate (cached), cost.
+
+        returns an ExecutionResult (or None for graphiql) when the request
+        ends early, otherwise a PreparedRequest ready to execute.
+        """
+        persisted_hash = self.get_persisted_hash(request, data)
+
+        if persisted_hash and query and query_hash(query) != persisted_hash:
+            return ExecutionResult(errors=[GraphQLError("provided sha does not match query")])
+
+        if persisted_hash and not query:
+            entry = self.cached_document(persisted_hash)
+            if entry is None:
+                # the client retries with the full query text, which registers it
+                return ExecutionResult(errors=[GraphQLError(
+                    "PersistedQueryNotFound",
+                    extensions={"code": "PERSISTED_QUERY_NOT_FOUND"},
+                )])
+        elif not query:
+            if show_graphiql:
+                return None
+            raise HttpError(HttpResponseBadRequest("Must provide query string."))
+        else:
+            entry = None
+
+        document_key = persisted_hash or query_hash(query)
+        schema = self.schema.graphql_schema
+
+        schema_validation_errors = validate_schema(schema)
+        if schema_validation_errors:
+            return ExecutionResult(data=None, errors=schema_validation_errors)
+
+        document, validation_errors = entry or self.get_document(query, document_key)
+        if document is None:
+            return ExecutionResult(errors=validation_errors)
+
+        operation_ast = get_operation_ast(document, operation_name)
+
+        if (
+            request.method.lower() == "get"
+            and operation_ast is not None
+            and operation_ast.operation != OperationType.QUERY
+        ):
+            if show_graphiql:
+                return None
+
+            raise HttpError(
+                HttpResponseNotAllowed(
+                    ["POST"],
+                    "Can only perform a {} operation from a POST request.".format(
+                        operation_ast.operation.value
+                    ),
+                )
+            )
+
+        if validation_errors:
+            return ExecutionResult(data=None, errors=validation_errors)
+
+        # cost depends on the variables, so it is checked on every request
+        cost_errors, cost = check_query_cost(schema, document, variables, operation_name)
+        if cost_errors:
+            return ExecutionResult(data=None, errors=cost_errors, extensions={"cost": cost})
+
+        tracer = request.tracer = start_trace(request)
+        execute_options = {
+            "root_value": self.get_root_value(request),
+            "context_value": self.get_context(request),
+            "variable_values": variables,
+            "operation_name": operation_name,
+            "middleware": self.get_middleware(request),
+        }
+        execution_context_class = self.execution_context_class or default_execution_context()
+        if execution_context_class:
+            execute_options["execution_context_class"] = execution_context_class
+
+        atomic = (
+            operation_ast is not None
+            and operation_ast.operation == OperationType.MUTATION
+            and (
+                graphene_settings.ATOMIC_MUTATIONS is True
+                or connection.settings_dict.get("ATOMIC_MUTATIONS", False) is True
+            )
+        )
+
+        cache = None
+        response_cache = get_response_cache()
+        if (
+            response_cache is not None
+            and tracer is None
+            and operation_ast is not None
+            and operation_ast.operation == OperationType.QUERY
+        ):
+            key, labels = response_cache.make_key(document_key, schema, document, operation_name, variables)
+            cache = CacheSlot(response_cache, key, labels)
+        operation = operation_ast.operation if operation_ast is not None else None
+        batch_key = None
+        if self.batch and tracer is None and operation == OperationType.QUERY:
+            batch_key = (document_key, operation_name, json.dumps(variables, sort_keys=True))
+        return PreparedRequest(schema, document, execute_options, operation, atomic, cost, tracer, cache, batch_key)
+
+    def execute_graphql_request(
+        self, request, data, query, variables, operation_name, show_graphiql=False
+    ):
+        prepared = self.prepare_request(
+            request, data, query, variables, operation_name, show_graphiql
+        )
+        if not isinstance(prepared, PreparedRequest):
+            return prepared
+        return self.run_prepared(request, prepared)
+
+    def run_prepared(self, request, prepared):
+        shared = self.get_shared(request, prepared)
+        if shared is not None:
+            return self.finish_result(prepared, shared)
+        cached, versions = self.get_cached(prepared)
+        if cached is not None:
+            return self.finish_result(prepared, cached)
+        if prepared.operation == OperationType.MUTATION:
+            # whatever earlier operations of the batch loaded may be about to change
+            self.reset_batch_state(request)
+            request.wrote = True
+        alias = alias_for(request, prepared.operation)
+        try:
+            with reading_from(alias):
+                if prepared.atomic:
+                    with transaction.atomic():
+                        result = self.execute(prepared)
+                        if getattr(request, MUTATION_ERRORS_FLAG, False) is True:
+                            transaction.set_rollback(True)
+                else:
+                    result = self.execute(prepared)
+        except Exception as e:
+            return ExecutionResult(errors=[e])
+        self.store_result(prepared, versions, result, alias)
+        self.share_result(request, prepared, result)
+        return self.finish_result(prepared, result)
+
+    @staticmethod
+    def get_cached(prepared):
+        """(ExecutionResult from the response cache or None, versions to store with)"""
+        if prepared.cache is None:
+            return None, None
+        data, versions = prepared.cache.response_cache.get(prepared.cache.key, prepared.cache.labels)
+        return (ExecutionResult(data=data) if data is not None else None), versions
+
+    @staticmethod
+    def store_result(prepared, versions, result, alias=None):
+        # a lagging replica may not have the write the versions already count,
+        # its answer would be served as current until the next write
+        if alias is not None:
+            return
+        if prepared.cache is not None and result.data is not None and not result.errors:
+            prepared.cache.response_cache.set(prepared.cache.key, versions, result.data)
+
+    @staticmethod
+    def get_shared(request, prepared):
+        """the result of the same query earlier in the batch, if any"""
+        if prepared.batch_key is None:
+            return None
+        result = request.batch_results.get(prepared.batch_key)
+        return ExecutionResult(data=result.data) if result is not None else None
+
+    @staticmethod
+    def share_result(request, prepared, result):
+        if prepared.batch_key is not None and result.data is not None and not result.errors:
+            request.batch_results[prepared.batch_key] = result
+
+    @staticmethod
+    def capture_sql(prepared):
+        return prepared.tracer.capture_sql() if prepared.tracer is not None else nullcontext()
+
+    def execute(self, prepared):
+        with self.capture_sql(prepared):
+            return execute(prepared.schema, prepared.document, **prepared.execute_options)
+
+    @staticmethod
+    def finish_result(prepared, result):
+        result.extensions = {**(result.extensions or {}), "cost": prepared.cost}
+        tracer = prepared.tracer
+        if tracer is not None:
+            finish_trace(tracer)
+            if tracer.include_in_response:
+                result.extensions["tracing"] = tracer.report()
+        return result
+
+    def get_response(self, request, data, show_graphiql=False):
+        # same as GraphQLView.get_response, plus the result `extensions`
+        query, variables, operation_name, id = self.get_graphql_params(request, data)
+
+        execution_result = self.execute_graphql_request(
+            request, data, query, variables, operation_name, show_graphiql
+        )
+        return self.encode_result(request, execution_result, id, show_graphiql)
+
+    def encode_result(self, request, execution_result, id=None, show_graphiql=False):
+        if getattr(request, MUTATION_ERRORS_FLAG, False) is True:
+            set_rollback()
+
+        if not execution_result:
+            return None, 200
+
+        status_code = 200
+        response = {}
+        if execution_result.errors:
+            set_rollback()
+            response["errors"] = [self.format_error(e) for e in execution_result.errors]
+
+        if execution_result.errors and any(
+            not getattr(e, "path", None) for e in execution_result.errors
+        ):
+            status_code = 400
+        else:
+            response["data"] = execution_result.data
+
+        if execution_result.extensions:
+            response["extensions"] = execution_result.extensions
+
+        if self.batch:
+            response["id"] = id
+            response["status"] = status_code
+
+        return self.json_encode(request, response, pretty=show_graphiql), status_code
+
+
+# ==========
+#  async execution path, served through ASGI.
+#  root Query fields run concurrently, each in its own worker thread (see
+#  crm.concurrency.run_sync), relations are loaded with async DataLoaders
+#  on Django's async ORM, and mutations have async variants.
+# ==========
+
+class AsyncCRMGraphQLView(CRMGraphQLView):
+    """CRMGraphQLView whose requests don't hold a worker thread while waiting on the DB"""
+
+    def get_context(self, request):
+        request.is_async = True
+        return super().get_context(request)
+
+    def dispatch(self, request, *args, **kwargs):
+        # plain View.dispatch, routes to the async get/post below
+        return View.dispatch(self, request, *args, **kwargs)
+
+    async def get(self, request, *args, **kwargs):
+        return await self.async_dispatch(request)
+
+    async def post(self, request, *args, **kwargs):
+        return await self.async_dispatch(request)
+
+    async def async_dispatch(self, request):
+        if hasattr(request, "auser"):
+            # start_trace looks at request.user, the lazy one would hit the session from the event loop
+            request.user = await request.auser()
+        try:
+            data = self.parse_body(request)
+            if self.graphiql and self.can_display_graphiql(request, data):
+                # the IDE page is static, the sync view knows how to render it
+                return await sync_to_async(super().dispatch)(request)
+
+            if self.batch:
+                responses = await self.get_batch_response_async(request, data)
+                result = "[{}]".format(",".join(response[0] for response in responses))
+                status_code = max((response[1] for response in responses), default=200)
+            else:
+                result, status_code = await self.get_response_async(request, data)
+
+            response = HttpResponse(status=status_code, content=result, content_type="application/json")
+            return pin_after_write(request, response)
+        except HttpError as e:
+            response = e.response
+            response["Content-Type"] = "application/json"
+            response.content = self.json_encode(request, {"errors": [self.format_error(e)]})
+            return response
+
+    async def get_response_async(self, request, data):
+        query, variables, operation_name, id = self.get_graphql_params(request, data)
+        execution_result = await self.execute_graphql_request_async(
+            request, data, query, variables, operation_name
+        )
+        return self.encode_result(request, execution_result, id)
+
+    async def get_batch_response_async(self, request, entries):
+        """[(content, status)] of the operations of a batch, in order.
+
+        consecutive queries run side by side (unless CONCURRENT_READS is off),
+        their async loaders batch and dedupe relation lookups across all of
+        them. a mutation waits for the queries before it and runs alone, and so
+        does a traced operation, whose resolvers must not mix with others.
+        """
+        concurrent = batch_settings()["CONCURRENT_READS"]
+        responses, pending = [], []
+
+        async def flush():
+            # a query repeated within the group runs once
+            runs = {}
+            for _, prepared in pending:
+                runs.setdefault(prepared.batch_key, prepared)
+            results = await asyncio.gather(*(self.execute_prepared_async(request, run) for run in runs.values()))
+            results = dict(zip(runs, results))
+            responses.extend(self.encode_result(request, results[prepared.batch_key], id) for id, prepared in pending)
+            pending.clear()
+
+        for entry in entries:
+            query, variables, operation_name, id = self.get_graphql_params(request, entry)
+            prepared = self.prepare_request(request, entry, query, variables, operation_name)
+            # only untraced queries of a batch have a batch_key
+            if concurrent and isinstance(prepared, PreparedRequest) and prepared.batch_key is not None:
+                pending.append((id, prepared))
+                continue
+            await flush()
+            if isinstance(prepared, PreparedRequest):
+                prepared = await self.execute_prepared_async(request, prepared)
+            responses.append(self.encode_result(request, prepared, id))
+        await flush()
+        return responses
+
+    def execute_atomic(self, request, prepared):
+        # back to sync loaders, this runs in a thread with a plain connection
+        request.is_async = False
+        try:
+            return self.run_prepared(request, prepared)
+        finally:
+            request.is_async = True
+            self.reset_batch_state(request)
+
+    async def execute_graphql_request_async(self, request, data, query, variables, operation_name):
+        prepared = self.prepare_request(request, data, query, variables, operation_name)
+        if not isinstance(prepared, PreparedRequest):
+            return prepared
+        return await self.execute_prepared_async(request, prepared)
+
+    async def execute_prepared_async(self, request, prepared):
+        if prepared.atomic:
+            # transaction.atomic() has no async version, run the whole thing in a thread
+            return await sync_to_async(self.execute_atomic)(request, prepared)
+
+        shared = self.get_shared(request, prepared)
+        if shared is not None:
+            return self.finish_result(prepared, shared)
+        cached, versions = self.get_cached(prepared)
+        if cached is not None:
+            return self.finish_result(prepared, cached)
+        if prepared.operation == OperationType.MUTATION:
+            self.reset_batch_state(request)
+            request.wrote = True
+        alias = alias_for(request, prepared.operation)
+        try:
+            # resolvers pick the alias up in their run_sync threads, the context is copied there
+            with reading_from(alias), self.capture_sql(prepared):
+                result = execute(prepared.schema, prepared.document, **prepared.execute_options)
+                if inspect.isawaitable(result):
+                    result = await result
+        except Exception as e:
+            return ExecutionResult(errors=[e])
+        self.store_result(prepared, versions, result, alias)
+        self.share_result(request, prepared, result)
+        return self.finish_result(prepared, result)
+
+
+def cache_stats(request):
+    """hit ratios of the document and response caches of this process"""
+    response_cache = get_response_cache()
+    return JsonResponse({
+        "documents": CRMGraphQLView.document_cache.stats(),
+        "responses": response_cache.stats() if response_cache is not None else None,
+    })
+
+
+# ==========
+#  streaming exports, filtered with the same filtersets as the GraphQL connections:
+#  /crm/export/orders/?format=ndjson&order_date__gte=2025-01-01&customer_name=ann
+#  they hand out every customer's contact details, so they are for staff only.
+# ==========
+
+def stream_export(request, filterset_class, queryset, rows, header, name):
+    export_format = request.GET.get("format", "csv")
+    if export_format not in RENDERERS:
+        return JsonResponse({"errors": {"format": [f"one of {', '.join(RENDERERS)}"]}}, status=400)
+    params = request.GET.copy()
+    params.pop("format", None)
+    filterset = filterset_class(params, queryset=queryset)
+    if not filterset.is_valid():
+        return JsonResponse({"errors": filterset.errors}, status=400)
+
+    render, content_type = RENDERERS[export_format]
+    response = StreamingHttpResponse(render(header, rows(filterset.qs)), content_type=content_type)
+    response["Content-Disposition"] = f'attachment; filename="{name}.{export_format}"'
+    return response
+
+
+@require_GET
+@staff_member_required
+def export_customers(request):
+    return stream_export(request, CustomerFilter, Customer.objects.all(), customer_rows, CUSTOMER_COLUMNS, "customers")
+
+
+@require_GET
+@staff_member_required
+def export_orders(request):
+    return stream_export(request, OrderFilter, Order.objects.all(), order_rows, ORDER_HEADER, "orders")
@@ -0,0 +1,178 @@
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+from django.conf import settings
+
+
+logger = logging.getLogger("crm.warmup")
+
+# ==========
+#  worker boot.
+#  the schema is built on first use (alx_backend_graphql/schema.py), so
+#  without a warm up the first request of every new worker builds it, checks
+#  it with validate_schema, and parses and validates its document from
+#  scratch. warm_up() does all of that when the worker starts (asgi.py and
+#  wsgi.py call it), plus the introspection query GraphiQL and codegen
+#  clients open with, and the documents the frontend ships, so that they
+#  are found in the document cache.
+#  `manage.py boot_report` times a cold boot in a fresh interpreter.
+# ==========
+
+DEFAULTS = {
+    # warm up when asgi.py/wsgi.py load, runserver included (it loads wsgi.py). the
+    # tests never import either, the test client builds its own handler
+    "ENABLED": False,
+    # run the introspection query once
+    "INTROSPECTION": True,
+    # .graphql/.gql files, or directories of them, each holding a document as clients send it
+    # (byte for byte: the document cache and persisted queries go by the sha256 of the text)
+    "DOCUMENTS": [],
+}
+
+DOCUMENT_EXTENSIONS = (".graphql", ".gql")
+
+
+def warmup_settings():
+    return {**DEFAULTS, **getattr(settings, "GRAPHQL_WARMUP", {})}
+
+
+def document_files(paths):
+    """the document files in `paths`, directories searched recursively"""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in sorted(os.walk(path)):
+                yield from (os.path.join(root, name) for name in sorted(names) if name.endswith(DOCUMENT_EXTENSIONS))
+        else:
+            yield path
+
+
+@contextmanager
+def timed(timings, step):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[step] = round((time.perf_counter() - start) * 1000, 1)
+
+
+def warm_up(config=None):
+    """build the schema and fill the caches a first request would, {step: ms}"""
+    from django.urls import get_resolver
+    from graphene_django.settings import graphene_settings
+    from graphql import execute, get_introspection_query, validate_schema
+
+    from .views import CRMGraphQLView
+
+    config = config or warmup_settings()
+    timings = {}
+    with timed(timings, "urlconf"):
+        get_resolver().url_patterns
+    with timed(timings, "schema"):
+        schema = graphene_settings.SCHEMA
+        # graphql-core keeps the result, the views call it on every request
+        validate_schema(schema.graphql_schema)
+    view = CRMGraphQLView(schema=schema)
+    if config["INTROSPECTION"]:
+        with timed(timings, "introspection"):
+            document, errors = view.get_document(get_introspection_query())
+            if not errors:
+                errors = execute(schema.graphql_schema, document).errors
+            if errors:
+                logger.warning("introspection failed: %s", errors[0])
+    if config["DOCUMENTS"]:
+        with timed(timings, "documents"):
+            for path in document_files(config["DOCUMENTS"]):
+                with open(path, encoding="utf-8") as file:
+                    _, errors = view.get_document(file.read())
+                if errors:
+                    # still cached, the clients sending it get the same errors without a parse
+                    logger.warning("%s does not validate: %s", path, errors[0])
+    logger.info("warmed up in %sms: %s", sum(timings.values()), timings)
+    return timings
+
+
+# ==========
+#  boot report, see `manage.py boot_report`
+# ==========
+
+# runs in a fresh interpreter started with -X importtime, prints the phases as JSON
+BOOT_SCRIPT = """
+import json, sys, time
+
+start = time.perf_counter()
+phases = {}
+
+
+def mark(phase):
+    global start
+    now = time.perf_counter()
+    phases[phase] = round((now - start) * 1000, 1)
+    start = now
+
+
+import django
+django.setup()
+mark("django.setup")
+
+from django.urls import get_resolver
+get_resolver().url_patterns
+mark("urlconf")
+
+warm, query = json.loads(sys.argv[1])
+if warm:
+    from crm.warmup import warm_up
+    warm_up()
+    mark("warm_up")
+
+from django.test import Client
+from django.test.utils import setup_test_environment
+setup_test_environment()  # lets the client's host through ALLOWED_HOSTS
+client = Client()
+mark("client")
+
+statuses = []
+for phase in ("first request", "second request"):
+    response = client.post("/graphql/", json.dumps({"query": query}), content_type="application/json")
+    statuses.append(response.status_code)
+    mark(phase)
+
+print(json.dumps({"phases": phases, "statuses": statuses}))
+"""
+
+# one line of -X importtime output
+ImportTime = namedtuple("ImportTime", ["module", "depth", "self_us", "cumulative_us"])
+
+
+def parse_importtime(text):
+    """the ImportTimes in the stderr of `python -X importtime`, in the order they finished"""
+    imports = []
+    for line in text.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        module = name.strip()
+        # nested imports are indented by two spaces per level
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append(ImportTime(module, depth, int(self_us), int(cumulative_us)))
+    return imports
+
+
+def boot_report(warm=False, query="{ hello }"):
+    """boot a worker in a fresh interpreter: {phases: {phase: ms}, statuses, imports: [ImportTime]}"""
+    env = {**os.environ, "DJANGO_SETTINGS_MODULE": settings.SETTINGS_MODULE}
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [str(settings.BASE_DIR), env.get("PYTHONPATH")]))
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", BOOT_SCRIPT, json.dumps([warm, query])],
+        capture_output=True, text=True, env=env, cwd=settings.BASE_DIR,
+    )
+    if process.returncode:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1] if process.stderr.strip() else "boot failed")
+    report = json.loads(process.stdout.strip().splitlines()[-1])
+    report["imports"] = parse_importtime(process.stderr)
+    return report
@@ -1,7 +1,8 @@
-import graphene
-from graphene_django import DjangoObjectType
+# the project schema lives in alx_backend_graphql/schema.py (hello included),
+# this only forwards to it so there is one schema, built once, on first use
 
-class Query(graphene.ObjectType):
-    hello = graphene.String(default_value="Hello, GraphQL!")
 
-schema = graphene.Schema(query=Query)
\ No newline at end of file
+def __getattr__(name):
+    from alx_backend_graphql import schema
+
+    return getattr(schema, name)